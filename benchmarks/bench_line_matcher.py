@@ -0,0 +1,102 @@
+"""Micro-benchmark: RemovedLineMatcher against the original blame-line scan.
+
+Usage: python benchmarks/bench_line_matcher.py [--lines N] [--removed N ...]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from line_matcher import MATCH_CONTEXT, MATCH_EXACT, RemovedLineMatcher
+
+IDENTIFIERS = ["buf", "len", "ptr", "ctx", "state", "size", "offset", "tmp", "node"]
+CALLS = ["memcpy", "malloc", "free", "strlen", "check_bounds", "read_header"]
+
+
+def synthetic_line(rng):
+    kind = rng.random()
+    a, b = rng.sample(IDENTIFIERS, 2)
+    if kind < 0.4:
+        return f"{a} = {rng.choice(CALLS)}({b}, {rng.randint(0, 4096)});"
+    if kind < 0.7:
+        return f"if ({a} > {b} + {rng.randint(0, 64)}) {{"
+    if kind < 0.8:
+        return "}"
+    return f"/* {a} {rng.choice(CALLS)} {b} {rng.randint(0, 10 ** 6)} */"
+
+
+def original_scan(blame_lines, removed_lines):
+    hits = 0
+    used_context_lines = False
+    for line_content in blame_lines:
+        if line_content in removed_lines:
+            hits += 1
+        elif any(removed_line in line_content for removed_line in removed_lines):
+            hits += 1
+            used_context_lines = True
+    return hits, used_context_lines
+
+
+def matcher_scan(blame_lines, removed_lines):
+    matcher = RemovedLineMatcher(removed_lines)
+    hits = 0
+    used_context_lines = False
+    for line_content in blame_lines:
+        match = matcher.match(line_content)
+        if match == MATCH_EXACT:
+            hits += 1
+        elif match == MATCH_CONTEXT:
+            hits += 1
+            used_context_lines = True
+    return hits, used_context_lines
+
+
+def best_of(repeat, func, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--removed", type=int, nargs="+", default=[5, 50, 500, 2000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    blame_lines = [synthetic_line(rng) for _ in range(args.lines)]
+
+    print(f"{'removed':>8} {'original (s)':>14} {'matcher (s)':>14} {'speedup':>9}")
+    for removed_count in args.removed:
+        removed_lines = rng.sample(blame_lines, removed_count // 2) + [
+            synthetic_line(rng) for _ in range(removed_count - removed_count // 2)
+        ]
+        original_time, original_result = best_of(
+            args.repeat, original_scan, blame_lines, removed_lines
+        )
+        matcher_time, matcher_result = best_of(
+            args.repeat, matcher_scan, blame_lines, removed_lines
+        )
+        if original_result != matcher_result:
+            raise SystemExit(
+                f"Result mismatch for {removed_count} removed lines: "
+                f"{original_result} != {matcher_result}"
+            )
+        print(
+            f"{removed_count:>8} {original_time:>14.4f} {matcher_time:>14.4f} "
+            f"{original_time / matcher_time:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Check and time network.py against a local HTTP stand-in for GitHub.
+
+Starts http.server on localhost and covers the retry/backoff loop (5xx,
+429 and refused connections), the memoized repository existence check and
+the Prefetcher, which overlaps existence checks with the processing of
+earlier rows. Exits with an error if the client misbehaves.
+
+Usage: python benchmarks/bench_network.py [--repos N] [--latency S] [--work S]
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+import network
+
+
+class StandIn(ThreadingHTTPServer):
+    """Serves /repo/<name> (HEAD: 200), /missing/<name> (HEAD: 404) and
+    /flaky/<status>/<failures>/<name> (GET: <failures> times <status>, then 200).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.latency = latency
+        self.hits = Counter()
+        self.hits_lock = threading.Lock()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+    def count(self, path):
+        with self.hits_lock:
+            self.hits[path] += 1
+            return self.hits[path]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.server.count(self.path)
+        time.sleep(self.server.latency)
+        self._respond(200 if self.path.startswith("/repo/") else 404)
+
+    def do_GET(self):
+        hits = self.server.count(self.path)
+        parts = self.path.strip("/").split("/")
+        if parts[0] != "flaky":
+            self._respond(404)
+            return
+        status, failures = int(parts[1]), int(parts[2])
+        if hits <= failures:
+            self._respond(status, headers={"Retry-After": "0"})
+        else:
+            self._respond(200, f"ok after {hits} requests".encode())
+
+
+def check(condition, message):
+    if not condition:
+        raise SystemExit(f"FAIL: {message}")
+    print(f"ok   {message}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def check_retries(server):
+    client = network.NetworkClient(max_retries=3, backoff=0.01, max_backoff=0.05)
+    for status in (503, 429):
+        path = f"/flaky/{status}/2/retried"
+        text = client.fetch_text(server.url(path))
+        check(
+            text == "ok after 3 requests" and server.hits[path] == 3,
+            f"{status} is retried until the server recovers",
+        )
+
+    path = "/flaky/500/100/exhausted"
+    try:
+        client.fetch_text(server.url(path))
+        raised = False
+    except requests.HTTPError:
+        raised = True
+    check(raised and server.hits[path] == 4, "a persistent 500 fails after max_retries")
+
+    path = "/flaky/404/100/not-retried"
+    try:
+        client.fetch_text(server.url(path))
+    except requests.HTTPError:
+        pass
+    check(server.hits[path] == 1, "a 404 is not retried")
+
+    start = time.perf_counter()
+    try:
+        client.request("GET", f"http://127.0.0.1:{free_port()}/", timeout=1)
+        raised = False
+    except requests.ConnectionError:
+        raised = True
+    elapsed = time.perf_counter() - start
+    # Three backoff sleeps of 0.01, 0.02 and 0.04 s, each jittered to 50-100%.
+    check(
+        raised and elapsed >= 0.035,
+        f"refused connections back off and re-raise ({elapsed:.3f} s)",
+    )
+    client.close()
+
+
+def check_memoized(server):
+    client = network.NetworkClient(max_workers=8)
+    url = server.url("/repo/memo")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(client.repo_exists, [url] * 32))
+    results += [client.repo_exists(url) for _ in range(8)]
+    check(
+        all(results) and server.hits["/repo/memo"] == 1,
+        "40 concurrent and repeated checks of one repository send one HEAD",
+    )
+    missing = server.url("/missing/memo")
+    check(
+        not client.repo_exists(missing)
+        and not client.repo_exists(missing)
+        and server.hits["/missing/memo"] == 1,
+        "a missing repository is memoized as missing",
+    )
+    client.close()
+
+
+def process_rows(server, repo_urls, work, prefetch):
+    client = network.NetworkClient(max_workers=8)
+    prefetcher = network.Prefetcher(repo_urls, ahead=8, client=client) if prefetch else None
+    start = time.perf_counter()
+    for index, repo_url in enumerate(repo_urls):
+        if prefetcher is not None:
+            prefetcher.advance(index)
+        if not client.repo_exists(repo_url):
+            raise SystemExit(f"FAIL: {repo_url} reported missing")
+        time.sleep(work)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+
+def row_urls(server, prefix, repos):
+    # Two rows per repository, as several CVEs often share one.
+    return [server.url(f"/repo/{prefix}-{index}") for index in range(repos) for _ in range(2)]
+
+
+def check_prefetch(server, repos, work):
+    rows = row_urls(server, "serial", repos)
+    serial = process_rows(server, rows, work, False)
+    prefetched = process_rows(server, row_urls(server, "prefetch", repos), work, True)
+    heads = sum(hits for path, hits in server.hits.items() if path.startswith("/repo/prefetch-"))
+    check(heads == repos, f"prefetching checks each of {repos} repositories once")
+    print(
+        f"{len(rows)} rows, {repos} repositories: {serial:.3f} s without prefetch, "
+        f"{prefetched:.3f} s with it ({serial / prefetched:.1f}x)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repos", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per HEAD")
+    parser.add_argument("--work", type=float, default=0.01, help="seconds of work per row")
+    args = parser.parse_args()
+
+    server = StandIn(args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        check_retries(server)
+        check_memoized(server)
+        check_prefetch(server, args.repos, args.work)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""Benchmark the pipeline stages against synthetic local repositories.
+
+Generates repositories with benchmarks/synthetic_repos.py, then times
+get_parent_commits, get_blame_data (patch building, patch parsing, blame
+and line matching separately, plus end to end) and metadata_extractor.
+Nothing touches the network: every repository URL is file://. Results are
+written as JSON, and --compare prints the speedup over an earlier result.
+
+Usage: python benchmarks/bench_stages.py [--output results.json] [--compare old.json] ...
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic_repos
+
+STAGES = ["clone", "parents", "blame.patch", "blame.parse", "blame.blame", "blame.match",
+          "blame", "metadata.log", "metadata"]
+
+
+def timed(repeat, setup, func):
+    """Run setup() then func(state) repeat times; returns (seconds per run, items)."""
+    runs = []
+    items = None
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        items = func(state)
+        runs.append(time.perf_counter() - start)
+    return runs, items
+
+
+def summarize(runs, items):
+    best = min(runs)
+    return {
+        "best_s": best,
+        "mean_s": sum(runs) / len(runs),
+        "runs_s": runs,
+        "items": items,
+        "items_per_s": items / best if items and best else None,
+    }
+
+
+def read_csv(path):
+    with open(path, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def git_revision(path):
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    return result.stdout.strip() or None
+
+
+def run_benchmarks(work_dir, commits_csv, repeat, checkout=False, blobless=False):
+    # The stage modules configure logging and caches relative to the
+    # working directory when imported, so keep all of that in work_dir.
+    os.chdir(work_dir)
+    get_parent_commits = importlib.import_module("get_parent_commits")
+    get_blame_data = importlib.import_module("get_blame_data")
+    metadata_extractor = importlib.import_module("metadata_extractor")
+    from line_matcher import RemovedLineMatcher
+    from repo_store import RepoStore, directory_size
+
+    rows = read_csv(commits_csv)
+    repo_urls = list(dict.fromkeys(row["repo_url"] for row in rows))
+    results = {}
+    counter = iter(range(1 << 30))
+
+    def fresh(name):
+        path = os.path.join(work_dir, f"{name}-{next(counter)}")
+        os.makedirs(path)
+        return path
+
+    # clone: a cold mirror of every repository.
+    def clone(store_dir):
+        store = RepoStore(store_dir, blobless=blobless)
+        for repo_url in repo_urls:
+            store.ensure(repo_url)
+        return len(repo_urls)
+
+    results["clone"] = summarize(*timed(repeat, lambda: fresh("store"), clone))
+
+    # The remaining stages share one warm store, as in a resumed run.
+    store = RepoStore("repo_cache", blobless=blobless)
+    get_blame_data.configure_repo_store("repo_cache", blobless=blobless)
+    for repo_url in repo_urls:
+        store.ensure(repo_url)
+    # Measured before any stage fetches blobs into a blobless store.
+    results["clone"]["store_bytes"] = directory_size("repo_cache")
+
+    parents_csv = os.path.join(work_dir, "commits_with_parent_ids.csv")
+
+    def parents(run_dir):
+        output = os.path.join(run_dir, "parents.csv")
+        get_parent_commits.process_commits(
+            commits_csv, output, state_path=os.path.join(run_dir, "state.sqlite")
+        )
+        shutil.copy(output, parents_csv)
+        return len(rows)
+
+    results["parents"] = summarize(*timed(repeat, lambda: fresh("parents"), parents))
+    parent_rows = [row for row in read_csv(parents_csv) if row["parent_commit_id"]]
+
+    def blame_setup():
+        get_blame_data.configure_cache(root=fresh("blame_cache"))
+        return None
+
+    repo_paths = {url: get_blame_data.get_repo_path(url, bare=not checkout) for url in repo_urls}
+
+    def patches(_):
+        return [
+            get_blame_data.get_local_patch(
+                repo_paths[row["repo_url"]], row["parent_commit_id"], row["commit_id"]
+            )
+            for row in parent_rows
+        ]
+
+    runs, _ = timed(repeat, blame_setup, patches)
+    results["blame.patch"] = summarize(runs, len(parent_rows))
+    patch_texts = patches(None)
+
+    parsed = []
+    runs, _ = timed(
+        repeat, None, lambda _: parsed.__setitem__(slice(None), map(get_blame_data.parse_patch, patch_texts))
+    )
+    results["blame.parse"] = summarize(runs, len(patch_texts))
+
+    blame_jobs = [
+        (row, filename, removed_lines)
+        for row, (file_changes, _) in zip(parent_rows, parsed)
+        for filename, removed_lines in file_changes.items()
+        if removed_lines
+    ]
+    blamed = []
+
+    def blame(_):
+        blamed[:] = [
+            get_blame_data.get_blamed_lines(
+                row["repo_url"], repo_paths[row["repo_url"]], row["commit_id"], filename
+            )
+            for row, filename, _ in blame_jobs
+        ]
+        return len(blame_jobs)
+
+    results["blame.blame"] = summarize(*timed(repeat, blame_setup, blame))
+
+    def match(_):
+        hits = 0
+        for (_, _, removed_lines), blamed_lines in zip(blame_jobs, blamed):
+            matcher = RemovedLineMatcher(removed_lines)
+            for _, line_content in blamed_lines:
+                if matcher.match(line_content.strip()):
+                    hits += 1
+        return sum(len(lines) for lines in blamed)
+
+    results["blame.match"] = summarize(*timed(repeat, None, match))
+
+    blame_csv = os.path.join(work_dir, "commits_with_blame_data.csv")
+
+    def blame_end_to_end(run_dir):
+        output = os.path.join(run_dir, "blame.csv")
+        get_blame_data.process_commits(
+            parents_csv,
+            output,
+            checkout=checkout,
+            state_path=os.path.join(run_dir, "state.sqlite"),
+        )
+        shutil.copy(output, blame_csv)
+        return len(parent_rows)
+
+    def blame_end_to_end_setup():
+        blame_setup()
+        return fresh("blame")
+
+    results["blame"] = summarize(*timed(repeat, blame_end_to_end_setup, blame_end_to_end))
+
+    blame_rows = read_csv(blame_csv)
+    hashes_by_repo = {}
+    for row in blame_rows:
+        hashes_by_repo.setdefault(row["repo_url"], set()).update(
+            filter(None, row["malicious_commit_hashes"].split(","))
+        )
+
+    def metadata_log(_):
+        described = 0
+        for repo_url, commit_hashes in hashes_by_repo.items():
+            described += len(
+                metadata_extractor.get_commits_metadata(store.path_for(repo_url), sorted(commit_hashes))
+            )
+        return described
+
+    results["metadata.log"] = summarize(*timed(repeat, None, metadata_log))
+
+    def metadata(run_dir):
+        metadata_extractor.process_commits(
+            blame_csv,
+            os.path.join(run_dir, "records.jsonl"),
+            os.path.join(run_dir, "index.jsonl"),
+            "repo_cache",
+            state_path=os.path.join(run_dir, "state.sqlite"),
+            blobless=blobless,
+        )
+        return sum(len(hashes) for hashes in hashes_by_repo.values())
+
+    results["metadata"] = summarize(*timed(repeat, lambda: fresh("metadata"), metadata))
+    return results
+
+
+def print_results(results, baseline=None):
+    header = f"{'stage':<14} {'best (s)':>10} {'items':>8} {'items/s':>10}"
+    print(header + (f" {'speedup':>9}" if baseline else ""))
+    for stage in STAGES:
+        result = results.get(stage)
+        if result is None:
+            continue
+        rate = f"{result['items_per_s']:.1f}" if result["items_per_s"] else "-"
+        line = f"{stage:<14} {result['best_s']:>10.4f} {result['items'] or 0:>8} {rate:>10}"
+        if baseline and stage in baseline:
+            line += f" {baseline[stage]['best_s'] / result['best_s']:>8.2f}x"
+        print(line)
+    clone = results.get("clone", {})
+    if "store_bytes" in clone:
+        line = f"repository store after clone: {clone['store_bytes'] / 1024**2:.2f} MiB"
+        if baseline and "store_bytes" in baseline.get("clone", {}):
+            line += f" (was {baseline['clone']['store_bytes'] / 1024**2:.2f} MiB)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repos", type=int, default=3)
+    parser.add_argument("--commits", type=int, default=200, help="history depth per repository")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--file-lines", type=int, default=500)
+    parser.add_argument("--patch-lines", type=int, default=10)
+    parser.add_argument("--fixes-per-repo", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--checkout", action="store_true", help="blame from working copies")
+    parser.add_argument(
+        "--blobless", action="store_true", help="clone without blobs and fetch them on demand"
+    )
+    parser.add_argument("--work-dir", help="keep repositories and outputs here")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="earlier JSON result to compute speedups against")
+    args = parser.parse_args()
+    if args.blobless and args.checkout:
+        parser.error("--blobless cannot be combined with --checkout")
+
+    package_dir = os.path.dirname(BENCH_DIR)
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="bench-stages-"))
+    output = os.path.abspath(args.output) if args.output else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+    params = {
+        key: getattr(args, key)
+        for key in ["repos", "commits", "files", "file_lines", "patch_lines",
+                    "fixes_per_repo", "seed", "repeat", "checkout", "blobless"]
+    }
+    try:
+        commits_csv = synthetic_repos.generate(
+            work_dir,
+            args.repos,
+            args.commits,
+            args.files,
+            args.file_lines,
+            args.patch_lines,
+            args.fixes_per_repo,
+            args.seed,
+        )
+        results = run_benchmarks(
+            work_dir, os.path.abspath(commits_csv), args.repeat, args.checkout, args.blobless
+        )
+    finally:
+        os.chdir(package_dir)
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(package_dir),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "git": subprocess.run(
+            ["git", "--version"], stdout=subprocess.PIPE, text=True
+        ).stdout.strip(),
+        "params": params,
+        "results": results,
+    }
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
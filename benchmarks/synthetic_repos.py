@@ -0,0 +1,175 @@
+"""Generate synthetic git repositories and a matching commits CSV.
+
+Each repository gets a linear history: the first commit adds --files files
+of --file-lines lines and every later commit rewrites or amends a
+block of --patch-lines lines in one of them. A sample of the later commits is
+written to the CSV as "fixes", with file:// commit and repository URLs,
+so the pipeline stages can run against them without network access. The
+repositories allow filtered fetches, so they also stand in for a server
+that supports blobless clones.
+
+Usage: python benchmarks/synthetic_repos.py OUTPUT_DIR [--repos N] [--commits N] ...
+"""
+import argparse
+import csv
+import os
+import random
+import subprocess
+
+COMMITS_FIELDNAMES = ["id", "cve_id", "commit_url", "project_name", "commit_id", "repo_url"]
+
+
+def synthetic_source_line(rng, file_index, line_index, revision):
+    kind = rng.random()
+    if kind < 0.5:
+        return (
+            f"buf_{file_index}_{line_index} = memcpy(dst, src, "
+            f"{rng.randint(0, 4096)}); /* r{revision} */"
+        )
+    if kind < 0.8:
+        return f"if (len_{line_index} > {rng.randint(0, 1 << 16)}) {{ /* r{revision} */"
+    return f"}} /* {file_index}.{line_index} r{revision} */"
+
+
+def _data(payload):
+    encoded = payload.encode()
+    return b"data %d\n" % len(encoded) + encoded + b"\n"
+
+
+def fast_import_stream(rng, commits, files, file_lines, patch_lines):
+    """Yield the git fast-import commands of one synthetic history."""
+    contents = [
+        [synthetic_source_line(rng, f, i, 0) for i in range(file_lines)]
+        for f in range(files)
+    ]
+    timestamp = 1_500_000_000
+    for revision in range(commits):
+        chunks = [
+            b"commit refs/heads/main\n",
+            b"mark :%d\n" % (revision + 1),
+            b"committer Bench Author <bench@example.com> %d +0000\n" % (timestamp + revision * 60),
+            _data(f"Change {revision}\n\nSynthetic commit {revision}."),
+        ]
+        if revision:
+            chunks.append(b"from :%d\n" % revision)
+            changed = [rng.randrange(files)]
+            lines = contents[changed[0]]
+            start = rng.randrange(max(1, file_lines - patch_lines))
+            for line_index in range(start, min(file_lines, start + patch_lines)):
+                if rng.random() < 0.5:
+                    # Amend the line, so blame's context matching has work to do.
+                    lines[line_index] += f" /* fix r{revision} */"
+                else:
+                    lines[line_index] = synthetic_source_line(
+                        rng, changed[0], line_index, revision
+                    )
+        else:
+            changed = range(files)
+        for file_index in changed:
+            chunks.append(b"M 100644 inline src/file_%03d.c\n" % file_index)
+            chunks.append(_data("\n".join(contents[file_index]) + "\n"))
+        yield b"".join(chunks)
+
+
+def create_repo(repo_path, seed=0, commits=200, files=20, file_lines=500, patch_lines=10):
+    """Create a bare repository at repo_path; returns its commit ids, oldest first."""
+    rng = random.Random(seed)
+    subprocess.run(
+        ["git", "init", "--quiet", "--bare", "--initial-branch=main", repo_path], check=True
+    )
+    subprocess.run(["git", "config", "uploadpack.allowFilter", "true"], cwd=repo_path, check=True)
+    marks_file = os.path.join(repo_path, "bench-marks")
+    importer = subprocess.Popen(
+        ["git", "fast-import", "--quiet", f"--export-marks={marks_file}"],
+        cwd=repo_path,
+        stdin=subprocess.PIPE,
+    )
+    for chunk in fast_import_stream(rng, commits, files, file_lines, patch_lines):
+        importer.stdin.write(chunk)
+    importer.stdin.close()
+    if importer.wait() != 0:
+        raise RuntimeError(f"git fast-import failed for {repo_path}")
+
+    marks = {}
+    with open(marks_file) as f:
+        for line in f:
+            mark, commit_id = line.split()
+            marks[int(mark[1:])] = commit_id
+    os.remove(marks_file)
+    return [marks[mark] for mark in sorted(marks)]
+
+
+def generate(
+    output_dir,
+    repos=3,
+    commits=200,
+    files=20,
+    file_lines=500,
+    patch_lines=10,
+    fixes_per_repo=20,
+    seed=0,
+):
+    """Create the repositories under output_dir/repos and output_dir/commits.csv.
+
+    Returns the path of the CSV. Its rows also carry repo_url, so it can be
+    fed straight to get_parent_commits.
+    """
+    rng = random.Random(seed)
+    repos_dir = os.path.abspath(os.path.join(output_dir, "repos"))
+    os.makedirs(repos_dir, exist_ok=True)
+    csv_path = os.path.join(output_dir, "commits.csv")
+    row_id = 0
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COMMITS_FIELDNAMES)
+        writer.writeheader()
+        for repo_index in range(repos):
+            name = f"project{repo_index}"
+            repo_path = os.path.join(repos_dir, "bench", name)
+            commit_ids = create_repo(
+                repo_path, seed + repo_index, commits, files, file_lines, patch_lines
+            )
+            repo_url = f"file://{repo_path}"
+            # The root commit has no parent to blame against.
+            candidates = commit_ids[1:]
+            for commit_id in rng.sample(candidates, min(fixes_per_repo, len(candidates))):
+                writer.writerow(
+                    {
+                        "id": row_id,
+                        "cve_id": f"CVE-2000-{row_id:05d}",
+                        "commit_url": f"{repo_url}/commit/{commit_id}",
+                        "project_name": name,
+                        "commit_id": commit_id,
+                        "repo_url": repo_url,
+                    }
+                )
+                row_id += 1
+    return csv_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output_dir")
+    parser.add_argument("--repos", type=int, default=3)
+    parser.add_argument("--commits", type=int, default=200, help="history depth per repository")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--file-lines", type=int, default=500)
+    parser.add_argument("--patch-lines", type=int, default=10, help="lines rewritten per commit")
+    parser.add_argument("--fixes-per-repo", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    csv_path = generate(
+        args.output_dir,
+        args.repos,
+        args.commits,
+        args.files,
+        args.file_lines,
+        args.patch_lines,
+        args.fixes_per_repo,
+        args.seed,
+    )
+    print(f"Wrote {csv_path}")
+
+
+if __name__ == "__main__":
+    main()
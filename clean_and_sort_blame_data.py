@@ -1,9 +1,15 @@
+import argparse
 import csv
 import os
 from tqdm import tqdm
 
+import columnar_store
+
 
 def clean_and_sort_csv(input_file, output_file):
+    if columnar_store.is_dataset(input_file):
+        return clean_and_sort_dataset(input_file, output_file)
+
     # Read the existing CSV
     with open(input_file, "r", newline="") as infile:
         reader = csv.reader(infile)
@@ -34,7 +40,39 @@ def clean_and_sort_csv(input_file, output_file):
     print(f"Total rows in output: {len(rows)}")
 
 
+def clean_and_sort_dataset(input_path, output_file):
+    """clean_and_sort_csv for a columnar dataset.
+
+    The 8th and 9th columns are read first to find the rows to keep; only
+    then are the remaining columns of those rows read. The output is a CSV,
+    or another dataset if output_file ends in ".cols".
+    """
+    dataset = columnar_store.ColumnarDataset(input_path)
+    header = dataset.columns
+    if len(header) < 9:
+        raise ValueError("Input dataset does not have enough columns")
+
+    rows = dataset.sorted_rows(
+        header[0], key=int, where={header[7]: bool, header[8]: bool}
+    )
+    if output_file.endswith(".cols"):
+        columnar_store.write_dataset(output_file, header, rows)
+    else:
+        dataset.to_csv(output_file, rows=rows)
+
+    print(f"Cleaning and sorting complete. Results saved to {output_file}")
+    print(f"Total rows in output: {len(rows)}")
+
+
 if __name__ == "__main__":
-    input_file = "commits_with_blame_data.csv"
-    output_file = "commits_with_blame_data_cleaned_sorted.csv"
-    clean_and_sort_csv(input_file, output_file)
+    parser = argparse.ArgumentParser(
+        description="Keep rows with blame results and sort them by id."
+    )
+    parser.add_argument(
+        "--input",
+        default="commits_with_blame_data.csv",
+        help="a CSV file or a columnar dataset directory",
+    )
+    parser.add_argument("--output", default="commits_with_blame_data_cleaned_sorted.csv")
+    args = parser.parse_args()
+    clean_and_sort_csv(args.input, args.output)
@@ -0,0 +1,260 @@
+"""Compressed column-per-file datasets for the pipeline's tables.
+
+A dataset is a directory:
+
+    blame.cols/
+        _schema.json        {"version": 1, "columns": [...], "parts": [...], ...}
+        part-00000/0.gz     one gzip file of JSON values per column
+        part-00000/1.gz
+        ...
+
+Queries open only the columns they use: a filter reads its predicate
+columns first to pick the matching rows, then reads just the projected
+columns for those rows. Every write adds a part that becomes visible
+when _schema.json is atomically replaced, so an interrupted writer never
+leaves a half-written table behind and resumed runs simply append parts.
+"""
+import argparse
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+SCHEMA_FILE = "_schema.json"
+FORMAT_VERSION = 1
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON to path without ever leaving a partial file behind."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _column_path(part_path, index):
+    return os.path.join(part_path, f"{index}.gz")
+
+
+class ColumnarWriter:
+    """Stream rows (dicts or sequences) into a new part of a dataset.
+
+    With replace=True the existing parts are dropped when the new one is
+    committed, otherwise the part is appended. write() is thread-safe.
+    """
+
+    def __init__(self, path, columns, replace=False, compresslevel=6):
+        self.path = path
+        self.columns = list(columns)
+        self.replace = replace
+        self.rows = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        schema = load_schema(path)
+        if schema is not None and not replace and schema["columns"] != self.columns:
+            raise ValueError(
+                f"{path} has columns {schema['columns']}, cannot append {self.columns}"
+            )
+        self._part_path = tempfile.mkdtemp(prefix="writing-", suffix=".partial", dir=path)
+        self._files = [
+            gzip.open(_column_path(self._part_path, index), "wt", compresslevel=compresslevel)
+            for index in range(len(self.columns))
+        ]
+
+    def write(self, row):
+        if isinstance(row, dict):
+            values = [row.get(column) for column in self.columns]
+        else:
+            values = list(row)
+        with self._lock:
+            for f, value in zip(self._files, values):
+                f.write(json.dumps(value))
+                f.write("\n")
+            self.rows += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def close(self):
+        """Commit the part and publish it in the schema."""
+        with self._lock:
+            if self._files is None:
+                return
+            for f in self._files:
+                f.close()
+            self._files = None
+            schema = load_schema(self.path)
+            if self.rows == 0 and schema is not None and not self.replace:
+                # Nothing to append.
+                shutil.rmtree(self._part_path, ignore_errors=True)
+                return
+            next_part = schema["next_part"] if schema else 0
+            old_parts = []
+            if schema is None or self.replace:
+                old_parts = schema["parts"] if schema else []
+                schema = {"version": FORMAT_VERSION, "columns": self.columns, "parts": []}
+            part_name = f"part-{next_part:05d}"
+            os.rename(self._part_path, os.path.join(self.path, part_name))
+            schema["parts"].append({"name": part_name, "rows": self.rows})
+            schema["next_part"] = next_part + 1
+            write_json_atomic(os.path.join(self.path, SCHEMA_FILE), schema)
+            for part in old_parts:
+                shutil.rmtree(os.path.join(self.path, part["name"]), ignore_errors=True)
+
+    def abort(self):
+        with self._lock:
+            if self._files is not None:
+                for f in self._files:
+                    f.close()
+                self._files = None
+            shutil.rmtree(self._part_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def load_schema(path):
+    try:
+        with open(os.path.join(path, SCHEMA_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_dataset(path, columns, rows, replace=True):
+    with ColumnarWriter(path, columns, replace=replace) as writer:
+        writer.write_rows(rows)
+    return writer.rows
+
+
+class ColumnarDataset:
+    def __init__(self, path):
+        self.path = path
+        schema = load_schema(path)
+        if schema is None:
+            raise FileNotFoundError(f"No columnar dataset at {path}")
+        self.columns = schema["columns"]
+        self.parts = schema["parts"]
+        self._index = {column: index for index, column in enumerate(self.columns)}
+
+    def __len__(self):
+        return sum(part["rows"] for part in self.parts)
+
+    def read_column(self, column):
+        """Yield every value of one column, reading no other column file."""
+        index = self._index[column]
+        for part in self.parts:
+            with gzip.open(_column_path(os.path.join(self.path, part["name"]), index), "rt") as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def select(self, where):
+        """Return a bytearray mask of the rows matching every predicate.
+
+        where maps column names to predicates taking a single value; only
+        those columns are read.
+        """
+        mask = bytearray(b"\x01") * len(self)
+        for column, predicate in where.items():
+            for row_index, value in enumerate(self.read_column(column)):
+                if mask[row_index] and not predicate(value):
+                    mask[row_index] = 0
+        return mask
+
+    def read(self, columns=None, where=None):
+        """Yield rows as dicts of the requested columns, filtered by where."""
+        columns = list(columns or self.columns)
+        mask = self.select(where) if where else None
+        streams = [self.read_column(column) for column in columns]
+        for row_index, values in enumerate(zip(*streams)):
+            if mask is None or mask[row_index]:
+                yield dict(zip(columns, values))
+
+    def sorted_rows(self, key_column, key=None, columns=None, where=None):
+        """Return the matching rows sorted by one column.
+
+        Only the key column, the predicate columns and the projected
+        columns are read; the projected columns of matching rows are held
+        in memory for the sort.
+        """
+        columns = list(columns or self.columns)
+        read_columns = columns if key_column in columns else columns + [key_column]
+        rows = list(self.read(read_columns, where))
+        rows.sort(key=lambda row: key(row[key_column]) if key else row[key_column])
+        if key_column not in columns:
+            for row in rows:
+                del row[key_column]
+        return rows
+
+    def distinct(self, column, where=None):
+        """Return the set of values of one column among the matching rows."""
+        if not where:
+            return set(self.read_column(column))
+        mask = self.select(where)
+        return {value for value, keep in zip(self.read_column(column), mask) if keep}
+
+    def to_csv(self, csv_path, columns=None, where=None, rows=None):
+        """Export to CSV; rows may be a pre-sorted result of sorted_rows()."""
+        columns = list(columns or self.columns)
+        if rows is None:
+            rows = self.read(columns, where)
+        written = 0
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+        return written
+
+
+def csv_to_dataset(csv_path, path):
+    """Convert a CSV file with a header row into a dataset at path."""
+    with open(csv_path, "r", newline="") as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        return write_dataset(path, columns, reader)
+
+
+def is_dataset(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SCHEMA_FILE))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert between CSV and columnar datasets.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="CSV -> dataset")
+    import_parser.add_argument("csv_path")
+    import_parser.add_argument("dataset")
+    export_parser = subparsers.add_parser("export", help="dataset -> CSV")
+    export_parser.add_argument("dataset")
+    export_parser.add_argument("csv_path")
+    export_parser.add_argument("--columns", help="comma-separated columns to export")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        rows = csv_to_dataset(args.csv_path, args.dataset)
+        print(f"Wrote {rows} rows to {args.dataset}")
+    else:
+        columns = args.columns.split(",") if args.columns else None
+        rows = ColumnarDataset(args.dataset).to_csv(args.csv_path, columns)
+        print(f"Wrote {rows} rows to {args.csv_path}")
@@ -1,55 +1,161 @@
+import argparse
 import os
 import csv
-from collections import OrderedDict
+import heapq
+import shutil
+import sys
+import tempfile
 
+DEFAULT_MEMORY_LIMIT = 256 * 1024**2
+MAX_OPEN_RUNS = 64
 
-def combine_and_deduplicate_csv(input_directory, output_file):
-    all_lines = OrderedDict()
+# Let whole blame rows through; glibc's malicious_commit_hashes alone can
+# exceed the csv module's default 128 KiB field limit.
+csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+
+
+def row_key(row):
+    """Sort by the numeric id in the first column, then by the whole row.
+
+    Identical rows therefore always end up next to each other, which is all
+    the deduplication needs.
+    """
+    return int(row[0]), row
+
+
+def estimate_row_size(row):
+    # Rough in-memory cost of a parsed row: the strings plus list overhead.
+    return sys.getsizeof(row) + sum(sys.getsizeof(field) for field in row)
+
+
+def write_run(rows, run_dir):
+    """Sort and deduplicate rows and write them to a new run file."""
+    rows.sort(key=row_key)
+    fd, run_path = tempfile.mkstemp(dir=run_dir, suffix=".csv")
+    previous = None
+    with os.fdopen(fd, "w", newline="") as run_file:
+        writer = csv.writer(run_file)
+        for row in rows:
+            if row != previous:
+                writer.writerow(row)
+                previous = row
+    return run_path
+
+
+def read_run(run_path):
+    with open(run_path, "r", newline="") as run_file:
+        yield from csv.reader(run_file)
+
+
+def merge_sorted_runs(run_paths):
+    """Yield the rows of several sorted runs in order, without duplicates."""
+    previous = None
+    for row in heapq.merge(*(read_run(path) for path in run_paths), key=row_key):
+        if row != previous:
+            yield row
+            previous = row
+
+
+def reduce_runs(run_paths, run_dir, max_open_runs=MAX_OPEN_RUNS):
+    """Merge runs in groups until few enough are left to open at once."""
+    while len(run_paths) > max_open_runs:
+        merged_paths = []
+        for start in range(0, len(run_paths), max_open_runs):
+            group = run_paths[start : start + max_open_runs]
+            fd, merged_path = tempfile.mkstemp(dir=run_dir, suffix=".csv")
+            with os.fdopen(fd, "w", newline="") as merged_file:
+                csv.writer(merged_file).writerows(merge_sorted_runs(group))
+            for path in group:
+                os.remove(path)
+            merged_paths.append(merged_path)
+        run_paths = merged_paths
+    return run_paths
+
+
+def combine_and_deduplicate_csv(
+    input_directory,
+    output_file,
+    memory_limit=DEFAULT_MEMORY_LIMIT,
+    max_open_runs=MAX_OPEN_RUNS,
+):
+    """Combine every CSV in input_directory into one file sorted by id.
+
+    Exact duplicate rows are dropped. Rows are parsed with the csv module,
+    so quoted fields with commas survive intact. At most about memory_limit
+    bytes of rows are held at once: each full buffer is sorted and spilled
+    to a run file on disk, and the runs are combined with a k-way merge.
+    """
     total_lines = 0
     header = None
+    run_dir = tempfile.mkdtemp(
+        prefix="combine-", dir=os.path.dirname(os.path.abspath(output_file))
+    )
+    try:
+        run_paths = []
+        buffer = []
+        buffer_size = 0
 
-    # Read all CSV files in the input directory
-    for filename in os.listdir(input_directory):
-        if filename.endswith(".csv"):
+        # Read all CSV files in the input directory
+        for filename in sorted(os.listdir(input_directory)):
+            if not filename.endswith(".csv"):
+                continue
             file_path = os.path.join(input_directory, filename)
             with open(file_path, "r", newline="") as csvfile:
                 reader = csv.reader(csvfile)
+                file_header = next(reader, None)
                 if header is None:
-                    header = next(reader)  # Assume all files have the same header
-                else:
-                    next(reader)  # Skip header for subsequent files
+                    header = file_header  # Assume all files have the same header
                 for row in reader:
-                    line = ",".join(row)
-                    if line not in all_lines:
-                        all_lines[line] = 1
-                    else:
-                        all_lines[line] += 1
+                    if not row:
+                        continue
+                    buffer.append(row)
+                    buffer_size += estimate_row_size(row)
                     total_lines += 1
+                    if buffer_size >= memory_limit:
+                        run_paths.append(write_run(buffer, run_dir))
+                        buffer = []
+                        buffer_size = 0
+        if buffer:
+            run_paths.append(write_run(buffer, run_dir))
+            buffer = []
 
-    # Sort lines by the numeric 'id' in the first column
-    sorted_lines = sorted(all_lines.keys(), key=lambda x: int(x.split(",")[0]))
+        run_paths = reduce_runs(run_paths, run_dir, max_open_runs)
 
-    # Write sorted unique lines to output file
-    with open(output_file, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(header)
-        for line in sorted_lines:
-            writer.writerow(line.split(","))
+        # Write sorted unique lines to output file
+        unique_lines = 0
+        with open(output_file, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            if header is not None:
+                writer.writerow(header)
+            for row in merge_sorted_runs(run_paths):
+                writer.writerow(row)
+                unique_lines += 1
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
 
-    unique_lines = len(all_lines)
     duplicates = total_lines - unique_lines
 
     return total_lines, unique_lines, duplicates
 
 
-# Usage
-input_directory = "files"
-output_file = "combined_output.csv"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Combine CSV shards into one file sorted by id, without duplicates."
+    )
+    parser.add_argument("--input-directory", default="files")
+    parser.add_argument("--output", default="combined_output.csv")
+    parser.add_argument(
+        "--memory-mb",
+        type=int,
+        default=DEFAULT_MEMORY_LIMIT // 1024**2,
+        help="approximate memory for rows before sorted runs are spilled to disk",
+    )
+    args = parser.parse_args()
 
-total_lines, unique_lines, duplicates = combine_and_deduplicate_csv(
-    input_directory, output_file
-)
+    total_lines, unique_lines, duplicates = combine_and_deduplicate_csv(
+        args.input_directory, args.output, args.memory_mb * 1024**2
+    )
 
-print(f"Total lines processed: {total_lines}")
-print(f"Unique lines after deduplication: {unique_lines}")
-print(f"Number of duplicates removed: {duplicates}")
+    print(f"Total lines processed: {total_lines}")
+    print(f"Unique lines after deduplication: {unique_lines}")
+    print(f"Number of duplicates removed: {duplicates}")
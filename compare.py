@@ -1,51 +1,205 @@
-<<<<<<< HEAD
+"""Reconcile the outputs of the pipeline stages.
+
+Streams each stage output once (CSV files, columnar datasets or metadata
+records) and reports how many input ids survive every stage, which ids
+were dropped between consecutive stages and why, and which ids occur
+more than once. Ids are kept in bitmaps, so memory grows with the largest
+id rather than with the size of the files:
+
+    python compare.py
+    python compare.py commits.csv commits_with_blame_data.csv --list-dropped
+"""
+import argparse
 import csv
+import json
+import os
+import re
+import sqlite3
+import sys
+from collections import Counter
 
-def read_ids_from_csv(file_path):
-    ids = set()
-    with open(file_path, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
+import columnar_store
+
+csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+
+DEFAULT_STAGES = [
+    ("commits", "commits.csv"),
+    ("repo_url", "commits_with_repo_url.csv"),
+    ("parent_ids", "commits_with_parent_ids.csv"),
+    ("blame_data", "commits_with_blame_data.csv"),
+    ("cleaned", "commits_with_blame_data_cleaned_sorted.csv"),
+]
+# The metadata stage is read from the first of these that exists.
+METADATA_OUTPUTS = ["commit_metadata.jsonl", "commit_metadata.json", "commit_metadata"]
+DEFAULT_LOGS = [
+    "repo_processing.log",
+    "blame_processing.log",
+    "commit_metadata.log",
+    "pipeline.log",
+]
+DEFAULT_STATE = "pipeline_state.sqlite"
+
+HASH_RE = re.compile(r"\^?\b[0-9a-f]{7,40}\b")
+URL_RE = re.compile(r"https?://\S+?(?=[\s:,')]|$)|file://\S+")
+LOG_LINE_RE = re.compile(r"^\S+ \S+ - (ERROR|WARNING) - (?:\S+ - )?(.*)$")
+PATH_RE = re.compile(r"(?:[A-Za-z]:\\|/)\S+")
+NUMBER_RE = re.compile(r"-?\d+")
+NO_REASON = "(no log entry)"
+
+
+class IdBitmap:
+    """Set of non-negative integer ids stored one bit per id.
+
+    add() remembers ids seen more than once in a second bitmap.
+    """
+
+    def __init__(self):
+        self._bits = bytearray()
+        self._dup_bits = bytearray()
+        self.count = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def _set(bits, id_):
+        byte, bit = divmod(id_, 8)
+        if byte >= len(bits):
+            bits.extend(bytes(max(byte + 1 - len(bits), len(bits))))
+        present = bits[byte] >> bit & 1
+        bits[byte] |= 1 << bit
+        return present
+
+    def add(self, id_):
+        if self._set(self._bits, id_):
+            self.duplicates += 1
+            self._set(self._dup_bits, id_)
+        else:
+            self.count += 1
+
+    def __contains__(self, id_):
+        byte, bit = divmod(id_, 8)
+        return byte < len(self._bits) and self._bits[byte] >> bit & 1 == 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self._iter_bits(self._bits)
+
+    def duplicated_ids(self):
+        return self._iter_bits(self._dup_bits)
+
+    @staticmethod
+    def _iter_bits(bits):
+        for byte_index, byte in enumerate(bits):
+            if byte:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield byte_index * 8 + bit
+
+    def difference(self, other):
+        """Yield the ids in this bitmap that are not in other."""
+        for id_ in self:
+            if id_ not in other:
+                yield id_
+
+
+def iter_rows(path, columns):
+    """Yield {column: value} for the given columns of a CSV or dataset."""
+    if columnar_store.is_dataset(path):
+        dataset = columnar_store.ColumnarDataset(path)
+        yield from dataset.read([c for c in columns if c in dataset.columns])
+        return
+    with open(path, "r", newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        positions = [(c, header.index(c)) for c in columns if c in header]
         for row in reader:
-            ids.add(row['id'])
-    return ids
+            if row:
+                yield {c: row[i] for c, i in positions if i < len(row)}
 
-def find_skipped_ids(file1_path, file2_path):
-    ids_file1 = read_ids_from_csv(file1_path)
-    ids_file2 = read_ids_from_csv(file2_path)
 
-    skipped_ids = ids_file1 - ids_file2
-    return skipped_ids
+def parse_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
-def output_skipped_ids(file1_path, file2_path):
-    skipped_ids = find_skipped_ids(file1_path, file2_path)
 
-    if not skipped_ids:
-        print("No IDs from file 1 were skipped in file 2. All IDs are present.")
+def read_metadata_keys(path):
+    """Return the (cve_id, project_name) pairs that have extracted commits."""
+    keys = set()
+    if os.path.isdir(path):
+        # One <cve_id>.json per CVE, as in commit_metadata/.
+        for filename in os.listdir(path):
+            if filename.endswith(".json"):
+                with open(os.path.join(path, filename)) as f:
+                    projects = json.load(f)
+                cve_id = filename[: -len(".json")]
+                keys.update((cve_id, p) for p, commits in projects.items() if commits)
+    elif path.endswith(".jsonl"):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("original_hash"):
+                    keys.add((record["cve_id"], record["project_name"]))
     else:
-        print(f"IDs from file 1 that were skipped in file 2:")
-        for id in sorted(skipped_ids):
-            print(id)
-        print(f"\nTotal IDs skipped: {len(skipped_ids)}")
+        with open(path) as f:
+            data = json.load(f)
+        for cve_id, projects in data.items():
+            keys.update((cve_id, p) for p, commits in projects.items() if commits)
+    return keys
+
+
+def read_id_bitmap(path, key_source=None):
+    """Stream the ids of one stage output into an IdBitmap.
+
+    Metadata outputs have no id column; their ids are those of the rows of
+    key_source (the previous CSV stage) whose CVE/project has metadata.
+    """
+    ids = IdBitmap()
+    invalid = 0
+    if is_metadata_output(path):
+        keys = read_metadata_keys(path)
+        rows = (
+            row
+            for row in iter_rows(key_source, ["id", "cve_id", "project_name"])
+            if (row.get("cve_id"), row.get("project_name")) in keys
+        )
+    else:
+        rows = iter_rows(path, ["id"])
+    for row in rows:
+        id_ = parse_id(row.get("id"))
+        if id_ is None or id_ < 0:
+            invalid += 1
+            continue
+        ids.add(id_)
+    return ids, invalid
+
+
+def is_metadata_output(path):
+    return path.endswith((".json", ".jsonl")) or (
+        os.path.isdir(path) and not columnar_store.is_dataset(path)
+    )
 
-file1_path = 'C:/Users/X/Desktop/Malicious-Commits/commits_with_repo_url.csv'
-file2_path = 'C:/Users/X/Desktop/Malicious-Commits/commits_with_parent_ids.csv'
-=======
-import csv
 
 def read_ids_from_csv(file_path):
-    ids = set()
-    with open(file_path, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            ids.add(row['id'])
+    ids = IdBitmap()
+    for row in iter_rows(file_path, ["id"]):
+        id_ = parse_id(row.get("id"))
+        if id_ is not None and id_ >= 0:
+            ids.add(id_)
     return ids
 
+
 def find_skipped_ids(file1_path, file2_path):
     ids_file1 = read_ids_from_csv(file1_path)
     ids_file2 = read_ids_from_csv(file2_path)
 
-    skipped_ids = ids_file1 - ids_file2
-    return skipped_ids
+    return set(ids_file1.difference(ids_file2))
+
 
 def output_skipped_ids(file1_path, file2_path):
     skipped_ids = find_skipped_ids(file1_path, file2_path)
@@ -58,7 +212,212 @@ def output_skipped_ids(file1_path, file2_path):
             print(id)
         print(f"\nTotal IDs skipped: {len(skipped_ids)}")
 
-file1_path = 'C:/Users/X/Desktop/Malicious-Commits/commits_with_repo_url.csv'
-file2_path = 'C:/Users/X/Desktop/Malicious-Commits/commits_with_parent_ids.csv'
->>>>>>> 6395c3ff566e29267ef9b782079b2e98b17fc9c4
-output_skipped_ids(file1_path, file2_path)
\ No newline at end of file
+
+def normalize_reason(message):
+    """Turn a log message into a reason template shared by similar failures."""
+    message = re.sub(r"\s*\(attempt \d+\)", "", message)
+    message = URL_RE.sub("<url>", message)
+    message = HASH_RE.sub("<hash>", message)
+    message = PATH_RE.sub("<path>", message)
+    message = NUMBER_RE.sub("<n>", message)
+    return message.strip()[:120]
+
+
+def dropped_commits(path, dropped_ids):
+    """Map commit_id -> id and repo_url -> ids for the dropped ids."""
+    by_commit = {}
+    by_repo = {}
+    for row in iter_rows(path, ["id", "commit_id", "commit_url", "repo_url"]):
+        id_ = parse_id(row.get("id"))
+        if id_ is None or id_ not in dropped_ids:
+            continue
+        if row.get("commit_id"):
+            by_commit.setdefault(row["commit_id"], set()).add(id_)
+        repo_url = row.get("repo_url")
+        if not repo_url and row.get("commit_url"):
+            repo_url = "/".join(row["commit_url"].split("/")[:5])
+        if repo_url:
+            by_repo.setdefault(repo_url.replace("//", "/").rstrip("/"), set()).add(id_)
+    return by_commit, by_repo
+
+
+def reasons_from_state(state_path, by_commit):
+    """Return {id: "stage: error_class"} from the pipeline state, if any."""
+    reasons = {}
+    if not state_path or not os.path.exists(state_path):
+        return reasons
+    conn = sqlite3.connect(state_path)
+    try:
+        # items is keyed by (stage, item_id), so per-commit lookups would each
+        # scan the table; read every failure once and join here instead.
+        latest = {}
+        rows = conn.execute(
+            "SELECT item_id, stage, error_class, finished_at FROM items WHERE status = 'failed'"
+        )
+        for item_id, stage, error_class, finished_at in rows:
+            if item_id not in by_commit:
+                continue
+            previous = latest.get(item_id)
+            if previous is None or (finished_at or 0) >= (previous[0] or 0):
+                latest[item_id] = (finished_at, f"{stage}: {error_class}")
+        for commit_id, (_, reason) in latest.items():
+            for id_ in by_commit[commit_id]:
+                reasons[id_] = reason
+    except sqlite3.DatabaseError:
+        pass
+    finally:
+        conn.close()
+    return reasons
+
+
+def reasons_from_logs(log_paths, by_commit, by_repo):
+    """Return {id: reason} from ERROR/WARNING lines naming a dropped commit.
+
+    A line that names the commit wins over one that only names its
+    repository; among equals the latest line wins.
+    """
+    by_prefix = {}
+    for commit_id in by_commit:
+        by_prefix.setdefault(commit_id[:7], []).append(commit_id)
+    commit_reasons = {}
+    repo_reasons = {}
+    for log_path in log_paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, "r", errors="replace") as f:
+            for line in f:
+                match = LOG_LINE_RE.match(line)
+                if not match:
+                    continue
+                message = match.group(2)
+                reason = None
+                for token in HASH_RE.findall(message):
+                    token = token.lstrip("^")
+                    for commit_id in by_prefix.get(token[:7], ()):
+                        if commit_id.startswith(token):
+                            reason = reason or f"{match.group(1)} - {normalize_reason(message)}"
+                            for id_ in by_commit[commit_id]:
+                                commit_reasons[id_] = reason
+                for url in URL_RE.findall(message):
+                    ids = by_repo.get(url.replace("//", "/").rstrip("/"))
+                    if ids:
+                        reason = reason or f"{match.group(1)} - {normalize_reason(message)}"
+                        for id_ in ids:
+                            repo_reasons[id_] = reason
+    repo_reasons.update(commit_reasons)
+    return repo_reasons
+
+
+def reconcile(stages, log_paths=(), state_path=None):
+    """Build the coverage report for stages given as (name, path) pairs."""
+    report = {"stages": [], "transitions": []}
+    previous = None
+    previous_csv = None
+    for name, path in stages:
+        ids, invalid = read_id_bitmap(path, key_source=previous_csv)
+        report["stages"].append(
+            {
+                "name": name,
+                "path": path,
+                "ids": len(ids),
+                "duplicates": ids.duplicates,
+                "duplicated_ids": list(ids.duplicated_ids())[:20],
+                "invalid_ids": invalid,
+            }
+        )
+        if previous is not None:
+            prev_name, prev_path, prev_ids = previous
+            dropped = IdBitmap()
+            for id_ in prev_ids.difference(ids):
+                dropped.add(id_)
+            added = sum(1 for _ in ids.difference(prev_ids))
+            reasons = Counter()
+            if len(dropped):
+                by_commit, by_repo = dropped_commits(prev_path, dropped)
+                id_reasons = reasons_from_logs(log_paths, by_commit, by_repo)
+                id_reasons.update(reasons_from_state(state_path, by_commit))
+                for id_ in dropped:
+                    reasons[id_reasons.get(id_, NO_REASON)] += 1
+            report["transitions"].append(
+                {
+                    "from": prev_name,
+                    "to": name,
+                    "dropped": len(dropped),
+                    "dropped_ids": list(dropped),
+                    "unexpected": added,
+                    "reasons": reasons.most_common(),
+                }
+            )
+        previous = (name, path, ids)
+        if not is_metadata_output(path):
+            previous_csv = path
+    if report["stages"]:
+        total = report["stages"][0]["ids"] or 1
+        for stage in report["stages"]:
+            stage["coverage"] = stage["ids"] / total
+    return report
+
+
+def print_report(report, list_dropped=False, top_reasons=10):
+    print("Stage coverage:")
+    for stage in report["stages"]:
+        print(
+            f"  {stage['name']:<12} {stage['ids']:>8} ids  {stage['coverage']:>7.1%}"
+            f"  duplicates: {stage['duplicates']}"
+            + (f"  invalid ids: {stage['invalid_ids']}" if stage["invalid_ids"] else "")
+        )
+        if stage["duplicates"]:
+            print(f"      e.g. ids {', '.join(map(str, stage['duplicated_ids'][:10]))}")
+    for transition in report["transitions"]:
+        print(
+            f"\n{transition['from']} -> {transition['to']}: "
+            f"{transition['dropped']} dropped"
+            + (
+                f", {transition['unexpected']} not in {transition['from']}"
+                if transition["unexpected"]
+                else ""
+            )
+        )
+        for reason, count in transition["reasons"][:top_reasons]:
+            print(f"  {count:>8}  {reason}")
+        if len(transition["reasons"]) > top_reasons:
+            rest = sum(count for _, count in transition["reasons"][top_reasons:])
+            print(f"  {rest:>8}  ({len(transition['reasons']) - top_reasons} other reasons)")
+        if list_dropped and transition["dropped_ids"]:
+            print("  ids: " + " ".join(map(str, transition["dropped_ids"])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report per-stage coverage, dropped ids with reasons, and duplicates."
+    )
+    parser.add_argument(
+        "outputs",
+        nargs="*",
+        help="stage outputs in pipeline order (CSV, dataset dir or metadata "
+        "json/jsonl); defaults to the standard file names that exist",
+    )
+    parser.add_argument("--log", action="append", dest="logs", help="log file to mine")
+    parser.add_argument("--state-db", default=DEFAULT_STATE)
+    parser.add_argument("--list-dropped", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.outputs:
+        stages = [
+            (os.path.splitext(os.path.basename(path.rstrip("/")))[0], path)
+            for path in args.outputs
+        ]
+    else:
+        stages = [(name, path) for name, path in DEFAULT_STAGES if os.path.exists(path)]
+        for path in METADATA_OUTPUTS:
+            if os.path.exists(path):
+                stages.append(("metadata", path))
+                break
+    logs = args.logs if args.logs is not None else DEFAULT_LOGS
+
+    report = reconcile(stages, logs, args.state_db)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, list_dropped=args.list_dropped)
@@ -0,0 +1,243 @@
+"""Streaming parser for unified diffs.
+
+parse_unified_diff() reads a diff line by line from any iterable (an open
+file, a subprocess pipe, a list of lines) and yields one FileDiff per file
+as soon as that file is complete, so only the file currently being parsed
+is ever held in memory. It understands plain `git diff` output as well as
+the mail-formatted `.patch` files GitHub serves.
+"""
+import re
+
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@ ?(.*)$")
+
+ADDED = "+"
+REMOVED = "-"
+CONTEXT = " "
+
+_ESCAPES = {"a": "\a", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+
+class Hunk:
+    """One @@ hunk: its line ranges and (kind, old_lineno, new_lineno, text) lines.
+
+    kind is ADDED, REMOVED or CONTEXT; the line number of the side a line
+    does not exist on is None.
+    """
+
+    __slots__ = ("old_start", "old_count", "new_start", "new_count", "section", "lines")
+
+    def __init__(self, old_start, old_count, new_start, new_count, section=""):
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.section = section
+        self.lines = []
+
+    @property
+    def removed_lines(self):
+        return [text for kind, _, _, text in self.lines if kind == REMOVED]
+
+    @property
+    def added_lines(self):
+        return [text for kind, _, _, text in self.lines if kind == ADDED]
+
+    @property
+    def context_lines(self):
+        return [text for kind, _, _, text in self.lines if kind == CONTEXT]
+
+    def __repr__(self):
+        return (
+            f"Hunk(-{self.old_start},{self.old_count} "
+            f"+{self.new_start},{self.new_count}, {len(self.lines)} lines)"
+        )
+
+
+class FileDiff:
+    """The changes to one file. old_path/new_path are None for /dev/null."""
+
+    __slots__ = ("old_path", "new_path", "is_rename", "is_binary", "hunks")
+
+    def __init__(self, old_path=None, new_path=None):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.is_rename = False
+        self.is_binary = False
+        self.hunks = []
+
+    @property
+    def path(self):
+        """The path the file has before the change, or after it if it is new."""
+        return self.old_path if self.old_path is not None else self.new_path
+
+    @property
+    def is_new(self):
+        return self.old_path is None and self.new_path is not None
+
+    @property
+    def is_deleted(self):
+        return self.new_path is None and self.old_path is not None
+
+    @property
+    def removed_lines(self):
+        return [line for hunk in self.hunks for line in hunk.removed_lines]
+
+    @property
+    def added_lines(self):
+        return [line for hunk in self.hunks for line in hunk.added_lines]
+
+    def __repr__(self):
+        return (
+            f"FileDiff({self.old_path!r} -> {self.new_path!r}, "
+            f"{len(self.hunks)} hunks, rename={self.is_rename}, binary={self.is_binary})"
+        )
+
+
+def unquote_path(path):
+    """Undo git's C-style quoting of paths with special characters."""
+    if len(path) < 2 or not (path.startswith('"') and path.endswith('"')):
+        return path
+    raw = bytearray()
+    body = path[1:-1]
+    i = 0
+    while i < len(body):
+        char = body[i]
+        if char != "\\" or i + 1 == len(body):
+            raw += char.encode("utf-8")
+            i += 1
+            continue
+        escaped = body[i + 1]
+        if escaped in "01234567":
+            octal = body[i + 1 : i + 4]
+            raw.append(int(octal, 8))
+            i += 1 + len(octal)
+        else:
+            raw += _ESCAPES.get(escaped, escaped).encode("utf-8")
+            i += 2
+    return raw.decode("utf-8", errors="replace")
+
+
+def _strip_prefix(path):
+    """Map a ---/+++ path to a repository path (None for /dev/null)."""
+    if "\t" in path:
+        # Plain diff(1) output appends a tab and a timestamp.
+        path = path.split("\t", 1)[0]
+    path = unquote_path(path)
+    if path == "/dev/null":
+        return None
+    if path.startswith(("a/", "b/")):
+        return path[2:]
+    return path
+
+
+def _paths_from_git_header(rest):
+    """Best-effort split of the "a/old b/new" part of a diff --git line."""
+    if rest.startswith('"'):
+        end = rest.index('"', 1)
+        while rest[end - 1] == "\\":
+            end = rest.index('"', end + 1)
+        return _strip_prefix(rest[: end + 1]), _strip_prefix(rest[end + 2 :])
+    # Without renames both halves are the same path, which may contain spaces.
+    half = (len(rest) - 1) // 2
+    if rest[half] == " " and rest[:half][2:] == rest[half + 1 :][2:]:
+        return _strip_prefix(rest[:half]), _strip_prefix(rest[half + 1 :])
+    old, _, new = rest.partition(" b/")
+    return _strip_prefix(old), _strip_prefix("b/" + new)
+
+
+def parse_unified_diff(lines):
+    """Yield a FileDiff for every file in a unified diff, one file at a time."""
+    current = None
+    hunk = None
+    old_remaining = new_remaining = 0
+    old_lineno = new_lineno = 0
+    pending_old_path = None
+    saw_old_path = False
+
+    for line in lines:
+        line = line.rstrip("\n")
+
+        if hunk is not None and (old_remaining > 0 or new_remaining > 0):
+            if line.startswith("\\"):
+                # "\ No newline at end of file"
+                continue
+            kind = line[:1] or CONTEXT
+            text = line[1:]
+            if kind == REMOVED and old_remaining > 0:
+                hunk.lines.append((REMOVED, old_lineno, None, text))
+                old_lineno += 1
+                old_remaining -= 1
+                continue
+            if kind == ADDED and new_remaining > 0:
+                hunk.lines.append((ADDED, None, new_lineno, text))
+                new_lineno += 1
+                new_remaining -= 1
+                continue
+            if kind == CONTEXT and old_remaining > 0 and new_remaining > 0:
+                hunk.lines.append((CONTEXT, old_lineno, new_lineno, text))
+                old_lineno += 1
+                new_lineno += 1
+                old_remaining -= 1
+                new_remaining -= 1
+                continue
+            # Truncated hunk: fall through and treat the line as a header.
+            hunk = None
+
+        if line.startswith("diff --git "):
+            if current is not None:
+                yield current
+            old_path, new_path = _paths_from_git_header(line[len("diff --git ") :])
+            current = FileDiff(old_path, new_path)
+            hunk = None
+            saw_old_path = False
+            continue
+
+        if line.startswith("@@ ") and current is not None:
+            match = HUNK_HEADER_RE.match(line)
+            if match:
+                old_start = int(match.group(1))
+                old_count = int(match.group(2)) if match.group(2) is not None else 1
+                new_start = int(match.group(3))
+                new_count = int(match.group(4)) if match.group(4) is not None else 1
+                hunk = Hunk(old_start, old_count, new_start, new_count, match.group(5))
+                current.hunks.append(hunk)
+                old_remaining, new_remaining = old_count, new_count
+                old_lineno, new_lineno = old_start, new_start
+            continue
+
+        if line.startswith("--- "):
+            pending_old_path = _strip_prefix(line[4:])
+            saw_old_path = True
+            continue
+
+        if line.startswith("+++ ") and saw_old_path:
+            new_path = _strip_prefix(line[4:])
+            if current is None or current.hunks:
+                # A plain unified diff without "diff --git" headers.
+                if current is not None:
+                    yield current
+                current = FileDiff(pending_old_path, new_path)
+            else:
+                current.old_path = pending_old_path
+                current.new_path = new_path
+            saw_old_path = False
+            continue
+
+        if current is None:
+            continue
+
+        if line.startswith("rename from "):
+            current.old_path = unquote_path(line[len("rename from ") :])
+            current.is_rename = True
+        elif line.startswith("rename to "):
+            current.new_path = unquote_path(line[len("rename to ") :])
+            current.is_rename = True
+        elif line.startswith("new file mode"):
+            current.old_path = None
+        elif line.startswith("deleted file mode"):
+            current.new_path = None
+        elif line.startswith("Binary files ") or line == "GIT binary patch":
+            current.is_binary = True
+
+    if current is not None:
+        yield current
@@ -0,0 +1,368 @@
+"""Per-commit features for the commits in commit_metadata/.
+
+Replaces the update_csv loop of the jsonreader notebook. Files are
+processed by a pool of worker processes and the feature table is written
+once at the end, as CSV (list columns in Python repr, as pandas wrote
+them) or as a columnar dataset when the output ends in .cols:
+
+    python feature_extraction.py --input-dir commit_metadata --output character_counts.csv
+
+A manifest next to the output records the content hash of every input
+file and a fingerprint of the feature definitions. Later runs recompute
+only the files that were added or changed, drop the rows of removed
+files and merge the rest into the existing table; changing the keyword
+lists, the tokenizer or FEATURE_VERSION forces a full rebuild.
+
+Two input shapes are understood: the notebook's one-commit files
+({"commit_metadata": {...}, "file_changes": {...}}) and the per-CVE files
+written by metadata_extractor ({project_name: [metadata, ...]}). The
+latter carry no diff lines, so their token and memory-function columns
+are left empty.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from tqdm import tqdm
+
+import columnar_store
+from line_matcher import KeywordMatcher
+
+try:
+    from nltk.stem.porter import PorterStemmer
+    from nltk.tokenize import word_tokenize
+except ImportError:
+    PorterStemmer = None
+    word_tokenize = None
+
+# security related keywords (stems, matched against the stemmed message)
+SECURITY_WORDS = [
+    "buffer", "corrupt", "boundary", "valid", "invalid", "bypass", "neutral", "restrict",
+    "pathname", "verifi", "verif", "query", "request", "author", "authent", "command",
+    "permission", "password", "key", "deseri", "encrypt", "decrypt", "credenti", "passkey",
+    "depend",
+]
+MEMORY_FXNS = [
+    "malloc", "calloc", "memcpy", "free", "realloc", "alloc", "memchr", "memcmp", "memmove",
+    "memset",
+]
+
+KEY_COLUMNS = ["CVE", "Project", "Commit hash"]
+FEATURE_COLUMNS = [
+    "Length of author name",
+    "Length of author email",
+    "Length of commit message",
+    "Security related keywords in message",
+    "Memory related functions in code changes",
+    "Tokens added in commit",
+    "Tokens removed in commit",
+]
+COLUMNS = KEY_COLUMNS + FEATURE_COLUMNS
+LIST_COLUMNS = {"Security related keywords in message", "Memory related functions in code changes"}
+
+# Used when nltk or its punkt models are not installed: words and single
+# punctuation characters, close to what word_tokenize returns for code lines.
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+STEMMER = "nltk.PorterStemmer" if PorterStemmer is not None else "lower"
+
+# Bump whenever a feature is computed differently.
+FEATURE_VERSION = 3
+
+_security_matcher = None
+_memory_matcher = None
+_stemmer = None
+_tokenizer = None
+
+
+def get_matchers():
+    # Both lists are shorter than line_matcher.AUTOMATON_THRESHOLD, so these
+    # use the plain `in` loop, which is faster than an automaton or an
+    # alternation regex at this size.
+    global _security_matcher, _memory_matcher
+    if _security_matcher is None:
+        _security_matcher = KeywordMatcher(SECURITY_WORDS)
+        _memory_matcher = KeywordMatcher(MEMORY_FXNS)
+    return _security_matcher, _memory_matcher
+
+
+@lru_cache(maxsize=None)
+def stem(word):
+    """Stem one word; commit messages repeat words, so each is stemmed once per worker."""
+    global _stemmer
+    if PorterStemmer is None:
+        return word.lower()
+    if _stemmer is None:
+        _stemmer = PorterStemmer()
+    return _stemmer.stem(word)
+
+
+def tokenizer_name():
+    """Return the tokenizer count_tokens uses: "nltk.word_tokenize" or "regex".
+
+    nltk is only used when its punkt models are downloaded as well.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = "regex"
+        if word_tokenize is not None:
+            try:
+                word_tokenize("probe")
+                _tokenizer = "nltk.word_tokenize"
+            except LookupError:
+                pass
+    return _tokenizer
+
+
+def count_tokens(lines):
+    if not lines:
+        return 0
+    if tokenizer_name() == "nltk.word_tokenize":
+        # Per line, as in the notebook: word_tokenize splits sentences and
+        # trailing periods across the whole string, so joined lines count
+        # differently.
+        return sum(len(word_tokenize(line)) for line in lines)
+    # Regex tokens never span lines, so the whole batch is matched at once.
+    return len(TOKEN_RE.findall("\n".join(lines)))
+
+
+def diff_features(file_changes):
+    """Return (memory functions, tokens added, tokens removed) for a diff."""
+    _, memory_matcher = get_matchers()
+    lines = [
+        line
+        for changes in file_changes.values()
+        for key, file_lines in changes.items()
+        if key != "used_context_lines"
+        for line in file_lines
+    ]
+    mem_words_present = []
+    # One scan of the whole diff rules out the common case of no matches.
+    if memory_matcher.contains_any("\n".join(lines)):
+        for line in lines:
+            mem_words_present.extend(memory_matcher.find(line))
+    added = [line for line in lines if line.startswith("+")]
+    removed = [line for line in lines if line.startswith("-")]
+    return mem_words_present, count_tokens(added), count_tokens(removed)
+
+
+def commit_features(metadata, file_changes=None):
+    security_matcher, _ = get_matchers()
+    message = metadata.get("message") or ""
+    message_stemmed = " ".join(stem(word) for word in message.split())
+    if file_changes is None:
+        mem_words_present, tokens_added, tokens_removed = None, None, None
+    else:
+        mem_words_present, tokens_added, tokens_removed = diff_features(file_changes)
+    return [
+        len(metadata.get("author") or ""),
+        len(metadata.get("author_email") or ""),
+        len(message),
+        security_matcher.find(message_stemmed),
+        mem_words_present,
+        tokens_added,
+        tokens_removed,
+    ]
+
+
+def extract_file(json_file):
+    """Return the feature rows (KEY_COLUMNS + FEATURE_COLUMNS) of one JSON file."""
+    cve_id = os.path.splitext(os.path.basename(json_file))[0]
+    with open(json_file, "r") as f:
+        data = json.load(f)
+    if "commit_metadata" in data:
+        metadata = data["commit_metadata"]
+        return [
+            [cve_id, metadata.get("project_name", ""), metadata.get("hash", "")]
+            + commit_features(metadata, data.get("file_changes", {}))
+        ]
+    rows = []
+    for project_name, commits in data.items():
+        for metadata in commits:
+            rows.append(
+                [cve_id, project_name, metadata.get("original_hash") or metadata.get("hash", "")]
+                + commit_features(metadata, metadata.get("file_changes"))
+            )
+    return rows
+
+
+def json_files(json_folder):
+    return sorted(
+        os.path.join(json_folder, name)
+        for name in os.listdir(json_folder)
+        if name.endswith(".json")
+    )
+
+
+def extract_features(paths, max_workers=None, chunksize=16):
+    """Return {path: rows} for the given JSON files, computed in a process pool.
+
+    Files that cannot be read are logged and left out.
+    """
+    results = {}
+    if not paths:
+        return results
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = executor.map(_extract_file_safe, paths, chunksize=chunksize)
+        for path, rows in tqdm(
+            zip(paths, futures), total=len(paths), desc="Extracting features", unit="file"
+        ):
+            if rows is not None:
+                results[path] = rows
+    return results
+
+
+def _extract_file_safe(json_file):
+    try:
+        return extract_file(json_file)
+    except (OSError, ValueError, AttributeError, TypeError) as e:
+        logging.error(f"Error extracting features from {json_file}: {e}")
+        return None
+
+
+def write_features(rows, output_file):
+    """Write the feature table in one go, sorted by CVE, project and commit."""
+    rows = sorted(rows, key=lambda row: (row[0], row[1] or "", row[2] or ""))
+    if output_file.endswith(".cols"):
+        return columnar_store.write_dataset(output_file, COLUMNS, rows)
+    tmp_file = output_file + ".tmp"
+    list_indexes = [COLUMNS.index(column) for column in LIST_COLUMNS]
+    with open(tmp_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            row = list(row)
+            for index in list_indexes:
+                if row[index] is not None:
+                    row[index] = str(row[index])
+            writer.writerow(row)
+    os.replace(tmp_file, output_file)
+    return len(rows)
+
+
+def definition_fingerprint():
+    """Hash of everything that decides the feature values of a file."""
+    definition = {
+        "version": FEATURE_VERSION,
+        "columns": COLUMNS,
+        "security_words": SECURITY_WORDS,
+        "memory_fxns": MEMORY_FXNS,
+        "tokenizer": tokenizer_name(),
+        "stemmer": STEMMER,
+    }
+    return hashlib.sha256(json.dumps(definition, sort_keys=True).encode()).hexdigest()
+
+
+def manifest_path(output_file):
+    return output_file.rstrip("/") + ".manifest.json"
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def file_digest(path, previous=None):
+    """Return {"sha256", "size", "mtime"} of a file.
+
+    The hash from the previous manifest entry is reused while the size and
+    mtime are unchanged, so unchanged files are not read again.
+    """
+    stat = os.stat(path)
+    if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+        return previous
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"sha256": digest.hexdigest(), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def read_features(output_file):
+    """Return the rows of an existing feature table, or None if there is none."""
+    if columnar_store.is_dataset(output_file):
+        dataset = columnar_store.ColumnarDataset(output_file)
+        if dataset.columns != COLUMNS:
+            return None
+        return [[row[column] for column in COLUMNS] for row in dataset.read(COLUMNS)]
+    if not os.path.exists(output_file):
+        return None
+    with open(output_file, "r", newline="") as f:
+        reader = csv.reader(f)
+        if next(reader, None) != COLUMNS:
+            return None
+        # List columns stay in their written repr; write_features keeps them as-is.
+        return [[value if value != "" else None for value in row] for row in reader]
+
+
+def build_features(json_folder, output_file, max_workers=None, full=False):
+    """Bring the feature table up to date with json_folder.
+
+    Returns (rows written, files recomputed).
+    """
+    manifest_file = manifest_path(output_file)
+    manifest = load_manifest(manifest_file)
+    fingerprint = definition_fingerprint()
+    existing = None
+    if not full and manifest is not None and manifest.get("definition") == fingerprint:
+        existing = read_features(output_file)
+    previous_files = manifest["files"] if existing is not None else {}
+
+    files = {}
+    changed = []
+    for path in json_files(json_folder):
+        name = os.path.basename(path)
+        files[name] = file_digest(path, previous_files.get(name))
+        if previous_files.get(name, {}).get("sha256") != files[name]["sha256"]:
+            changed.append(path)
+    removed = set(previous_files) - set(files)
+    if existing is None:
+        logging.info(f"Rebuilding features for all {len(files)} files")
+    else:
+        logging.info(f"Recomputing features for {len(changed)} changed files, {len(removed)} removed")
+
+    if existing is not None and not changed and not removed:
+        columnar_store.write_json_atomic(manifest_file, {"definition": fingerprint, "files": files})
+        return len(existing), 0
+
+    results = extract_features(changed, max_workers)
+    for path in changed:
+        if path not in results:
+            # Leave failed files out of the manifest so they are retried.
+            del files[os.path.basename(path)]
+
+    stale = {os.path.splitext(name)[0] for name in removed}
+    stale.update(os.path.splitext(os.path.basename(path))[0] for path in changed)
+    rows = [row for row in existing or [] if row[0] not in stale]
+    rows.extend(row for file_rows in results.values() for row in file_rows)
+    written = write_features(rows, output_file)
+    columnar_store.write_json_atomic(manifest_file, {"definition": fingerprint, "files": files})
+    logging.info(f"Wrote features of {written} commits to {output_file}")
+    return written, len(changed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the per-commit feature table.")
+    parser.add_argument("--input-dir", default="commit_metadata")
+    parser.add_argument("--output", default="character_counts.csv")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--full", action="store_true", help="recompute every file, ignoring the manifest"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename="feature_extraction.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    written, recomputed = build_features(args.input_dir, args.output, args.workers, args.full)
+    print(f"Recomputed {recomputed} files; wrote {written} rows to {args.output}")
@@ -1,13 +1,25 @@
+import argparse
 import csv
-import os
+import multiprocessing
+import io
+import queue
 import subprocess
-from git import Repo
-import git
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
 import logging
 import traceback
 import requests
 
+import git_backend
+import network
+import pipeline_state
+import tracing
+from diff_parser import parse_unified_diff
+from line_matcher import MATCH_CONTEXT, RemovedLineMatcher
+from repo_store import RepoStore
+from result_cache import DEFAULT_MAX_BYTES, ResultCache
+
 log_filename = "blame_processing.log"
 logging.basicConfig(
     filename=log_filename,
@@ -15,79 +27,149 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
 )
 
-PATCH_CACHE_DIR = "patch_cache"
+CACHE_DIR = "blame_cache"
+REPO_CACHE_DIR = "repo_cache"
+LOCAL_DIFF_OPTIONS = ["--no-color", "--no-ext-diff"]
 
+_result_cache = None
+_repo_store = None
+_cache_settings = {"root": CACHE_DIR, "max_bytes": DEFAULT_MAX_BYTES}
 
-def ensure_cache_dir():
-    """Ensure the patch cache directory exists."""
-    os.makedirs(PATCH_CACHE_DIR, exist_ok=True)
 
+def configure_cache(root=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Set where patches and blame results are cached and the disk budget."""
+    global _result_cache
+    _cache_settings.update(root=root, max_bytes=max_bytes)
+    _result_cache = None
 
-def get_cached_patch_path(commit_url):
-    """Generate a unique filename for caching the patch."""
-    # Use the last part of the URL as the filename, replacing '/' with '_'
-    filename = commit_url.split("/")[-1].replace("/", "_") + ".patch"
-    return os.path.join(PATCH_CACHE_DIR, filename)
 
+def get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(**_cache_settings)
+    return _result_cache
 
-def get_patch_info(commit_url):
-    try:
-        clean_url = commit_url.split("#")[0]
-        patch_url = clean_url + ".patch"
-        cached_patch_path = get_cached_patch_path(clean_url)
-
-        if os.path.exists(cached_patch_path):
-            logging.info(f"Using cached patch for: {clean_url}")
-            with open(cached_patch_path, "r") as patch_file:
-                patch_content = patch_file.read()
-        else:
-            logging.info(f"Fetching patch from: {patch_url}")
-            wget_command = ["wget", "-q", "-O", cached_patch_path, patch_url]
-            subprocess.run(wget_command, check=True)
 
-            with open(cached_patch_path, "r") as patch_file:
-                patch_content = patch_file.read()
+def configure_repo_store(root=REPO_CACHE_DIR, max_bytes=None, blobless=False):
+    """Set the root, disk budget and clone mode of the shared repository store."""
+    global _repo_store
+    _repo_store = RepoStore(root, max_bytes=max_bytes, blobless=blobless)
 
-        file_changes = {}
-        current_file = None
-        in_changelog = False
 
-        for line_number, line in enumerate(patch_content.split("\n"), 1):
-            try:
-                if line.startswith("---"):
-                    parts = line.split(" ")
-                    if len(parts) > 1:
-                        current_file = parts[1][2:]
-                        logging.debug(f"New file detected: {current_file}")
-                        file_changes[current_file] = []
-                        in_changelog = False
-                    else:
-                        logging.debug(
-                            f"Changelog section started at line {line_number} - ignoring"
-                        )
-                        in_changelog = True
-                elif not in_changelog:
-                    if line.startswith("-") and not line.startswith("---"):
-                        if current_file is not None:
-                            file_changes[current_file].append(line[1:])
-                            # logging.debug(f"Added removed line to {current_file}: {line[1:]}")
-                        else:
-                            logging.warning(
-                                f"Removed line found before file declaration at line {line_number}: {line}"
-                            )
-            except Exception as e:
-                logging.error(f"Error processing line {line_number}: {line}")
-                logging.error(f"Error details: {str(e)}")
-
-        logging.info(
-            f"Patch processing complete. Files changed: {list(file_changes.keys())}"
+def get_repo_store():
+    global _repo_store
+    if _repo_store is None:
+        _repo_store = RepoStore(REPO_CACHE_DIR)
+    return _repo_store
+
+
+def log_cache_stats():
+    stats = get_result_cache().stats()
+    logging.info(
+        f"Cache stats: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['evictions']} evictions, {stats['bytes']} bytes"
+    )
+
+
+def parse_patch(patch_content):
+    """Parse a patch into removed lines and new-side hunk ranges per file.
+
+    Returns (file_changes, file_hunks): file_changes maps each file (by its
+    pre-change path) to its removed lines and file_hunks maps it to the
+    (start, count) line ranges its hunks cover in the commit itself.
+    Added files have no pre-change path and are left out.
+    """
+    file_changes = {}
+    file_hunks = {}
+    with tracing.span("patch.parse") as span:
+        span.bytes_read = len(patch_content)
+        for file_diff in parse_unified_diff(io.StringIO(patch_content)):
+            if file_diff.old_path is None:
+                continue
+            file_changes[file_diff.old_path] = file_diff.removed_lines
+            file_hunks[file_diff.old_path] = [
+                (hunk.new_start, hunk.new_count) for hunk in file_diff.hunks
+            ]
+    return file_changes, file_hunks
+
+
+def get_local_patch(repo_path, parent_commit_id, commit_id):
+    """Build the diff of parent_commit_id..commit_id from the local repository.
+
+    Returns None if either revision is missing locally.
+    """
+    # Both revisions are content hashes, so the diff is the same in any clone.
+    cache_key = ("local", parent_commit_id, commit_id, LOCAL_DIFF_OPTIONS)
+    patch_content = get_result_cache().get_text("patches", *cache_key)
+    if patch_content is not None:
+        return patch_content
+
+    try:
+        patch_content = git_backend.get_repo(repo_path).diff(
+            parent_commit_id, commit_id, LOCAL_DIFF_OPTIONS
+        )
+    except subprocess.CalledProcessError as e:
+        logging.warning(
+            f"Could not build local patch {parent_commit_id}..{commit_id}: {e.stderr}"
         )
-        for file, changes in file_changes.items():
-            logging.info(f"File {file} has {len(changes)} removed lines")
+        return None
+
+    get_result_cache().put_text("patches", patch_content, *cache_key)
+    return patch_content
+
+
+def fetch_remote_patch(commit_url):
+    """Download the GitHub .patch of a commit, reusing the result cache."""
+    # The URL names owner, repository and commit, so forks never collide.
+    clean_url = commit_url.split("#")[0]
+    patch_url = clean_url + ".patch"
+    cache = get_result_cache()
+
+    patch_content = cache.get_text("patches", "remote", clean_url)
+    if patch_content is not None:
+        logging.debug(f"Using cached patch for: {clean_url}")
+        return patch_content
+
+    logging.debug(f"Fetching patch from: {patch_url}")
+    with tracing.span("patch.remote") as span:
+        patch_content = network.get_client().fetch_text(patch_url)
+        span.bytes_read = len(patch_content)
+    cache.put_text("patches", patch_content, "remote", clean_url)
+    return patch_content
+
 
+def get_patch_info(
+    commit_url, with_hunks=False, repo_path=None, parent_commit_id=None, commit_id=None
+):
+    """Get the patch of a commit and parse it.
+
+    When repo_path and both revisions are given the diff is built locally;
+    the remote .patch download is only used as a fallback.
+
+    Returns the removed lines per file, or (file_changes, file_hunks) when
+    with_hunks is set; None if the patch could not be fetched or parsed.
+    """
+    try:
+        patch_content = None
+        if repo_path and parent_commit_id and commit_id:
+            patch_content = get_local_patch(repo_path, parent_commit_id, commit_id)
+        if patch_content is None:
+            patch_content = fetch_remote_patch(commit_url)
+
+        file_changes, file_hunks = parse_patch(patch_content)
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                f"Patch processing complete. Files changed: {list(file_changes.keys())}"
+            )
+            for file, changes in file_changes.items():
+                logging.debug(f"File {file} has {len(changes)} removed lines")
+
+        if with_hunks:
+            return file_changes, file_hunks
         return file_changes
-    except subprocess.CalledProcessError as e:
-        logging.warning(f"Failed to fetch patch. wget error: {e}")
+    except requests.RequestException as e:
+        logging.warning(f"Failed to fetch patch. HTTP error: {e}")
         return None
     except Exception as e:
         logging.error(f"Error in get_patch_info for {commit_url}: {str(e)}")
@@ -96,206 +178,713 @@ def get_patch_info(commit_url):
 
 
 def check_repo_exists(repo_url):
-    try:
-        response = requests.head(repo_url)
-        return response.status_code == 200
-    except Exception as e:
-        logging.error(f"Error checking repository {repo_url}: {str(e)}")
-        return False
+    return network.get_client().repo_exists(repo_url)
 
 
-def clone_repo_if_not_exists(repo_url, repo_path):
+def clone_repo_if_not_exists(repo_url, bare=False):
+    """Make sure the repository is in the shared store and return its path.
+
+    bare=True returns the mirror itself; blame reads revisions straight
+    from its object store. Otherwise a working copy borrowing the mirror's
+    objects is returned. Returns None if the repository is unavailable.
+    """
     if not check_repo_exists(repo_url):
-        return False
+        return None
     try:
-        if not os.path.exists(repo_path):
-            logging.info(f"Attempting to clone repository: {repo_url}")
-        if not os.path.exists(repo_path):
-            logging.info(f"Cloning repository: {repo_url}")
-            Repo.clone_from(repo_url, repo_path)
-            logging.info(f"Repository clone finished: {repo_url}")
+        store = get_repo_store()
+        if bare:
+            return store.ensure(repo_url)
+        return store.working_copy(repo_url)
     except Exception as e:
         logging.error(f"Error in clone_repo_if_not_exists for {repo_url}: {str(e)}")
         raise
 
 
-def get_processed_commits(output_file):
-    processed_commits = set()
-    if os.path.exists(output_file):
-        with open(output_file, "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                processed_commits.add(row["commit_id"])
-    return processed_commits
+def open_state(output_file, state_path=pipeline_state.DEFAULT_PATH):
+    """Open the pipeline state, importing an output CSV written before it existed."""
+    state = pipeline_state.PipelineState(state_path)
+    state.seed_from_csv(pipeline_state.STAGE_BLAME, output_file)
+    return state
 
 
-def process_commits(input_file, output_file):
-    processed_commits = get_processed_commits(output_file)
+def get_repo_path(repo_url, bare=False):
+    store = get_repo_store()
+    if bare:
+        return store.path_for(repo_url)
+    return store.worktree_path(repo_url)
 
-    with open(input_file, "r") as in_f, open(output_file, "a", newline="") as out_f:
-        reader = csv.DictReader(in_f)
-        fieldnames = reader.fieldnames + [
-            "malicious_files",
-            "malicious_commit_hashes",
-            "used_context_lines",
-        ]
 
-        writer = csv.DictWriter(out_f, fieldnames=fieldnames)
+def commit_exists(repo_path, commit_id):
+    return git_backend.get_repo(repo_path).commit_exists(commit_id)
 
-        if out_f.tell() == 0:
-            writer.writeheader()
 
-        total_commits = sum(1 for _ in reader)
-        in_f.seek(0)
-        reader = csv.DictReader(in_f)
+def prefetch_blobs(repo_path, commit_id):
+    """Fetch, in one batch, the blobs a blobless mirror lacks to diff and blame commit_id.
 
-        pbar = tqdm(
-            reader,
-            desc="Processing commits",
-            total=total_commits,
-            unit="commit",
-            ncols=100,
-            bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]",
+    Every version of the files the commit changes is fetched, as blame
+    reads their whole history. Anything missed (e.g. a file blame -C
+    copies lines from) is still fetched lazily by git itself.
+    """
+    repo = git_backend.get_repo(repo_path)
+    if not repo.is_partial():
+        return
+    try:
+        fetched = repo.prefetch_blobs([commit_id], repo.changed_paths([commit_id]))
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Could not prefetch the blobs of {commit_id}: {e.stderr}")
+        return
+    logging.debug(f"Fetched {fetched} blobs for {commit_id}")
+
+
+def merge_line_ranges(hunks, padding=0):
+    """Turn (start, count) hunks into merged, padded (start, end) ranges."""
+    ranges = []
+    for hunk_start, count in sorted(hunks):
+        if count == 0:
+            continue
+        start = max(1, hunk_start - padding)
+        end = hunk_start + count - 1 + padding
+        if ranges and start <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+BLAME_OPTIONS = ["-C", "-C", "-M"]
+
+
+def parse_blame_incremental(lines):
+    """Yield (final_line, line_count, commit_hash) for each `--incremental` entry.
+
+    Only the entry headers matter; the author, summary, boundary and
+    filename lines that follow them are skipped.
+    """
+    for line in lines:
+        fields = line.rstrip("\n").split(" ")
+        if (
+            len(fields) == 4
+            and len(fields[0]) == 40
+            and fields[2].isdigit()
+            and fields[3].isdigit()
+        ):
+            yield int(fields[2]), int(fields[3]), fields[0]
+
+
+def stream_blame(repo_path, revision, filename, line_ranges=None):
+    """Yield (line_number, commit_hash, line_content) as git blame attributes lines.
+
+    `git blame --incremental` reports each group of lines as soon as it is
+    attributed, so lines arrive in that order rather than in file order;
+    their content comes from the blob at revision. Closing the generator
+    early stops git blame. Raises CalledProcessError once the output is
+    exhausted if blame failed, e.g. because the file does not exist.
+    """
+    repo = git_backend.get_repo(repo_path)
+    blob = repo.read_blob(revision, filename)
+    if blob is None:
+        # Not a file at revision, e.g. one the commit deletes; there is
+        # nothing to blame.
+        logging.warning(f"Could not read file: {filename} at {revision}. Skipping file.")
+        return
+    file_lines = blob.decode("utf-8", errors="replace").split("\n")
+    options = list(BLAME_OPTIONS)
+    if line_ranges is not None:
+        # git blame rejects ranges past the end of the file; padding can
+        # reach there.
+        line_count = blob.count(b"\n") + (not blob.endswith(b"\n") and bool(blob))
+        for start, end in line_ranges:
+            if start <= line_count:
+                options += ["-L", f"{start},{min(end, line_count)}"]
+        if len(options) == len(BLAME_OPTIONS):
+            return
+    entries = parse_blame_incremental(repo.blame_incremental(revision, filename, options))
+    for final_line, line_count, commit_hash in entries:
+        for line_number in range(final_line, final_line + line_count):
+            if line_number <= len(file_lines):
+                yield line_number, commit_hash, file_lines[line_number - 1]
+
+
+def blame_cache_key(repo_url, revision, filename, line_ranges=None):
+    options = ["--incremental", *BLAME_OPTIONS]
+    if line_ranges is not None:
+        options.append([list(r) for r in line_ranges])
+    return repo_url, revision, filename, options
+
+
+def iter_blamed_lines(repo_url, repo_path, revision, filename, line_ranges=None):
+    """Yield (line_number, commit_hash, line_content) for a file, reusing cached results.
+
+    Results are cached by repository, revision, path and blame options, so
+    changing the matcher never requires blaming again. Only a blame that
+    was read to the end is cached; a caller that stops early leaves no
+    partial entry behind.
+    """
+    cache = get_result_cache()
+    cache_key = blame_cache_key(repo_url, revision, filename, line_ranges)
+    blamed_lines = cache.get_json("blame", *cache_key)
+    if blamed_lines is not None:
+        for line_number, commit_hash, line_content in blamed_lines:
+            yield line_number, commit_hash, line_content
+        return
+
+    blamed_lines = []
+    for blamed_line in stream_blame(repo_path, revision, filename, line_ranges):
+        blamed_lines.append(blamed_line)
+        yield blamed_line
+    blamed_lines.sort()
+    cache.put_json("blame", blamed_lines, *cache_key)
+
+
+def get_blamed_lines(repo_url, repo_path, revision, filename, line_ranges=None):
+    """Blame a file (or only line_ranges of it); returns [(commit_hash, line_content)] in file order."""
+    blamed_lines = sorted(
+        iter_blamed_lines(repo_url, repo_path, revision, filename, line_ranges)
+    )
+    return [(commit_hash, line_content) for _, commit_hash, line_content in blamed_lines]
+
+
+class CommitSkipped(Exception):
+    """A commit that cannot be blamed; error_class says why."""
+
+    def __init__(self, error_class, message):
+        super().__init__(message)
+        self.error_class = error_class
+
+
+def try_process_commit(row, repo_path, **options):
+    """Blame one commit row and report why it failed, if it did.
+
+    Returns (row, None, None) on success and (None, error_class, message)
+    otherwise. error_class is a CommitSkipped class such as
+    "parent_not_found" or the name of an unexpected exception.
+    """
+    commit_id = row["commit_id"]
+    with tracing.span("blame.commit") as span:
+        try:
+            return blame_commit(row, repo_path, **options), None, None
+        except CommitSkipped as e:
+            logging.warning(f"Skipping commit {commit_id}: {e}")
+            span.status = e.error_class
+            return None, e.error_class, str(e)
+        except Exception as e:
+            logging.error(f"Error processing commit {commit_id}: {str(e)}")
+            logging.error(f"Full traceback: {traceback.format_exc()}")
+            span.status = type(e).__name__
+            return None, type(e).__name__, str(e)
+
+
+def blame_commit(
+    row,
+    repo_path,
+    checkout=True,
+    clone=True,
+    hunks=False,
+    padding=0,
+    local_patches=True,
+    early_stop=False,
+):
+    """Blame the removed lines of one commit row.
+
+    With checkout=False the repository is a bare mirror and nothing is
+    reset; the parent is only checked for existence, since blame resolves
+    the file from the commit itself. clone=False skips the clone check when
+    the caller already made sure the repository is present. With hunks=True
+    the commit is blamed only over the line ranges its patch hunks cover
+    (widened by padding lines) instead of over whole files; lines are
+    matched as without it, so only matches outside those ranges are lost.
+    local_patches=False downloads the GitHub .patch instead of diffing the
+    local repository. With early_stop=True blaming a file stops as soon as
+    every removed line has matched a blamed line; lines that would have
+    matched after that (e.g. a removed "}" that occurs many times) no
+    longer add hashes.
+
+    Returns the row with the blame columns filled in; raises CommitSkipped
+    if the commit cannot be blamed. The repository is held in use
+    throughout, so the store's disk budget never evicts it mid-blame.
+    """
+    with get_repo_store().in_use(row["repo_url"]):
+        return _blame_commit(
+            row, repo_path, checkout, clone, hunks, padding, local_patches, early_stop
         )
 
+
+def _blame_commit(
+    row, repo_path, checkout, clone, hunks, padding, local_patches, early_stop
+):
+    commit_id = row["commit_id"]
+    parent_commit_id = row["parent_commit_id"]
+    commit_url = row["commit_url"]
+    repo_url = row["repo_url"]
+
+    if clone and not clone_repo_if_not_exists(repo_url, bare=not checkout):
+        raise CommitSkipped("repo_unavailable", f"Repository unavailable: {repo_url}")
+
+    if not commit_exists(repo_path, commit_id):
+        # The mirror may predate the commit; fetch once and re-check.
+        get_repo_store().ensure(repo_url, fetch=True)
+
+    if not checkout:
+        if not commit_exists(repo_path, parent_commit_id):
+            raise CommitSkipped(
+                "parent_not_found", f"Parent commit not found: {parent_commit_id}"
+            )
+        prefetch_blobs(repo_path, commit_id)
+    else:
+        logging.debug(f"Resetting to parent commit: {parent_commit_id}")
+        try:
+            git_backend.get_repo(repo_path).run(["reset", "--hard", parent_commit_id])
+        except subprocess.CalledProcessError as e:
+            raise CommitSkipped(
+                "reset_failed",
+                f"Could not reset to parent commit: {parent_commit_id}. Error: {e.stderr}",
+            )
+
+    patch_info = get_patch_info(
+        commit_url,
+        with_hunks=hunks,
+        repo_path=repo_path if local_patches else None,
+        parent_commit_id=parent_commit_id,
+        commit_id=commit_id,
+    )
+    if not patch_info:
+        raise CommitSkipped("no_patch", f"No patch info found for commit: {commit_id}")
+    if hunks:
+        patch_info, file_hunks = patch_info
+
+    malicious_commit_hashes = set()
+    malicious_files = set()
+    used_context_lines = False
+
+    for filename, removed_lines in patch_info.items():
+        if not removed_lines:
+            continue
+
+        if hunks:
+            # New-side line numbers address the commit itself.
+            line_ranges = merge_line_ranges(file_hunks.get(filename, []), padding)
+            if not line_ranges:
+                continue
+            blamed_lines = iter_blamed_lines(
+                repo_url, repo_path, commit_id, filename, line_ranges
+            )
+        else:
+            blamed_lines = iter_blamed_lines(repo_url, repo_path, commit_id, filename)
+
+        # Lines are matched while blame is still running; the file only
+        # counts once blame has succeeded.
+        matcher = RemovedLineMatcher(removed_lines)
+        unattributed = set(removed_lines) if early_stop else None
+        file_hashes = set()
+        file_used_context = False
+        try:
+            with tracing.span("blame.file"):
+                for _, commit_hash, line_content in blamed_lines:
+                    # Check if the line is in removed_lines or is a context line
+                    line_content = line_content.strip()
+                    match = matcher.match(line_content)
+                    if match is None:
+                        continue
+                    file_hashes.add(commit_hash)
+                    if match == MATCH_CONTEXT:
+                        file_used_context = True
+                    if unattributed is not None:
+                        unattributed -= matcher.matched_lines(line_content)
+                        if not unattributed:
+                            break
+        except subprocess.CalledProcessError as e:
+            logging.warning(
+                f"Could not run git blame on file: {filename}. Error: {e.stderr}. Skipping file."
+            )
+            continue
+        except (OSError, ValueError) as e:
+            # The blob reader failed; lose this file, not the whole commit.
+            logging.warning(f"Could not read file: {filename}. Error: {e}. Skipping file.")
+            continue
+        finally:
+            blamed_lines.close()
+
+        if file_hashes:
+            malicious_files.add(filename)
+            malicious_commit_hashes.update(file_hashes)
+            used_context_lines = used_context_lines or file_used_context
+
+    row["malicious_files"] = ",".join(malicious_files)
+    row["malicious_commit_hashes"] = ",".join(malicious_commit_hashes)
+    row["used_context_lines"] = "Yes" if used_context_lines else "No"
+
+    logging.debug(
+        f"Processed commit: {commit_id}. Found {len(malicious_files)} malicious files and {len(malicious_commit_hashes)} malicious commit hashes. Used context lines: {used_context_lines}"
+    )
+    return row
+
+
+def result_postfix(row):
+    return {
+        "Current Commit": row["commit_id"][:7],
+        "Malicious Files": len(list(filter(None, row["malicious_files"].split(",")))),
+        "Malicious Hashes": len(
+            list(filter(None, row["malicious_commit_hashes"].split(",")))
+        ),
+        "Used Context": row["used_context_lines"] == "Yes",
+    }
+
+
+def open_output(output_file, fieldnames):
+    out_f = open(output_file, "a", newline="")
+    writer = csv.DictWriter(out_f, fieldnames=fieldnames)
+    if out_f.tell() == 0:
+        writer.writeheader()
+    return out_f, writer
+
+
+def blame_fieldnames(input_fieldnames):
+    return input_fieldnames + [
+        "malicious_files",
+        "malicious_commit_hashes",
+        "used_context_lines",
+    ]
+
+
+def read_parent_rows(input_file):
+    """Return (fieldnames, rows) of a parents CSV with one row per commit.
+
+    get_parent_commits appends a row on every attempt, so after
+    `pipeline_state.py retry parents` a commit can have a row with an empty
+    parent followed by a resolved one. The first row with a parent wins; a
+    commit without any keeps its first row.
+    """
+    with open(input_file, "r") as in_f:
+        reader = csv.DictReader(in_f)
+        fieldnames = reader.fieldnames
+        by_commit = OrderedDict()
+        for row in reader:
+            current = by_commit.get(row["commit_id"])
+            if current is None or (not current["parent_commit_id"] and row["parent_commit_id"]):
+                by_commit[row["commit_id"]] = row
+    return fieldnames, list(by_commit.values())
+
+
+def process_commits(
+    input_file,
+    output_file,
+    checkout=True,
+    state_path=pipeline_state.DEFAULT_PATH,
+    **blame_options,
+):
+    stage = pipeline_state.STAGE_BLAME
+    state = open_state(output_file, state_path)
+
+    fieldnames, rows = read_parent_rows(input_file)
+    fieldnames = blame_fieldnames(fieldnames)
+    state.register(stage, [row["commit_id"] for row in rows])
+
+    # Check the next repositories' existence while this one is blamed.
+    pending_repo_urls = [
+        row["repo_url"]
+        for row in rows
+        if not state.is_processed(stage, row["commit_id"])
+    ]
+    prefetcher = network.Prefetcher(pending_repo_urls)
+    pending_index = 0
+
+    out_f, writer = open_output(output_file, fieldnames)
+    pbar = tqdm(
+        rows,
+        desc="Processing commits",
+        unit="commit",
+        ncols=100,
+        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]",
+    )
+
+    with out_f, state:
         for row in pbar:
             commit_id = row["commit_id"]
-            parent_commit_id = row["parent_commit_id"]
-            commit_url = row["commit_url"]
-            repo_url = row["repo_url"]
-
             pbar.set_postfix({"Current Commit": commit_id[:7]})
 
-            if commit_id in processed_commits:
-                logging.info(f"Skipping already processed commit: {commit_id}")
+            if state.is_processed(stage, commit_id):
+                logging.debug(f"Skipping already processed commit: {commit_id}")
                 continue
 
-            try:
-                repo_cache = "repo_cache"
-                os.makedirs(repo_cache, exist_ok=True)
-                repo_name = repo_url.split("/")[-1]
-                repo_path = os.path.join(repo_cache, repo_name)
-
-                if not clone_repo_if_not_exists(repo_url, repo_path):
-                    logging.warning(f"Skipping repository: {repo_url}")
-
-                logging.info(f"Resetting to parent commit: {parent_commit_id}")
-                try:
-                    subprocess.run(
-                        ["git", "reset", "--hard", parent_commit_id],
-                        cwd=repo_path,
-                        check=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                    )
-                except subprocess.CalledProcessError as e:
-                    logging.warning(
-                        f"Could not reset to parent commit: {parent_commit_id}. Error: {e.stderr.decode()}. Skipping."
-                    )
-                    continue
-
-                patch_info = get_patch_info(commit_url)
-                if not patch_info:
-                    logging.warning(f"No patch info found for commit: {commit_id}")
-                    continue
-
-                malicious_commit_hashes = set()
-                malicious_files = set()
-                used_context_lines = False
-
-                for filename, removed_lines in patch_info.items():
-                    if not removed_lines:
-                        continue
+            if pending_index < len(pending_repo_urls):
+                prefetcher.advance(pending_index)
+            pending_index += 1
+
+            state.mark_started(stage, commit_id)
+            repo_path = get_repo_path(row["repo_url"], bare=not checkout)
+            result, error_class, error = try_process_commit(
+                row, repo_path, checkout=checkout, **blame_options
+            )
+            if result is None:
+                state.mark_failed(stage, commit_id, error_class, error)
+                continue
 
-                    try:
-                        blame_output = subprocess.run(
-                            [
-                                "git",
-                                "blame",
-                                "-l",
-                                "-C",
-                                "-C",
-                                "-M",
-                                commit_id,
-                                "--",
-                                filename,
-                            ],
-                            cwd=repo_path,
-                            check=True,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True,
-                        ).stdout
-                    except subprocess.CalledProcessError as e:
-                        logging.warning(
-                            f"Could not run git blame on file: {filename}. Error: {e.stderr}. Skipping file."
-                        )
-                        continue
+            offset = out_f.tell()
+            writer.writerow(result)
+            out_f.flush()
+            state.mark_done(
+                stage, commit_id, pipeline_state.result_pointer(output_file, offset)
+            )
+            pbar.set_postfix(result_postfix(result))
 
-                    file_is_malicious = False
-                    for line in blame_output.split("\n"):
-                        if not line:
-                            continue
-                        try:
-                            parts = line.split(")")
-                            if len(parts) < 2:
-                                logging.warning(
-                                    f"Unexpected git blame output format: {line}"
-                                )
-                                continue
-                            hash_and_line = parts[0]
-                            commit_hash = hash_and_line.split(" ")[0]
-                            line_content = ")".join(parts[1:]).strip()
-
-                            # Check if the line is in removed_lines or is a context line
-                            if line_content in removed_lines:
-                                malicious_commit_hashes.add(commit_hash)
-                                file_is_malicious = True
-                            elif any(
-                                removed_line in line_content
-                                for removed_line in removed_lines
-                            ):
-                                malicious_commit_hashes.add(commit_hash)
-                                file_is_malicious = True
-                                used_context_lines = True
-                        except Exception as e:
-                            logging.warning(
-                                f"Error processing git blame line: {line}. Error: {str(e)}"
-                            )
-
-                    if file_is_malicious:
-                        malicious_files.add(filename)
-
-                row["malicious_files"] = ",".join(malicious_files)
-                row["malicious_commit_hashes"] = ",".join(malicious_commit_hashes)
-                row["used_context_lines"] = "Yes" if used_context_lines else "No"
-
-                writer.writerow(row)
-                out_f.flush()
-
-                processed_commits.add(commit_id)
-                pbar.set_postfix(
-                    {
-                        "Current Commit": commit_id[:7],
-                        "Malicious Files": len(malicious_files),
-                        "Malicious Hashes": len(malicious_commit_hashes),
-                        "Used Context": used_context_lines,
-                    }
-                )
-                logging.info(
-                    f"Processed commit: {commit_id}. Found {len(malicious_files)} malicious files and {len(malicious_commit_hashes)} malicious commit hashes. Used context lines: {used_context_lines}"
+    log_cache_stats()
+    logging.info(f"Processing complete. Results saved to {output_file}")
+
+
+def process_repo_group(
+    repo_path, rows, result_queue, checkout=True, blame_threads=4, blame_options=None
+):
+    """Worker entry point: process every row of one repository.
+
+    Results are sent back through result_queue as (commit_id, row_or_None,
+    error_class, error) so the parent process stays the only writer of the
+    output file and the pipeline state. A checkout-free group has no
+    working tree to protect, so its commits are blamed concurrently on
+    blame_threads threads.
+    """
+    blame_options = blame_options or {}
+    if checkout:
+        for row in rows:
+            result = try_process_commit(row, repo_path, **blame_options)
+            result_queue.put((row["commit_id"], *result))
+        log_cache_stats()
+        tracing.flush()
+        return
+
+    repo_url = rows[0]["repo_url"]
+    try:
+        cloned = clone_repo_if_not_exists(repo_url, bare=True)
+    except Exception:
+        cloned = False
+    if not cloned:
+        logging.warning(f"Skipping repository: {repo_url}")
+        for row in rows:
+            result_queue.put(
+                (
+                    row["commit_id"],
+                    None,
+                    "repo_unavailable",
+                    f"Repository unavailable: {repo_url}",
                 )
-            except Exception as e:
-                logging.error(f"Error processing commit {commit_id}: {str(e)}")
-                logging.error(f"Full traceback: {traceback.format_exc()}")
+            )
+        tracing.flush()
+        return
+
+    def blame_row(row):
+        result = try_process_commit(
+            row, repo_path, checkout=False, clone=False, **blame_options
+        )
+        result_queue.put((row["commit_id"], *result))
+
+    with ThreadPoolExecutor(max_workers=blame_threads) as executor:
+        list(executor.map(blame_row, rows))
+    log_cache_stats()
+    tracing.flush()
+
+
+def group_rows_by_repo(rows, bare=False):
+    """Group rows by working copy so no two workers share a checkout."""
+    groups = OrderedDict()
+    for row in rows:
+        repo_path = get_repo_path(row["repo_url"], bare=bare)
+        groups.setdefault(repo_path, []).append(row)
+    return groups
+
+
+def process_commits_parallel(
+    input_file,
+    output_file,
+    max_workers=None,
+    checkout=True,
+    blame_threads=4,
+    state_path=pipeline_state.DEFAULT_PATH,
+    **blame_options,
+):
+    """Like process_commits, but fans repositories out over a process pool.
+
+    Rows are grouped by repository and each group runs in a single worker
+    against its own working copy, so resets on one checkout never race.
+    """
+    stage = pipeline_state.STAGE_BLAME
+    state = open_state(output_file, state_path)
+
+    fieldnames, rows = read_parent_rows(input_file)
+    fieldnames = blame_fieldnames(fieldnames)
+    state.register(stage, [row["commit_id"] for row in rows])
+
+    pending_rows = []
+    queued = set()
+    for row in rows:
+        commit_id = row["commit_id"]
+        if commit_id not in queued and not state.is_processed(stage, commit_id):
+            pending_rows.append(row)
+            queued.add(commit_id)
+    logging.info(
+        f"Skipping {len(rows) - len(pending_rows)} already processed commits"
+    )
+    groups = group_rows_by_repo(pending_rows, bare=not checkout)
+
+    out_f, writer = open_output(output_file, fieldnames)
+    pbar = tqdm(
+        desc="Processing commits",
+        total=len(rows),
+        initial=len(rows) - len(pending_rows),
+        unit="commit",
+        ncols=100,
+        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]",
+    )
+
+    with out_f, state, pbar, multiprocessing.Manager() as manager, ProcessPoolExecutor(
+        max_workers=max_workers
+    ) as executor:
+        result_queue = manager.Queue()
+        futures = [
+            executor.submit(
+                process_repo_group,
+                repo_path,
+                group_rows,
+                result_queue,
+                checkout,
+                blame_threads,
+                blame_options,
+            )
+            for repo_path, group_rows in groups.items()
+        ]
 
+        remaining = len(pending_rows)
+        while remaining:
+            try:
+                commit_id, result, error_class, error = result_queue.get(timeout=1)
+            except queue.Empty:
+                failed = [f for f in futures if f.done() and f.exception()]
+                if failed:
+                    # Drop the queued groups, or leaving the pool would run
+                    # them all before the error surfaces.
+                    for future in futures:
+                        future.cancel()
+                    raise failed[0].exception()
+                continue
+
+            remaining -= 1
+            pbar.update(1)
+            if result is None:
+                state.mark_failed(stage, commit_id, error_class, error)
+                continue
+
+            offset = out_f.tell()
+            writer.writerow(result)
+            out_f.flush()
+            state.mark_done(
+                stage, commit_id, pipeline_state.result_pointer(output_file, offset)
+            )
+            pbar.set_postfix(result_postfix(result))
+
+    log_cache_stats()
     logging.info(f"Processing complete. Results saved to {output_file}")
 
 
 if __name__ == "__main__":
     input_file = "commits_with_parent_ids.csv"
     output_file = "commits_with_blame_data.csv"
-    process_commits(input_file, output_file)
+    parser = argparse.ArgumentParser(description="Blame the lines removed by each commit.")
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="process repositories in parallel worker processes",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--bare",
+        action="store_true",
+        help="blame from a mirror clone without resetting a working tree",
+    )
+    parser.add_argument(
+        "--blame-threads",
+        type=int,
+        default=4,
+        help="commits blamed concurrently per repository in --parallel --bare mode",
+    )
+    parser.add_argument(
+        "--hunks",
+        action="store_true",
+        help="blame only the line ranges of each commit covered by its patch hunks; "
+        "removed lines repeated elsewhere in a file are no longer matched",
+    )
+    parser.add_argument(
+        "--padding",
+        type=int,
+        default=0,
+        help="extra context lines blamed around each hunk in --hunks mode",
+    )
+    parser.add_argument(
+        "--remote-patches",
+        action="store_true",
+        help="download GitHub .patch files instead of diffing the local clone",
+    )
+    parser.add_argument(
+        "--early-stop",
+        action="store_true",
+        help="stop blaming a file once every removed line has been matched",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=DEFAULT_MAX_BYTES // 1024**2,
+        help="disk budget of the patch and blame cache before LRU eviction",
+    )
+    parser.add_argument(
+        "--repo-budget-gb",
+        type=float,
+        default=None,
+        help="disk budget of the shared repository store (default: unlimited)",
+    )
+    parser.add_argument(
+        "--blobless",
+        action="store_true",
+        help="clone new repositories without blobs and fetch only the files blamed (needs --bare)",
+    )
+    parser.add_argument(
+        "--state-db",
+        default=pipeline_state.DEFAULT_PATH,
+        help="SQLite pipeline state used to resume and to retry failures",
+    )
+    tracing.add_arguments(parser, "blame_metrics.json")
+    args = parser.parse_args()
+    if args.blobless and not args.bare:
+        parser.error("--blobless needs --bare: a working copy checks out every blob")
+    tracing.configure_from_args(args)
+    configure_cache(CACHE_DIR, args.cache_max_mb * 1024**2)
+    configure_repo_store(
+        REPO_CACHE_DIR,
+        args.repo_budget_gb * 1024**3 if args.repo_budget_gb else None,
+        blobless=args.blobless,
+    )
+    blame_options = {
+        "hunks": args.hunks,
+        "padding": args.padding,
+        "local_patches": not args.remote_patches,
+        "early_stop": args.early_stop,
+    }
+
+    if args.parallel:
+        process_commits_parallel(
+            input_file,
+            output_file,
+            max_workers=args.workers,
+            checkout=not args.bare,
+            blame_threads=args.blame_threads,
+            state_path=args.state_db,
+            **blame_options,
+        )
+    else:
+        process_commits(
+            input_file,
+            output_file,
+            checkout=not args.bare,
+            state_path=args.state_db,
+            **blame_options,
+        )
     print(f"Processing complete. Results saved to {output_file}")
     print(f"Log file: {log_filename}")
-    print(f"Patch cache directory: {PATCH_CACHE_DIR}")
+    print(f"Cache directory: {CACHE_DIR}")
+    print(f"Metrics: {args.metrics}")
@@ -1,11 +1,16 @@
+import argparse
 import csv
 import os
-import shutil
-from git import Repo, GitCommandError
 import time
 import logging
+from collections import OrderedDict
 from tqdm import tqdm
 
+import git_backend
+import pipeline_state
+import tracing
+from repo_store import RepoStore
+
 logging.basicConfig(
     filename="repo_processing.log",
     level=logging.INFO,
@@ -13,115 +18,161 @@ logging.basicConfig(
 )
 
 
-def clean_lock_files(repo_path):
-    lock_files = [
-        os.path.join(repo_path, ".git", "index.lock"),
-        os.path.join(repo_path, ".git", "shallow.lock"),
-    ]
-    for lock_file in lock_files:
-        if os.path.exists(lock_file):
-            try:
-                os.remove(lock_file)
-            except Exception as e:
-                logging.error(f"Failed to remove lock file {lock_file}: {str(e)}")
-
-
-def clone_repo_and_get_parent(repo_url, commit_id, repo_cache):
-    repo_name = repo_url.split("/")[-1]
-    repo_path = os.path.join(repo_cache, repo_name)
-
-    # Set environment variables to prevent Git from prompting for credentials
-    os.environ["GIT_TERMINAL_PROMPT"] = "0"
-    os.environ["GIT_ASKPASS"] = "echo"
-    os.environ["GIT_SSH_COMMAND"] = "ssh -o BatchMode=yes"
-
-    try:
-        clean_lock_files(repo_path)
-
-        if not os.path.exists(repo_path):
-            logging.info(f"Cloning repository: {repo_url}")
-            repo = Repo.clone_from(repo_url, repo_path, depth=1000)
-        else:
-            logging.info(f"Repository exists, fetching: {repo_url}")
-            repo = Repo(repo_path)
-            repo.remote().fetch(depth=1000)
-
-        logging.info(f"Checking out commit: {commit_id}")
-        repo.git.checkout(commit_id)
-
-        parent_commit = repo.commit(commit_id).parents[0].hexsha
-        logging.info(f"Found parent commit: {parent_commit}")
-
-        return parent_commit
-    except GitCommandError as e:
-        error_message = str(e)
-        logging.error(f"GitCommandError processing {repo_url}: {error_message}")
-        if "unable to read tree" in error_message or "does not exist" in error_message:
-            logging.info(f"Attempting full clone for {repo_url}")
-            shutil.rmtree(repo_path, ignore_errors=True)
-            repo = Repo.clone_from(repo_url, repo_path)
-            return clone_repo_and_get_parent(repo_url, commit_id, repo_cache)
-        elif (
-            "Authentication failed" in error_message
-            or "could not read Username" in error_message
-        ):
-            logging.warning(f"Repository {repo_url} requires authentication. Skipping.")
-            return None
+def read_parents(repo_path, commit_ids):
+    """Look up the first parent of many commits through the repository's batch reader.
+
+    Returns {commit_id: parent_or_None} for the commits present in the
+    repository. Root commits map to None. Commits that are missing, or that
+    sit on the boundary of a shallow clone (their parents were cut off),
+    are left out so the caller can fetch more history.
+    """
+    boundary = RepoStore.shallow_commits(repo_path)
+    commit_ids = [commit_id for commit_id in commit_ids if commit_id not in boundary]
+    return git_backend.get_repo(repo_path).first_parents(commit_ids)
+
+
+def resolve_repo_parents(store, repo_url, commit_ids, depth=None, deepen_steps=4):
+    """Resolve the first parent of every commit of one repository.
+
+    The repository is fetched once. Commits missing from a shallow mirror
+    make it deepen step by step (doubling each time, then unshallowing)
+    instead of re-cloning; commits no ref reaches are fetched by SHA.
+    Returns {commit_id: parent_or_None} for every requested commit.
+    """
+    with tracing.span("parents.resolve"), store.in_use(repo_url):
+        return _resolve_repo_parents(store, repo_url, commit_ids, depth, deepen_steps)
+
+
+def _resolve_repo_parents(store, repo_url, commit_ids, depth, deepen_steps):
+    commit_ids = list(dict.fromkeys(commit_ids))
+    repo_path = store.ensure(repo_url, fetch=True, depth=depth)
+    if repo_path is None:
+        return {commit_id: None for commit_id in commit_ids}
+
+    parents = read_parents(repo_path, commit_ids)
+    step = depth
+    for attempt in range(deepen_steps + 1):
+        missing = [commit_id for commit_id in commit_ids if commit_id not in parents]
+        if not missing or not store.is_shallow(repo_path):
+            break
+        # The last attempt fetches the complete history.
+        deepen_by = step if attempt < deepen_steps else None
+        logging.info(
+            f"{len(missing)} commits not reachable in {repo_url}, deepening by {deepen_by or 'everything'}"
+        )
+        if not store.deepen(repo_url, deepen_by):
+            break
+        parents.update(read_parents(repo_path, missing))
+        step *= 2
+
+    missing = [commit_id for commit_id in commit_ids if commit_id not in parents]
+    if missing and store.fetch_revisions(repo_url, missing):
+        parents.update(read_parents(repo_path, missing))
+
+    for commit_id in commit_ids:
+        if commit_id not in parents:
+            logging.error(f"Commit {commit_id} does not exist in {repo_url}")
+        elif parents[commit_id] is None:
+            logging.warning(f"Commit {commit_id} in {repo_url} has no parent")
         else:
-            return None
-    except Exception as e:
-        logging.error(f"Error processing {repo_url}: {str(e)}")
-        return None
+            logging.debug(f"Found parent commit of {commit_id}: {parents[commit_id]}")
+    return {commit_id: parents.get(commit_id) for commit_id in commit_ids}
 
 
-def process_commits(input_file, output_file):
+def process_commits(
+    input_file,
+    output_file,
+    depth=None,
+    state_path=pipeline_state.DEFAULT_PATH,
+    blobless=False,
+):
     repo_cache = "repo_cache"
     os.makedirs(repo_cache, exist_ok=True)
+    store = RepoStore(repo_cache, blobless=blobless)
+    stage = pipeline_state.STAGE_PARENTS
+    state = pipeline_state.PipelineState(state_path)
+    state.seed_from_csv(stage, output_file)
 
-    # Read existing output to determine where to resume
-    processed_commits = set()
-    if os.path.exists(output_file):
-        with open(output_file, "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                processed_commits.add(row["commit_id"])
-
-    with open(input_file, "r") as infile, open(output_file, "a", newline="") as outfile:
+    with open(input_file, "r") as infile:
         reader = csv.DictReader(infile)
-        writer = csv.DictWriter(
-            outfile, fieldnames=reader.fieldnames + ["parent_commit_id"]
-        )
+        fieldnames = reader.fieldnames + ["parent_commit_id"]
+        rows = list(reader)
+    state.register(stage, [row["commit_id"] for row in rows])
+
+    rows_by_repo = OrderedDict()
+    for row in rows:
+        if state.is_processed(stage, row["commit_id"]):
+            continue  # Skip already processed commits
+        rows_by_repo.setdefault(row["repo_url"], []).append(row)
+
+    with state, open(output_file, "a", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
 
         # Write header if the file is empty
         if outfile.tell() == 0:
             writer.writeheader()
 
-        total_rows = sum(1 for row in reader) - len(processed_commits)
-        infile.seek(0)
-        reader = csv.DictReader(infile)
-
+        total_rows = sum(len(rows) for rows in rows_by_repo.values())
         with tqdm(total=total_rows, desc="Processing commits") as pbar:
-            for row in reader:
-                if row["commit_id"] in processed_commits:
-                    continue  # Skip already processed commits
-
-                parent_commit = clone_repo_and_get_parent(
-                    row["repo_url"], row["commit_id"], repo_cache
-                )
-                row["parent_commit_id"] = parent_commit
-                writer.writerow(row)
-                outfile.flush()  # Ensure data is written immediately
-                pbar.update(1)
-
-    logging.info("Cleaning up repo cache")
-    shutil.rmtree(repo_cache, ignore_errors=True)
+            for repo_url, rows in rows_by_repo.items():
+                pbar.set_postfix({"Repository": repo_url.split("/")[-1]})
+                try:
+                    parents = resolve_repo_parents(
+                        store, repo_url, [row["commit_id"] for row in rows], depth
+                    )
+                except Exception as e:
+                    logging.error(f"Error processing {repo_url}: {str(e)}")
+                    parents = {}
+
+                with state.transaction():
+                    for row in rows:
+                        commit_id = row["commit_id"]
+                        row["parent_commit_id"] = parents.get(commit_id)
+                        offset = outfile.tell()
+                        writer.writerow(row)
+                        if row["parent_commit_id"] is None:
+                            state.mark_failed(
+                                stage,
+                                commit_id,
+                                "parent_not_found",
+                                f"No parent found in {repo_url}",
+                            )
+                        else:
+                            state.mark_done(
+                                stage,
+                                commit_id,
+                                pipeline_state.result_pointer(output_file, offset),
+                            )
+                    outfile.flush()  # Ensure data is written immediately
+                pbar.update(len(rows))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resolve the parent of each commit.")
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=None,
+        help="clone new repositories this shallow and deepen only when needed",
+    )
+    parser.add_argument(
+        "--blobless",
+        action="store_true",
+        help="clone new repositories without blobs; later stages fetch what they read",
+    )
+    parser.add_argument(
+        "--state-db",
+        default=pipeline_state.DEFAULT_PATH,
+        help="SQLite pipeline state used to resume and to retry failures",
+    )
+    tracing.add_arguments(parser, "parents_metrics.json")
+    args = parser.parse_args()
+    tracing.configure_from_args(args)
+
     input_file = "commits_with_repo_url.csv"
     output_file = "commits_with_parent_ids.csv"
     start_time = time.time()
-    process_commits(input_file, output_file)
+    process_commits(input_file, output_file, args.depth, args.state_db, args.blobless)
     end_time = time.time()
     print(f"Total execution time: {end_time - start_time} seconds")
     print(f"Check 'repo_processing.log' for detailed processing information.")
@@ -2,6 +2,11 @@ import csv
 from urllib.parse import urlparse
 
 
+def repo_url_from_commit_url(commit_url):
+    parsed_url = urlparse(commit_url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}/{'/'.join(parsed_url.path.split('/')[:3])}"
+
+
 def extract_repo_url(input_file, output_file):
     with open(input_file, "r") as infile, open(output_file, "w", newline="") as outfile:
         reader = csv.DictReader(infile)
@@ -10,14 +15,12 @@ def extract_repo_url(input_file, output_file):
         writer.writeheader()
 
         for row in reader:
-            commit_url = row["commit_url"]
-            parsed_url = urlparse(commit_url)
-            repo_url = f"{parsed_url.scheme}://{parsed_url.netloc}/{'/'.join(parsed_url.path.split('/')[:3])}"
-            row["repo_url"] = repo_url
+            row["repo_url"] = repo_url_from_commit_url(row["commit_url"])
             writer.writerow(row)
 
 
-# Example usage
-input_file = "commits.csv"
-output_file = "commits_with_repo_url.csv"
-extract_repo_url(input_file, output_file)
+if __name__ == "__main__":
+    # Example usage
+    input_file = "commits.csv"
+    output_file = "commits_with_repo_url.csv"
+    extract_repo_url(input_file, output_file)
@@ -0,0 +1,376 @@
+"""Long-lived access to the objects of the repositories in the store.
+
+Each GitRepository keeps one `git cat-file --batch` process open and
+answers object, commit, parent and existence lookups through it, so
+looking up thousands of commits costs no process launches and the pack
+indexes are read once. Operations git has no batch protocol for (diff,
+blame, log) are run through the same object, so every stage talks to git
+in one place. Partial (blobless) clones fetch the blobs a stage is about
+to read with prefetch_blobs(), in one request instead of one per blob:
+
+    repo = git_backend.get_backend().get(repo_path)
+    parents = repo.first_parents(commit_ids)
+    patch = repo.diff(parent_id, commit_id)
+
+Every process (and so every pool worker) has its own GitBackend, which
+keeps the most recently used repositories open and closes the others.
+"""
+import atexit
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+
+import tracing
+from repo_store import GIT_ENV, RepoStore
+
+DEFAULT_MAX_OPEN = 16
+
+
+class GitRepository:
+    """The git operations of one repository, over a persistent batch reader."""
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self._process = None
+        self._partial = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=self.repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env={**os.environ, **GIT_ENV},
+        )
+
+    def _request(self, revision):
+        self._process.stdin.write(revision.encode() + b"\n")
+        self._process.stdin.flush()
+        header = self._process.stdout.readline()
+        if not header:
+            raise BrokenPipeError(f"git cat-file exited in {self.repo_path}")
+        if header.endswith((b" missing\n", b" ambiguous\n")):
+            # "<revision> missing"; the revision may itself contain spaces.
+            return None
+        fields = header.split()
+        size = int(fields[2])
+        data = self._process.stdout.read(size + 1)[:-1]
+        return fields[0].decode(), fields[1].decode(), data
+
+    def read_object(self, revision):
+        """Return (object_id, type, content bytes) for revision, or None if missing.
+
+        revision may be anything cat-file accepts, e.g. "<commit>:<path>" or
+        "<hash>^{commit}".
+        """
+        if "\n" in revision:
+            raise ValueError(f"Invalid revision {revision!r}")
+        with self._lock, tracing.span("git.cat-file-batch") as span:
+            for attempt in range(2):
+                if self._process is None or self._process.poll() is not None:
+                    self._start()
+                try:
+                    result = self._request(revision)
+                    break
+                except (BrokenPipeError, ValueError):
+                    # The reader died, e.g. because the mirror was replaced
+                    # under it; start a new one once.
+                    self._close_process()
+                    if attempt:
+                        raise
+            span.bytes_read = len(result[2]) if result else 0
+            span.status = 0 if result else "missing"
+            return result
+
+    def resolve_commit(self, revision):
+        """Return the full id of the commit revision names, or None."""
+        result = self.read_object(f"{revision}^{{commit}}")
+        return result[0] if result else None
+
+    def commit_exists(self, commit_id):
+        return self.resolve_commit(commit_id) is not None
+
+    def resolve_commits(self, revisions):
+        """Map each revision that names a commit to the commit's full id."""
+        resolved = {}
+        for revision in revisions:
+            commit_id = self.resolve_commit(revision)
+            if commit_id is not None:
+                resolved[revision] = commit_id
+        return resolved
+
+    def read_commit(self, revision):
+        """Return {"id", "tree", "parents", "author", "committer", "message"} or None."""
+        result = self.read_object(f"{revision}^{{commit}}")
+        if result is None:
+            return None
+        commit_id, _, data = result
+        header, _, message = data.decode("utf-8", errors="replace").partition("\n\n")
+        commit = {"id": commit_id, "tree": None, "parents": [], "message": message}
+        for line in header.splitlines():
+            key, _, value = line.partition(" ")
+            if key == "tree":
+                commit["tree"] = value
+            elif key == "parent":
+                commit["parents"].append(value)
+            elif key in ("author", "committer"):
+                commit[key] = value
+        return commit
+
+    def first_parents(self, commit_ids):
+        """Return {commit_id: first_parent_or_None} for the commits present.
+
+        Missing commits are left out; root commits map to None.
+        """
+        parents = {}
+        for commit_id in commit_ids:
+            commit = self.read_commit(commit_id)
+            if commit is not None:
+                parents[commit_id] = commit["parents"][0] if commit["parents"] else None
+        return parents
+
+    def read_blob(self, revision, path):
+        """Return the content of path at revision as bytes, or None."""
+        result = self.read_object(f"{revision}:{path}")
+        if result is None or result[1] != "blob":
+            return None
+        return result[2]
+
+    def run(self, args, span_name=None, text=True, input=None):
+        """Run a git command in the repository; raises CalledProcessError on failure."""
+        with tracing.span(span_name or f"git.{args[0]}") as span:
+            result = subprocess.run(
+                ["git", *args],
+                cwd=self.repo_path,
+                check=True,
+                input=input,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=text,
+                errors="replace" if text else None,
+                env={**os.environ, **GIT_ENV},
+            )
+            span.bytes_read = len(result.stdout)
+        return result.stdout
+
+    def diff(self, old_revision, new_revision, options=()):
+        return self.run(["diff", *options, old_revision, new_revision, "--"])
+
+    def stream(self, args, span_name=None, input=None, chunk_size=None):
+        """Run a git command and yield its stdout as it is produced.
+
+        Yields lines, or chunks of up to chunk_size characters. If the
+        caller stops iterating early the process is killed; otherwise a
+        failing command raises CalledProcessError once its output is read.
+        """
+        with tracing.span(span_name or f"git.{args[0]}") as span:
+            process = subprocess.Popen(
+                ["git", *args],
+                cwd=self.repo_path,
+                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                errors="replace",
+                env={**os.environ, **GIT_ENV},
+            )
+            try:
+                if input is not None:
+                    process.stdin.write(input)
+                    process.stdin.close()
+                if chunk_size:
+                    chunks = iter(lambda: process.stdout.read(chunk_size), "")
+                else:
+                    chunks = process.stdout
+                for chunk in chunks:
+                    span.bytes_read += len(chunk)
+                    yield chunk
+                stderr = process.stderr.read()
+                span.status = process.wait()
+            except GeneratorExit:
+                # Returning instead of re-raising ends the span normally, so
+                # it keeps this status rather than the exception's name.
+                span.status = "stopped"
+                return
+            finally:
+                if process.poll() is None:
+                    # The caller stopped reading early.
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+                process.stderr.close()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    process.returncode, process.args, stderr=stderr
+                )
+
+    def log(self, commit_ids, options=()):
+        """Run `git log --no-walk=unsorted --stdin` for commit_ids; yields stdout chunks."""
+        # git reads all of --stdin before it prints anything, so writing the
+        # ids up front cannot deadlock on a full stdout pipe.
+        return self.stream(
+            ["log", "--no-walk=unsorted", "--stdin", *options],
+            input="".join(f"{commit_id}\n" for commit_id in commit_ids),
+            chunk_size=65536,
+        )
+
+    def blame_incremental(self, revision, filename, options=()):
+        """Yield the lines of `git blame --incremental` as git finds them."""
+        return self.stream(["blame", "--incremental", *options, revision, "--", filename])
+
+    def is_partial(self):
+        """Whether the repository is a partial clone that may lack blobs."""
+        if self._partial is None:
+            self._partial = RepoStore.is_partial(self.repo_path)
+        return self._partial
+
+    def changed_paths(self, commit_ids):
+        """Return the paths each commit changes against its first parent.
+
+        Only trees are compared, so no blob is read (or fetched).
+        """
+        output = self.run(
+            [
+                "diff-tree",
+                "--stdin",
+                "-r",
+                "--no-renames",
+                "--root",
+                "--diff-merges=first-parent",
+                "--name-only",
+                "--no-commit-id",
+            ],
+            input="".join(f"{commit_id}\n" for commit_id in commit_ids),
+        )
+        return set(filter(None, output.split("\n")))
+
+    def missing_blobs(self, revisions, paths, walk=True):
+        """Return the ids of the blobs of paths that are missing locally.
+
+        With walk=True every version of paths in the history of revisions
+        is considered, as blame needs them; otherwise only the versions
+        in revisions themselves.
+        """
+        options = ["--objects", "--missing=print", "--stdin"]
+        if not walk:
+            # Keep revisions that leave paths unchanged; their blobs are
+            # still the old side of a diff.
+            options += ["--no-walk", "--sparse", "--full-history"]
+        lines = list(revisions) + ["--"] + [f":(literal){path}" for path in paths]
+        output = self.run(["rev-list", *options], input="".join(f"{line}\n" for line in lines))
+        return [line[1:] for line in output.split("\n") if line.startswith("?")]
+
+    def fetch_objects(self, object_ids):
+        """Fetch specific objects from the promisor remote in one request."""
+        self.run(
+            [
+                "-c",
+                "fetch.negotiationAlgorithm=noop",
+                "fetch",
+                "--quiet",
+                "--no-tags",
+                "--no-write-fetch-head",
+                "--recurse-submodules=no",
+                "--filter=blob:none",
+                "--stdin",
+                "origin",
+            ],
+            span_name="git.fetch-objects",
+            input="".join(f"{object_id}\n" for object_id in object_ids),
+        )
+
+    def prefetch_blobs(self, revisions, paths, walk=True):
+        """Fetch the missing blobs of paths in one batch; returns how many.
+
+        Without it a partial clone fetches every blob git touches with a
+        request of its own. Does nothing for a complete repository.
+        """
+        if not paths or not self.is_partial():
+            return 0
+        object_ids = self.missing_blobs(revisions, paths, walk)
+        if object_ids:
+            self.fetch_objects(object_ids)
+        return len(object_ids)
+
+    def _close_process(self):
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+    def close(self):
+        with self._lock:
+            self._close_process()
+
+
+class GitBackend:
+    """Pool of open GitRepository objects, least recently used closed first."""
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max_open
+        self._repos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, repo_path):
+        key = os.path.abspath(repo_path)
+        evicted = []
+        with self._lock:
+            repo = self._repos.get(key)
+            if repo is None:
+                repo = self._repos[key] = GitRepository(repo_path)
+            self._repos.move_to_end(key)
+            while len(self._repos) > self.max_open:
+                evicted.append(self._repos.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return repo
+
+    def discard(self, repo_path):
+        """Close the reader of a repository, e.g. before deleting it."""
+        with self._lock:
+            repo = self._repos.pop(os.path.abspath(repo_path), None)
+        if repo is not None:
+            repo.close()
+
+    def close(self):
+        with self._lock:
+            repos = list(self._repos.values())
+            self._repos.clear()
+        for repo in repos:
+            repo.close()
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = GitBackend()
+        atexit.register(_backend.close)
+    return _backend
+
+
+def get_repo(repo_path):
+    return get_backend().get(repo_path)
+
+
+def _forget_after_fork():
+    # The parent's readers are not ours to use; start with an empty pool.
+    global _backend
+    _backend = None
+
+
+os.register_at_fork(after_in_child=_forget_after_fork)
@@ -0,0 +1,149 @@
+from collections import deque
+
+MATCH_EXACT = "exact"
+MATCH_CONTEXT = "context"
+
+# Below this many distinct patterns Python's C-level `in` loop beats walking
+# the automaton one character at a time (see benchmarks/bench_line_matcher.py).
+AUTOMATON_THRESHOLD = 32
+
+
+class AhoCorasick:
+    """Multi-pattern substring automaton.
+
+    Built once from a list of patterns, it scans a text in a single pass and
+    reports which of the patterns occur in it, however many there are.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+        for index, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._out[state].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] = (
+                    self._out[next_state] + self._out[self._fail[next_state]]
+                )
+
+    def contains_any(self, text):
+        """Return True as soon as any non-empty pattern is found in text."""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                return True
+        return False
+
+    def find_all(self, text):
+        """Return the set of indices of the patterns that occur in text."""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class RemovedLineMatcher:
+    """Classify blame lines against the lines removed from one file.
+
+    match() gives the same answer as the original scan in get_blame_data:
+    MATCH_EXACT when the line equals a removed line, MATCH_CONTEXT when a
+    removed line is a substring of it, otherwise None.
+    """
+
+    def __init__(self, removed_lines, automaton_threshold=AUTOMATON_THRESHOLD):
+        self.exact = set(removed_lines)
+        # An empty removed line is a substring of every blame line.
+        self.match_everything = "" in self.exact
+        patterns = [line for line in self.exact if line]
+        if len(patterns) >= automaton_threshold:
+            self._automaton = AhoCorasick(patterns)
+            self._patterns = None
+        else:
+            self._automaton = None
+            self._patterns = patterns
+
+    def match(self, line_content):
+        if line_content in self.exact:
+            return MATCH_EXACT
+        if self.match_everything:
+            return MATCH_CONTEXT
+        if self._automaton is not None:
+            if self._automaton.contains_any(line_content):
+                return MATCH_CONTEXT
+        elif any(pattern in line_content for pattern in self._patterns):
+            return MATCH_CONTEXT
+        return None
+
+    def matched_lines(self, line_content):
+        """Return the removed lines that line_content equals or contains."""
+        if self._automaton is not None:
+            patterns = self._automaton.patterns
+            found = {patterns[index] for index in self._automaton.find_all(line_content)}
+        else:
+            found = {pattern for pattern in self._patterns if pattern in line_content}
+        if self.match_everything:
+            found.add("")
+        return found
+
+
+class KeywordMatcher:
+    """Report which of a fixed list of keywords occur in a text.
+
+    find() returns the keywords in list order, like the comprehension
+    [word for word in keywords if word in text] it replaces, and uses the
+    automaton once there are enough keywords for it to pay off.
+    """
+
+    def __init__(self, keywords, automaton_threshold=AUTOMATON_THRESHOLD):
+        self.keywords = list(keywords)
+        if len(self.keywords) >= automaton_threshold:
+            self._automaton = AhoCorasick(self.keywords)
+        else:
+            self._automaton = None
+
+    def find(self, text):
+        if self._automaton is None:
+            return [word for word in self.keywords if word in text]
+        return [self.keywords[index] for index in sorted(self._automaton.find_all(text))]
+
+    def contains_any(self, text):
+        if self._automaton is None:
+            return any(word in text for word in self.keywords)
+        return self._automaton.contains_any(text)
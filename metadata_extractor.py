@@ -1,10 +1,18 @@
+import argparse
 import csv
 import os
 import json
-from git import Repo
+import subprocess
 import logging
+from collections import OrderedDict
 from tqdm import tqdm
 
+import git_backend
+import pipeline_state
+import tracing
+from columnar_store import write_json_atomic
+from repo_store import RepoStore
+
 # Set up logging
 logging.basicConfig(
     filename="commit_metadata.log",
@@ -13,115 +21,424 @@ logging.basicConfig(
 )
 
 
-def get_commit_metadata(repo, commit_hash):
+# One record per commit: a record separator, NUL-separated header fields,
+# then the --numstat lines of that commit.
+LOG_FORMAT = "%x1e%H%x00%an%x00%ae%x00%cI%x00%B%x00"
+
+
+def resolve_commits(repo_path, commit_hashes):
+    """Map each hash (full or abbreviated) to the full id of the commit it names.
+
+    Hashes that do not name a commit in the repository are left out.
+    """
+    return git_backend.get_repo(repo_path).resolve_commits(commit_hashes)
+
+
+def parse_log_record(record):
+    commit_id, author, email, date, message, numstat = record.split("\x00", 5)
+    files_changed = []
+    insertions = deletions = 0
+    for line in numstat.splitlines():
+        if not line:
+            continue
+        added, removed, path = line.split("\t", 2)
+        files_changed.append(path)
+        # Binary files show "-" for both counts, which git's stats treat as 0.
+        insertions += int(added) if added != "-" else 0
+        deletions += int(removed) if removed != "-" else 0
+    return {
+        "hash": commit_id,
+        "author": author,
+        "author_email": email,
+        "committed_date": date,
+        "message": message.strip(),
+        "files_changed": files_changed,
+        "insertions": insertions,
+        "deletions": deletions,
+    }
+
+
+def iter_log_metadata(repo_path, commit_ids):
+    """Stream the metadata of many commits from a single `git log` process.
+
+    Stats match GitPython's commit.stats: renames are not detected, merges are
+    diffed against their first parent and root commits against the empty
+    tree. Records are parsed as they arrive, one commit at a time.
+    """
+    chunks = git_backend.get_repo(repo_path).log(
+        commit_ids,
+        [
+            "--no-renames",
+            "--diff-merges=first-parent",
+            "--numstat",
+            f"--format={LOG_FORMAT}",
+        ],
+    )
+    pending = ""
+    for chunk in chunks:
+        records = (pending + chunk).split("\x1e")
+        pending = records.pop()
+        for record in records:
+            if record:
+                yield parse_log_record(record)
+    if pending:
+        yield parse_log_record(pending)
+
+
+def prefetch_blobs(repo_path, commit_ids):
+    """Fetch the blobs `git log --numstat` compares in one batch, for a blobless mirror."""
+    repo = git_backend.get_repo(repo_path)
+    if not repo.is_partial():
+        return
     try:
-        commit = repo.commit(commit_hash)
-        return {
-            "hash": commit.hexsha,
-            "author": commit.author.name,
-            "author_email": commit.author.email,
-            "committed_date": commit.committed_datetime.isoformat(),
-            "message": commit.message.strip(),
-            "files_changed": list(commit.stats.files.keys()),
-            "insertions": commit.stats.total["insertions"],
-            "deletions": commit.stats.total["deletions"],
-        }
-    except Exception as e:
-        logging.error(f"Error retrieving metadata for commit {commit_hash}: {str(e)}")
-        return None
-
-
-def load_existing_data(output_file):
-    if os.path.exists(output_file):
-        with open(output_file, "r") as f:
-            return json.load(f)
-    return {}
-
-
-def get_or_create_repo(repo_url, repo_cache_dir):
-    repo_name = repo_url.split("/")[-1]
-    repo_path = os.path.join(repo_cache_dir, repo_name)
-    if not os.path.exists(repo_path):
-        logging.info(f"Cloning repository: {repo_url}")
-        try:
-            repo = Repo.clone_from(repo_url, repo_path)
-            logging.info(f"Successfully cloned repository: {repo_url}")
-            return repo
-        except Exception as e:
-            logging.error(f"Error cloning repository {repo_url}: {str(e)}")
-            return None
-    else:
-        try:
-            repo = Repo(repo_path)
-            repo.remotes.origin.pull()
-            logging.info(f"Successfully updated repository: {repo_url}")
-            return repo
-        except Exception as e:
-            logging.error(
-                f"Error opening or updating repository at {repo_path}: {str(e)}"
-            )
-            return None
-
-
-def process_commits(input_file, output_file, repo_cache_dir):
+        parents = repo.first_parents(commit_ids)
+        revisions = list(commit_ids) + [parent for parent in parents.values() if parent]
+        repo.prefetch_blobs(revisions, repo.changed_paths(commit_ids), walk=False)
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Could not prefetch blobs from {repo_path}: {e.stderr}")
+
+
+def get_commits_metadata(repo_path, commit_hashes):
+    """Return {commit_hash: metadata} for every hash found in repo_path.
+
+    All hashes of a repository are resolved through the repository's
+    persistent `git cat-file --batch` reader and described by one
+    `git log --numstat` pass, instead of a separate diff per commit.
+    Missing hashes are logged and left out.
+    """
+    commit_hashes = list(dict.fromkeys(commit_hashes))
+    if not commit_hashes:
+        return {}
+    try:
+        resolved = resolve_commits(repo_path, commit_hashes)
+        by_id = {}
+        if resolved:
+            commit_ids = list(dict.fromkeys(resolved.values()))
+            prefetch_blobs(repo_path, commit_ids)
+            for metadata in iter_log_metadata(repo_path, commit_ids):
+                by_id[metadata["hash"]] = metadata
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error retrieving commit metadata from {repo_path}: {e.stderr}")
+        return {}
+
+    result = {}
+    for commit_hash in commit_hashes:
+        commit_id = resolved.get(commit_hash)
+        if commit_id is None or commit_id not in by_id:
+            logging.error(f"Error retrieving metadata for commit {commit_hash}: not found")
+            continue
+        result[commit_hash] = dict(by_id[commit_id])
+    return result
+
+
+def read_records(records_file):
+    """Yield the records of an append-only metadata file in order.
+
+    A line cut short by a crash mid-append is skipped.
+    """
+    if not os.path.exists(records_file):
+        return
+    with open(records_file, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(
+                    f"Skipping truncated record on line {line_number} of {records_file}"
+                )
+
+
+def load_processed_hashes(records_file):
+    """Return the (cve_id, project_name, original_hash) keys already recorded.
+
+    Markers are included with original_hash None.
+    """
+    processed = set()
+    for record in read_records(records_file):
+        processed.add((record["cve_id"], record["project_name"], record["original_hash"]))
+    return processed
+
+
+def row_hashes(row):
+    """Return the malicious commit hashes of a blame row, without empty entries."""
+    return [hash.strip() for hash in row["malicious_commit_hashes"].split(",") if hash.strip()]
+
+
+def ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def open_append(path):
+    out_f = open(path, "a")
+    if out_f.tell() > 0 and not ends_with_newline(path):
+        # Terminate a record cut short by a crash so the next one parses.
+        out_f.write("\n")
+    return out_f
+
+
+def append_record(out_f, cve_id, project_name, original_hash, malicious_files=None):
+    """Append one CVE/project entry that references a commit of the index.
+
+    original_hash is None for the marker written once per CVE/project,
+    which keeps CVEs whose commits could not be resolved in the output.
+    """
+    out_f.write(
+        json.dumps(
+            {
+                "cve_id": cve_id,
+                "project_name": project_name,
+                "original_hash": original_hash,
+                "malicious_files": malicious_files,
+            }
+        )
+        + "\n"
+    )
+
+
+class MetadataIndex:
+    """Global commit hash -> metadata index shared by every CVE/project.
+
+    Held in memory during a run and persisted as an append-only JSON-lines
+    file, so each commit is extracted once across CVEs and across runs.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._metadata = {}
+        for record in read_records(index_file):
+            self._metadata[record["original_hash"]] = record["metadata"]
+        self._out_f = None
+
+    def __contains__(self, commit_hash):
+        return commit_hash in self._metadata
+
+    def __len__(self):
+        return len(self._metadata)
+
+    def get(self, commit_hash):
+        return self._metadata.get(commit_hash)
+
+    def add(self, commit_hash, metadata):
+        if self._out_f is None:
+            self._out_f = open_append(self.index_file)
+        self._out_f.write(
+            json.dumps({"original_hash": commit_hash, "metadata": metadata}) + "\n"
+        )
+        self._out_f.flush()
+        self._metadata[commit_hash] = metadata
+
+    def close(self):
+        if self._out_f is not None:
+            self._out_f.close()
+            self._out_f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compact_metadata(records_file, index_file, output_file=None, per_cve_dir=None):
+    """Merge the append-only records into {cve_id: {project_name: [metadata]}}.
+
+    Each record's commit is looked up in the metadata index. The merged
+    view is written to output_file and/or as one <per_cve_dir>/<cve_id>.json
+    file per CVE (the commit_metadata/ layout), each replaced atomically.
+    Later records for the same commit win.
+    """
+    index = MetadataIndex(index_file)
+    commit_data = {}
+    for record in read_records(records_file):
+        commits = commit_data.setdefault(record["cve_id"], {}).setdefault(
+            record["project_name"], {}
+        )
+        commit_hash = record["original_hash"]
+        if commit_hash is not None and commit_hash in index:
+            commits[commit_hash] = {
+                **index.get(commit_hash),
+                "original_hash": commit_hash,
+                "malicious_files": record["malicious_files"],
+            }
+    commit_data = {
+        cve_id: {project: list(commits.values()) for project, commits in projects.items()}
+        for cve_id, projects in commit_data.items()
+    }
+
+    if output_file is not None:
+        write_json_atomic(output_file, commit_data)
+    if per_cve_dir is not None:
+        for cve_id, projects in commit_data.items():
+            write_json_atomic(os.path.join(per_cve_dir, f"{cve_id}.json"), projects)
+    logging.info(f"Compacted {records_file} into {len(commit_data)} CVEs")
+    return commit_data
+
+
+def pending_hashes(commit_hashes, index, state):
+    """Return the hashes that are neither indexed nor failed in an earlier run."""
+    stage = pipeline_state.STAGE_METADATA
+    return [
+        commit_hash
+        for commit_hash in dict.fromkeys(commit_hashes)
+        if commit_hash not in index
+        and state.status(stage, commit_hash) != pipeline_state.FAILED
+    ]
+
+
+def describe_commits(store, state, index, repo_url, commit_hashes):
+    """Extract the metadata of commit_hashes from repo_url into the index."""
+    stage = pipeline_state.STAGE_METADATA
+    # Another repository may have described the same commit already.
+    commit_hashes = [commit_hash for commit_hash in commit_hashes if commit_hash not in index]
+    if not commit_hashes:
+        return
+    with store.in_use(repo_url):
+        repo_path = store.ensure(repo_url, fetch=True)
+        if repo_path is None:
+            logging.error(f"Error cloning or updating repository {repo_url}")
+            error_class = "repo_unavailable"
+            metadata_by_hash = {}
+        else:
+            error_class = "commit_not_found"
+            with tracing.span("metadata.extract"):
+                metadata_by_hash = get_commits_metadata(repo_path, commit_hashes)
+    with state.transaction():
+        for commit_hash in commit_hashes:
+            metadata = metadata_by_hash.get(commit_hash)
+            if metadata is None:
+                state.mark_failed(stage, commit_hash, error_class, repo_url)
+                continue
+            index.add(commit_hash, metadata)
+            state.mark_done(stage, commit_hash, index.index_file)
+
+
+def record_row(out_f, row, index, processed):
+    """Append the records of one blame row whose commits are in the index."""
+    cve_id = row["cve_id"]
+    project_name = row["project_name"]
+    malicious_files = row["malicious_files"].split(",")
+
+    # Records the CVE/project even if none of its commits resolve, once.
+    marker = (cve_id, project_name, None)
+    if marker not in processed:
+        append_record(out_f, cve_id, project_name, None)
+        processed.add(marker)
+
+    for hash in row_hashes(row):
+        key = (cve_id, project_name, hash)
+        if key in processed:
+            logging.debug(f"Skipping already processed commit: {hash}")
+            continue
+
+        if hash in index:
+            append_record(out_f, cve_id, project_name, hash, malicious_files)
+            processed.add(key)
+
+    out_f.flush()
+
+
+def process_commits(
+    input_file,
+    records_file,
+    index_file,
+    repo_cache_dir,
+    state_path=pipeline_state.DEFAULT_PATH,
+    blobless=False,
+):
+    """Extract metadata for every malicious commit, appending one record each.
+
+    Metadata is stored once per commit in the index at index_file; records
+    only reference it. Entries already present in records_file are skipped,
+    so an interrupted run resumes where it stopped. Commits that could not
+    be extracted are recorded as failed in the pipeline state and are only
+    tried again after `pipeline_state.py retry metadata`. With
+    blobless=True new repositories are cloned without blobs. Use
+    compact_metadata() for the merged view.
+    """
     os.makedirs(repo_cache_dir, exist_ok=True)
 
-    commit_data = load_existing_data(output_file)
-    repos = {}
+    processed = load_processed_hashes(records_file)
+    store = RepoStore(repo_cache_dir, blobless=blobless)
 
     with open(input_file, "r") as in_f:
-        reader = csv.DictReader(in_f)
-        total_rows = sum(1 for row in reader)
-        in_f.seek(0)
-        next(reader)  # Skip header row
-
-        for row in tqdm(reader, desc="Processing commits", total=total_rows):
-            cve_id = row["cve_id"]
-            project_name = row["project_name"]
-            repo_url = row["repo_url"]
-            malicious_hashes = row["malicious_commit_hashes"].split(",")
-            malicious_files = row["malicious_files"].split(",")
-
-            if cve_id not in commit_data:
-                commit_data[cve_id] = {}
-
-            if project_name not in commit_data[cve_id]:
-                commit_data[cve_id][project_name] = []
-
-            if repo_url not in repos:
-                repo = get_or_create_repo(repo_url, repo_cache_dir)
-                if repo is None:
-                    continue
-                repos[repo_url] = repo
-            else:
-                repo = repos[repo_url]
-
-            for hash in malicious_hashes:
-                if any(
-                    commit["original_hash"] == hash.strip()
-                    for commit in commit_data[cve_id][project_name]
-                ):
-                    logging.info(f"Skipping already processed commit: {hash.strip()}")
-                    continue
-
-                metadata = get_commit_metadata(repo, hash.strip())
-                if metadata:
-                    metadata["original_hash"] = hash.strip()
-                    metadata["malicious_files"] = malicious_files
-                    commit_data[cve_id][project_name].append(metadata)
-
-            with open(output_file, "w") as out_f:
-                json.dump(commit_data, out_f, indent=2)
-
-    logging.info(f"Processing complete. Results saved to {output_file}")
+        rows = list(csv.DictReader(in_f))
+
+    with pipeline_state.PipelineState(state_path) as state, MetadataIndex(
+        index_file
+    ) as index:
+        # Every hash each repository still has to describe, so that it is
+        # extracted by a single git log pass when the repository comes up.
+        pending_by_repo = OrderedDict()
+        for row in rows:
+            pending_by_repo.setdefault(row["repo_url"], []).extend(row_hashes(row))
+        for repo_url, commit_hashes in pending_by_repo.items():
+            pending_by_repo[repo_url] = pending_hashes(commit_hashes, index, state)
+
+        with open_append(records_file) as out_f:
+            for row in tqdm(rows, desc="Processing commits"):
+                pending = pending_by_repo.pop(row["repo_url"], None)
+                if pending:
+                    describe_commits(store, state, index, row["repo_url"], pending)
+                record_row(out_f, row, index, processed)
+
+    logging.info(f"Processing complete. Records appended to {records_file}")
 
 
 if __name__ == "__main__":
-    input_file = "commits_with_blame_data.csv"
-    output_file = (
-        "commit_metadata.json"  # Changed: Now directly in the script directory
+    parser = argparse.ArgumentParser(description="Extract malicious commit metadata")
+    parser.add_argument("--input", default="commits_with_blame_data.csv")
+    parser.add_argument(
+        "--records",
+        default="commit_metadata.jsonl",
+        help="append-only file with one record per CVE/project commit",
+    )
+    parser.add_argument(
+        "--index",
+        default="commit_index.jsonl",
+        help="append-only hash -> metadata index shared by all CVEs",
+    )
+    parser.add_argument(
+        "--state-db",
+        default=pipeline_state.DEFAULT_PATH,
+        help="SQLite pipeline state recording which commits failed and why",
+    )
+    parser.add_argument(
+        "--output",
+        default="commit_metadata.json",
+        help="merged JSON written by the compaction step",
     )
-    repo_cache_dir = os.path.join("repo_cache")
-    process_commits(input_file, output_file, repo_cache_dir)
-    print(f"Processing complete. Results saved to {output_file}")
+    parser.add_argument(
+        "--per-cve-dir",
+        help="also write one <cve_id>.json per CVE into this directory",
+    )
+    parser.add_argument(
+        "--blobless",
+        action="store_true",
+        help="clone new repositories without blobs; fetch only those the stats need",
+    )
+    parser.add_argument(
+        "--compact-only",
+        action="store_true",
+        help="only rebuild the merged output from existing records",
+    )
+    tracing.add_arguments(parser, "metadata_metrics.json")
+    args = parser.parse_args()
+    tracing.configure_from_args(args)
+
+    if not args.compact_only:
+        repo_cache_dir = os.path.join("repo_cache")
+        process_commits(
+            args.input,
+            args.records,
+            args.index,
+            repo_cache_dir,
+            args.state_db,
+            blobless=args.blobless,
+        )
+    compact_metadata(args.records, args.index, args.output, args.per_cve_dir)
+    print(f"Processing complete. Results saved to {args.output}")
     print(f"Log file: commit_metadata.log")
@@ -0,0 +1,180 @@
+"""Pooled HTTP access for repository checks and remote downloads.
+
+One requests.Session with a connection pool is shared per process. Requests
+are retried with exponential backoff on connection errors, 429 and 5xx
+responses, repository existence is memoized per URL, and upcoming
+repositories can be checked ahead of time on a bounded thread pool while
+the current one is being processed.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class NetworkClient:
+    def __init__(
+        self,
+        max_workers=8,
+        timeout=30,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=60.0,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="network"
+        )
+        # Re-entrant: a check that finishes immediately records its result
+        # from inside _submit_check.
+        self._lock = threading.RLock()
+        self._exists = {}
+        self._pending = {}
+
+    def _sleep_before_retry(self, attempt, response=None):
+        delay = min(self.max_backoff, self.backoff * 2**attempt)
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = min(self.max_backoff, max(delay, int(retry_after)))
+        time.sleep(delay * (0.5 + random.random() / 2))
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying connection errors, 429 and 5xx with backoff.
+
+        Returns the last response; raises the last exception if every
+        attempt failed to connect.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"{method} {url} failed ({e}); retrying")
+                self._sleep_before_retry(attempt)
+                continue
+            status = response.status_code
+            if status not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            logging.warning(f"{method} {url} returned {status}; retrying")
+            self._sleep_before_retry(attempt, response)
+        return response
+
+    def _check_exists(self, repo_url):
+        parsed = urlparse(repo_url)
+        if parsed.scheme in ("", "file"):
+            return os.path.exists(parsed.path if parsed.scheme else repo_url)
+        try:
+            response = self.request("HEAD", repo_url, allow_redirects=False)
+            return response.status_code == 200
+        except Exception as e:
+            logging.error(f"Error checking repository {repo_url}: {str(e)}")
+            return False
+
+    def _submit_check(self, repo_url):
+        with self._lock:
+            if repo_url in self._exists:
+                return None
+            future = self._pending.get(repo_url)
+            if future is None:
+                future = self._executor.submit(self._check_exists, repo_url)
+                self._pending[repo_url] = future
+                future.add_done_callback(
+                    lambda f, url=repo_url: self._record(url, f)
+                )
+            return future
+
+    def _record(self, repo_url, future):
+        with self._lock:
+            self._pending.pop(repo_url, None)
+            self._exists[repo_url] = future.result()
+
+    def prefetch(self, repo_urls):
+        """Start existence checks for repositories that will be needed soon."""
+        for repo_url in repo_urls:
+            self._submit_check(repo_url)
+
+    def repo_exists(self, repo_url):
+        """Return whether repo_url exists, checking it at most once."""
+        future = self._submit_check(repo_url)
+        if future is not None:
+            return future.result()
+        with self._lock:
+            return self._exists[repo_url]
+
+    def fetch_text(self, url):
+        """GET url and return its body; raises requests.HTTPError on failure."""
+        response = self.request("GET", url)
+        response.raise_for_status()
+        return response.text
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_settings = {}
+
+
+def configure(**settings):
+    """Set NetworkClient options for the clients created from now on."""
+    global _client
+    _client_settings.clear()
+    _client_settings.update(settings)
+    _client = None
+
+
+def get_client():
+    """Return this process's shared client; forked workers get their own."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = NetworkClient(**_client_settings)
+        _client_pid = os.getpid()
+    return _client
+
+
+class Prefetcher:
+    """Keep existence checks running for the next few distinct repositories.
+
+    Call advance(index) as the rows are processed; it makes sure the
+    repositories of the next `ahead` distinct repo URLs after row index are
+    being checked in the background.
+    """
+
+    def __init__(self, repo_urls, ahead=8, client=None):
+        self.client = client or get_client()
+        self.ahead = ahead
+        self._row_repos = list(repo_urls)
+        self._order = []
+        self._first_index = {}
+        for repo_url in self._row_repos:
+            if repo_url not in self._first_index:
+                self._first_index[repo_url] = len(self._order)
+                self._order.append(repo_url)
+        self._submitted = 0
+
+    def advance(self, index):
+        position = self._first_index[self._row_repos[index]]
+        limit = min(len(self._order), position + 1 + self.ahead)
+        if self._submitted < limit:
+            self.client.prefetch(self._order[self._submitted : limit])
+            self._submitted = limit
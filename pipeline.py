@@ -0,0 +1,537 @@
+"""Run the whole pipeline in one process, streaming rows between stages.
+
+    commits.csv -> repo url -> parents -> blame -> clean -> metadata
+
+Each stage runs on its own thread(s) and hands rows to the next one
+through a bounded queue, so blame for one repository runs while the
+parents of the next are being resolved and memory stays bounded however
+large the input is. The intermediate CSVs of the script-by-script
+workflow are optional sinks, and every table can also be written as a
+columnar dataset (see columnar_store); progress is kept in the shared
+pipeline state, so the standalone scripts and this runner resume each
+other's work.
+"""
+import argparse
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+
+from tqdm import tqdm
+
+import columnar_store
+import get_blame_data
+import metadata_extractor
+import pipeline_state
+import tracing
+from clean_and_sort_blame_data import clean_and_sort_csv, clean_and_sort_dataset
+from get_parent_commits import resolve_repo_parents
+from get_repo_url import repo_url_from_commit_url
+from repo_store import RepoStore
+
+_DONE = object()
+
+BLAME_COLUMNS = ["malicious_files", "malicious_commit_hashes", "used_context_lines"]
+
+# Dataset written under --columnar-dir for each sink.
+DATASET_NAMES = {
+    "repo_url": "commits.cols",
+    "parents": "parents.cols",
+    "blame": "blame.cols",
+    "cleaned": "cleaned.cols",
+}
+METADATA_DATASET = "metadata.cols"
+METADATA_COLUMNS = [
+    "cve_id",
+    "project_name",
+    "hash",
+    "author",
+    "author_email",
+    "committed_date",
+    "message",
+    "files_changed",
+    "insertions",
+    "deletions",
+    "original_hash",
+    "malicious_files",
+]
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class CsvSink:
+    """Thread-safe CSV writer for one of the optional intermediate files.
+
+    Sinks of stages that only see new work append, so resumed runs extend
+    the earlier output; sinks every row passes through are rewritten.
+    write() returns a result pointer ("path#offset") to the written row.
+    """
+
+    def __init__(self, path, fieldnames, append=True):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a" if append else "w", newline="")
+        self._writer = csv.DictWriter(
+            self._file, fieldnames=fieldnames, extrasaction="ignore"
+        )
+        if self._file.tell() == 0:
+            self._writer.writeheader()
+
+    def write(self, row):
+        with self._lock:
+            offset = self._file.tell()
+            self._writer.writerow(row)
+            self._file.flush()
+        return pipeline_state.result_pointer(self.path, offset)
+
+    def close(self):
+        self._file.close()
+
+
+class ResultReader:
+    """Load a stage's earlier output row back from its result pointer."""
+
+    def __init__(self, id_column="commit_id"):
+        self.id_column = id_column
+        self._by_id = {}
+
+    def read(self, pointer, item_id):
+        if not pointer:
+            return None
+        path, _, offset = pointer.partition("#")
+        if not os.path.exists(path):
+            return None
+        if not offset:
+            # Seeded from a CSV written before offsets were recorded.
+            if path not in self._by_id:
+                with open(path, "r", newline="") as f:
+                    self._by_id[path] = {
+                        row[self.id_column]: row for row in csv.DictReader(f)
+                    }
+            return self._by_id[path].get(item_id)
+        with open(path, "r", newline="") as f:
+            fieldnames = next(csv.reader(f))
+            f.seek(int(offset))
+            values = next(csv.reader(f), None)
+        if values is None or len(values) != len(fieldnames):
+            return None
+        row = dict(zip(fieldnames, values))
+        return row if row.get(self.id_column) == item_id else None
+
+
+class Pipeline:
+    def __init__(
+        self,
+        state_path=pipeline_state.DEFAULT_PATH,
+        repo_cache_dir=get_blame_data.REPO_CACHE_DIR,
+        queue_size=64,
+        blame_workers=4,
+        parent_batch=32,
+        depth=None,
+        blame_options=None,
+        sinks=None,
+        records_file="commit_metadata.jsonl",
+        index_file="commit_index.jsonl",
+        columnar_dir=None,
+        blobless=False,
+    ):
+        self.state_path = state_path
+        self.store = RepoStore(repo_cache_dir, blobless=blobless)
+        # Blame clones through get_blame_data's store; keep both alike.
+        get_blame_data.configure_repo_store(repo_cache_dir, blobless=blobless)
+        self.queue_size = queue_size
+        self.blame_workers = blame_workers
+        self.parent_batch = parent_batch
+        self.depth = depth
+        self.blame_options = blame_options or {}
+        self.sink_paths = sinks or {}
+        self.records_file = records_file
+        self.index_file = index_file
+        self.columnar_dir = columnar_dir
+        self.sinks = {}
+        self.column_sinks = {}
+        self.counts = {}
+        self._counts_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._errors = []
+
+    # -- plumbing ---------------------------------------------------------
+
+    def _count(self, name, n=1):
+        with self._counts_lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        raise PipelineAborted()
+
+    def _get(self, q, timeout=0.5):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=timeout)
+            except queue.Empty:
+                continue
+        raise PipelineAborted()
+
+    def _run_stage(self, name, target, *args):
+        def run():
+            try:
+                target(*args)
+            except PipelineAborted:
+                pass
+            except BaseException as e:
+                logging.exception(f"Pipeline stage {name} failed")
+                self._errors.append(e)
+                self._stop.set()
+
+        thread = threading.Thread(target=run, name=f"pipeline-{name}", daemon=True)
+        thread.start()
+        return thread
+
+    def _sink(self, name, row):
+        column_sink = self.column_sinks.get(name)
+        if column_sink is not None:
+            column_sink.write(row)
+        sink = self.sinks.get(name)
+        return sink.write(row) if sink is not None else None
+
+    # -- stages -----------------------------------------------------------
+
+    def read_commits(self, input_file, parents_q, clean_q):
+        """Source: add repo URLs and route each row to the first stage it needs.
+
+        Rows whose blame is already done are re-read from the blame output
+        and go straight to cleaning; rows that failed before are skipped
+        until they are retried.
+        """
+        blame_stage = pipeline_state.STAGE_BLAME
+        results = ResultReader()
+        with pipeline_state.PipelineState(self.state_path) as state, open(
+            input_file, "r", newline=""
+        ) as in_f:
+            for row in csv.DictReader(in_f):
+                row["repo_url"] = repo_url_from_commit_url(row["commit_url"])
+                self._sink("repo_url", row)
+                self._count("read")
+                commit_id = row["commit_id"]
+                status = state.status(blame_stage, commit_id)
+                if status == pipeline_state.FAILED:
+                    self._count("finished")
+                    continue
+                if status == pipeline_state.DONE:
+                    pointer = state.result(blame_stage, commit_id)
+                    blamed = results.read(pointer, commit_id)
+                    if blamed is not None:
+                        self._count("resumed")
+                        self._put(clean_q, blamed)
+                        continue
+                state.register(blame_stage, [commit_id])
+                self._put(parents_q, row)
+        self._put(parents_q, _DONE)
+
+    def resolve_parents(self, parents_q, blame_q):
+        """Resolve parents in batches of whatever rows are already queued."""
+        stage = pipeline_state.STAGE_PARENTS
+        finished = False
+        with pipeline_state.PipelineState(self.state_path) as state:
+            while not finished:
+                batch = [self._get(parents_q)]
+                while len(batch) < self.parent_batch:
+                    try:
+                        batch.append(parents_q.get_nowait())
+                    except queue.Empty:
+                        break
+                if _DONE in batch:
+                    batch = [row for row in batch if row is not _DONE]
+                    finished = True
+
+                by_repo = {}
+                for row in batch:
+                    by_repo.setdefault(row["repo_url"], []).append(row)
+                for repo_url, rows in by_repo.items():
+                    try:
+                        parents = resolve_repo_parents(
+                            self.store, repo_url, [row["commit_id"] for row in rows], self.depth
+                        )
+                    except Exception as e:
+                        logging.error(f"Error processing {repo_url}: {str(e)}")
+                        parents = {}
+                    for row in rows:
+                        commit_id = row["commit_id"]
+                        row["parent_commit_id"] = parents.get(commit_id)
+                        pointer = self._sink("parents", row)
+                        if row["parent_commit_id"] is None:
+                            self._count("finished")
+                            state.mark_failed(
+                                stage, commit_id, "parent_not_found", repo_url
+                            )
+                            state.mark_failed(
+                                pipeline_state.STAGE_BLAME,
+                                commit_id,
+                                "parent_not_found",
+                                "No parent commit to blame against",
+                            )
+                            continue
+                        state.mark_done(stage, commit_id, pointer)
+                        self._count("parents")
+                        self._put(blame_q, row)
+        for _ in range(self.blame_workers):
+            self._put(blame_q, _DONE)
+
+    def blame(self, blame_q, clean_q, remaining):
+        """Blame rows from bare mirrors; several workers share the queue."""
+        stage = pipeline_state.STAGE_BLAME
+        with pipeline_state.PipelineState(self.state_path) as state:
+            while True:
+                row = self._get(blame_q)
+                if row is _DONE:
+                    break
+                commit_id = row["commit_id"]
+                state.mark_started(stage, commit_id)
+                repo_path = get_blame_data.get_repo_path(row["repo_url"], bare=True)
+                result, error_class, error = get_blame_data.try_process_commit(
+                    row, repo_path, checkout=False, **self.blame_options
+                )
+                if result is None:
+                    state.mark_failed(stage, commit_id, error_class, error)
+                    self._count("finished")
+                    continue
+                state.mark_done(stage, commit_id, self._sink("blame", result))
+                self._count("blamed")
+                self._put(clean_q, result)
+        # The last worker to finish closes the stream.
+        with remaining["lock"]:
+            remaining["workers"] -= 1
+            last = remaining["workers"] == 0
+        if last:
+            self._put(clean_q, _DONE)
+
+    def clean(self, clean_q, metadata_q):
+        """Keep rows that have both malicious files and malicious hashes."""
+        while True:
+            row = self._get(clean_q)
+            if row is _DONE:
+                break
+            if row.get("malicious_files") and row.get("malicious_commit_hashes"):
+                self._sink("cleaned", row)
+                self._count("cleaned")
+                self._put(metadata_q, row)
+            else:
+                self._count("finished")
+        self._put(metadata_q, _DONE)
+
+    def extract_metadata(self, metadata_q):
+        processed = metadata_extractor.load_processed_hashes(self.records_file)
+        with pipeline_state.PipelineState(
+            self.state_path
+        ) as state, metadata_extractor.MetadataIndex(
+            self.index_file
+        ) as index, metadata_extractor.open_append(
+            self.records_file
+        ) as out_f:
+            while True:
+                row = self._get(metadata_q)
+                if row is _DONE:
+                    break
+                commit_hashes = metadata_extractor.row_hashes(row)
+                pending = metadata_extractor.pending_hashes(commit_hashes, index, state)
+                if pending:
+                    metadata_extractor.describe_commits(
+                        self.store, state, index, row["repo_url"], pending
+                    )
+                metadata_extractor.record_row(out_f, row, index, processed)
+                self._count("finished")
+
+    # -- driver -----------------------------------------------------------
+
+    def _open_sinks(self, input_fieldnames):
+        fieldnames = {
+            "repo_url": input_fieldnames + ["repo_url"],
+            "parents": input_fieldnames + ["repo_url", "parent_commit_id"],
+        }
+        fieldnames["blame"] = fieldnames["parents"] + BLAME_COLUMNS
+        fieldnames["cleaned"] = fieldnames["blame"]
+        for name, path in self.sink_paths.items():
+            if path:
+                append = name in ("parents", "blame")
+                self.sinks[name] = CsvSink(path, fieldnames[name], append)
+        if self.columnar_dir:
+            for name, dataset_name in DATASET_NAMES.items():
+                append = name in ("parents", "blame")
+                self.column_sinks[name] = columnar_store.ColumnarWriter(
+                    os.path.join(self.columnar_dir, dataset_name),
+                    fieldnames[name],
+                    replace=not append,
+                )
+
+    def _close_sinks(self):
+        for sink in self.sinks.values():
+            sink.close()
+        for name, column_sink in self.column_sinks.items():
+            if self._errors and column_sink.replace:
+                # A partial rewrite would replace the complete earlier table.
+                column_sink.abort()
+            else:
+                column_sink.close()
+
+    def run(self, input_file):
+        with open(input_file, "r", newline="") as f:
+            input_fieldnames = next(csv.reader(f))
+        with pipeline_state.PipelineState(self.state_path) as state:
+            if self.sink_paths.get("blame"):
+                state.seed_from_csv(pipeline_state.STAGE_BLAME, self.sink_paths["blame"])
+            total = state.count_rows(input_file)
+        self._open_sinks(input_fieldnames)
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(4)]
+        parents_q, blame_q, clean_q, metadata_q = queues
+        remaining = {"lock": threading.Lock(), "workers": self.blame_workers}
+        threads = [
+            self._run_stage("read", self.read_commits, input_file, parents_q, clean_q),
+            self._run_stage("parents", self.resolve_parents, parents_q, blame_q),
+            *(
+                self._run_stage(f"blame-{i}", self.blame, blame_q, clean_q, remaining)
+                for i in range(self.blame_workers)
+            ),
+            self._run_stage("clean", self.clean, clean_q, metadata_q),
+            self._run_stage("metadata", self.extract_metadata, metadata_q),
+        ]
+
+        with tqdm(total=total, desc="Pipeline", unit="commit") as pbar:
+            try:
+                while any(thread.is_alive() for thread in threads):
+                    threads[-1].join(timeout=1)
+                    with self._counts_lock:
+                        counts = dict(self.counts)
+                    pbar.n = counts.get("finished", 0)
+                    pbar.set_postfix(
+                        {key: counts.get(key, 0) for key in ("parents", "blamed", "cleaned")}
+                    )
+            except BaseException as e:
+                # e.g. KeyboardInterrupt: stop the stage threads too.
+                self._stop.set()
+                self._errors.append(e)
+                raise
+            finally:
+                self._close_sinks()
+
+        if self._errors:
+            raise self._errors[0]
+        # Same ordering as clean_and_sort_blame_data.py.
+        if "cleaned" in self.sinks:
+            clean_and_sort_csv(self.sink_paths["cleaned"], self.sink_paths["cleaned"])
+        if "cleaned" in self.column_sinks:
+            cleaned_path = self.column_sinks["cleaned"].path
+            clean_and_sort_dataset(cleaned_path, cleaned_path)
+        get_blame_data.log_cache_stats()
+        logging.info(f"Pipeline finished: {self.counts}")
+        return self.counts
+
+
+def write_metadata_dataset(commit_data, path):
+    """Flatten compacted {cve_id: {project: [metadata]}} into a dataset."""
+
+    def rows():
+        for cve_id, projects in commit_data.items():
+            for project_name, commits in projects.items():
+                for metadata in commits:
+                    yield {"cve_id": cve_id, "project_name": project_name, **metadata}
+
+    return columnar_store.write_dataset(path, METADATA_COLUMNS, rows())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename="pipeline.log",
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(threadName)s - %(message)s",
+        force=True,
+    )
+    parser = argparse.ArgumentParser(
+        description="Run repo url, parents, blame, cleaning and metadata as one stream."
+    )
+    parser.add_argument("--input", default="commits.csv")
+    parser.add_argument("--state-db", default=pipeline_state.DEFAULT_PATH)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--blame-workers", type=int, default=4)
+    parser.add_argument(
+        "--parent-batch",
+        type=int,
+        default=32,
+        help="most queued rows whose parents are resolved together",
+    )
+    parser.add_argument("--depth", type=int, default=None)
+    parser.add_argument("--hunks", action="store_true")
+    parser.add_argument("--padding", type=int, default=0)
+    parser.add_argument("--remote-patches", action="store_true")
+    parser.add_argument("--early-stop", action="store_true")
+    parser.add_argument(
+        "--blobless",
+        action="store_true",
+        help="clone without blobs and fetch only the files diffed and blamed",
+    )
+    parser.add_argument("--repo-url-output", help="e.g. commits_with_repo_url.csv")
+    parser.add_argument("--parents-output", help="e.g. commits_with_parent_ids.csv")
+    parser.add_argument(
+        "--blame-output",
+        default="commits_with_blame_data.csv",
+        help="also lets later runs resume without blaming again",
+    )
+    parser.add_argument(
+        "--cleaned-output", help="e.g. commits_with_blame_data_cleaned_sorted.csv"
+    )
+    parser.add_argument("--records", default="commit_metadata.jsonl")
+    parser.add_argument("--index", default="commit_index.jsonl")
+    parser.add_argument("--metadata-output", default="commit_metadata.json")
+    parser.add_argument("--per-cve-dir")
+    parser.add_argument(
+        "--columnar-dir",
+        help="also write commits, parents, blame, cleaned and metadata datasets here",
+    )
+    tracing.add_arguments(parser, "pipeline_metrics.json")
+    args = parser.parse_args()
+    tracing.configure_from_args(args)
+
+    pipeline = Pipeline(
+        state_path=args.state_db,
+        queue_size=args.queue_size,
+        blame_workers=args.blame_workers,
+        parent_batch=args.parent_batch,
+        depth=args.depth,
+        blame_options={
+            "hunks": args.hunks,
+            "padding": args.padding,
+            "local_patches": not args.remote_patches,
+            "early_stop": args.early_stop,
+        },
+        sinks={
+            "repo_url": args.repo_url_output,
+            "parents": args.parents_output,
+            "blame": args.blame_output,
+            "cleaned": args.cleaned_output,
+        },
+        records_file=args.records,
+        index_file=args.index,
+        columnar_dir=args.columnar_dir,
+        blobless=args.blobless,
+    )
+    start_time = time.time()
+    counts = pipeline.run(args.input)
+    commit_data = metadata_extractor.compact_metadata(
+        args.records, args.index, args.metadata_output, args.per_cve_dir
+    )
+    if args.columnar_dir:
+        write_metadata_dataset(
+            commit_data, os.path.join(args.columnar_dir, METADATA_DATASET)
+        )
+    print(f"Pipeline finished in {time.time() - start_time:.1f} seconds: {counts}")
+    print(f"Metadata saved to {args.metadata_output}")
@@ -0,0 +1,290 @@
+"""Shared SQLite store of per-commit, per-stage pipeline progress.
+
+Every stage records each item it handles (a commit id for get_parent_commits
+and get_blame_data, a commit hash for metadata_extractor) with a status,
+timestamps, the class of the error that stopped it and a pointer to its
+result, e.g. "commits_with_blame_data.csv#1834" for the byte offset of the
+output row. Restarts look items up by primary key instead of re-reading
+whole output CSVs, failed items stay failed until they are explicitly
+retried by error class, and "what is left" is a single query:
+
+    python pipeline_state.py status
+    python pipeline_state.py retry blame --error-class parent_not_found
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+DEFAULT_PATH = "pipeline_state.sqlite"
+
+STAGE_PARENTS = "parents"
+STAGE_BLAME = "blame"
+STAGE_METADATA = "metadata"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    stage TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error_class TEXT,
+    error TEXT,
+    result TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (stage, item_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_status ON items (stage, status, error_class);
+CREATE TABLE IF NOT EXISTS input_counts (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    row_count INTEGER NOT NULL
+);
+"""
+
+
+class PipelineState:
+    def __init__(self, path=DEFAULT_PATH, timeout=60):
+        self.path = path
+        # Autocommit mode; transaction() groups statements explicitly.
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        if self.conn.in_transaction:
+            yield self.conn
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def register(self, stage, item_ids):
+        """Add items as pending unless the stage already knows them."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (stage, item_id, status, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                ((stage, item_id, PENDING, now) for item_id in item_ids),
+            )
+
+    def status(self, stage, item_id):
+        row = self.conn.execute(
+            "SELECT status FROM items WHERE stage = ? AND item_id = ?",
+            (stage, item_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def result(self, stage, item_id):
+        row = self.conn.execute(
+            "SELECT result FROM items WHERE stage = ? AND item_id = ?",
+            (stage, item_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def is_processed(self, stage, item_id):
+        """True once an item is done or has failed and was not retried since."""
+        return self.status(stage, item_id) in (DONE, FAILED)
+
+    def has_items(self, stage):
+        row = self.conn.execute(
+            "SELECT 1 FROM items WHERE stage = ? LIMIT 1", (stage,)
+        ).fetchone()
+        return row is not None
+
+    def _upsert(self, stage, item_id, status, **columns):
+        now = time.time()
+        assignments = ", ".join(f"{name} = :{name}" for name in columns)
+        params = {"stage": stage, "item_id": item_id, "status": status, "now": now}
+        params.update(columns)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO items (stage, item_id, status, created_at) "
+                "VALUES (:stage, :item_id, :status, :now)",
+                params,
+            )
+            conn.execute(
+                f"UPDATE items SET status = :status, {assignments} "
+                "WHERE stage = :stage AND item_id = :item_id",
+                params,
+            )
+
+    def mark_started(self, stage, item_id):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO items (stage, item_id, status, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (stage, item_id, PENDING, now),
+            )
+            conn.execute(
+                "UPDATE items SET status = ?, attempts = attempts + 1, started_at = ? "
+                "WHERE stage = ? AND item_id = ?",
+                (RUNNING, now, stage, item_id),
+            )
+
+    def mark_done(self, stage, item_id, result=None):
+        self._upsert(
+            stage,
+            item_id,
+            DONE,
+            result=result,
+            error_class=None,
+            error=None,
+            finished_at=time.time(),
+        )
+
+    def mark_failed(self, stage, item_id, error_class, error=None):
+        self._upsert(
+            stage,
+            item_id,
+            FAILED,
+            error_class=error_class,
+            error=error,
+            finished_at=time.time(),
+        )
+
+    def retry(self, stage, error_classes=None):
+        """Reset failed (and interrupted) items to pending; returns how many.
+
+        With error_classes, only failures of those classes are reset.
+        """
+        query = "UPDATE items SET status = ? WHERE stage = ? AND (status = ?"
+        params = [PENDING, stage, RUNNING]
+        if error_classes:
+            placeholders = ", ".join("?" for _ in error_classes)
+            query += f" OR (status = ? AND error_class IN ({placeholders})))"
+            params += [FAILED, *error_classes]
+        else:
+            query += " OR status = ?)"
+            params.append(FAILED)
+        with self.transaction() as conn:
+            return conn.execute(query, params).rowcount
+
+    def remaining(self, stage):
+        """Return the ids of the items of a stage that are not done yet."""
+        return [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT item_id FROM items WHERE stage = ? AND status != ?",
+                (stage, DONE),
+            )
+        ]
+
+    def summary(self):
+        """Return {stage: {status: count}} for every stage."""
+        counts = {}
+        for stage, status, count in self.conn.execute(
+            "SELECT stage, status, COUNT(*) FROM items GROUP BY stage, status"
+        ):
+            counts.setdefault(stage, {})[status] = count
+        return counts
+
+    def failures(self, stage):
+        """Return {error_class: count} for the failed items of a stage."""
+        return dict(
+            self.conn.execute(
+                "SELECT error_class, COUNT(*) FROM items "
+                "WHERE stage = ? AND status = ? GROUP BY error_class",
+                (stage, FAILED),
+            ).fetchall()
+        )
+
+    def count_rows(self, csv_path):
+        """Return the number of data rows of a CSV, cached by size and mtime."""
+        stat = os.stat(csv_path)
+        key = os.path.abspath(csv_path)
+        row = self.conn.execute(
+            "SELECT size, mtime, row_count FROM input_counts WHERE path = ?", (key,)
+        ).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2]
+        with open(csv_path, "r", newline="") as f:
+            row_count = sum(1 for _ in csv.DictReader(f))
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO input_counts VALUES (?, ?, ?, ?)",
+                (key, stat.st_size, stat.st_mtime, row_count),
+            )
+        return row_count
+
+    def seed_from_csv(self, stage, csv_path, id_column="commit_id"):
+        """Mark the ids already present in an existing output CSV as done.
+
+        Only needed once, to pick up output written before the state store
+        existed; does nothing if the stage already has items.
+        """
+        if self.has_items(stage) or not os.path.exists(csv_path):
+            return 0
+        now = time.time()
+        seeded = 0
+        with self.transaction() as conn, open(csv_path, "r", newline="") as f:
+            for row in csv.DictReader(f):
+                conn.execute(
+                    "INSERT OR IGNORE INTO items "
+                    "(stage, item_id, status, result, created_at, finished_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (stage, row[id_column], DONE, csv_path, now, now),
+                )
+                seeded += 1
+        return seeded
+
+
+def result_pointer(path, offset=None):
+    return path if offset is None else f"{path}#{offset}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or reset pipeline progress.")
+    parser.add_argument("--db", default=DEFAULT_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="count items per stage, status and error")
+    retry_parser = subparsers.add_parser("retry", help="reset failed items to pending")
+    retry_parser.add_argument("stage")
+    retry_parser.add_argument(
+        "--error-class",
+        action="append",
+        dest="error_classes",
+        help="only retry failures of this class (repeatable)",
+    )
+    remaining_parser = subparsers.add_parser("remaining", help="list unfinished items")
+    remaining_parser.add_argument("stage")
+    args = parser.parse_args()
+
+    with PipelineState(args.db) as state:
+        if args.command == "status":
+            for stage, counts in sorted(state.summary().items()):
+                print(f"{stage}: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+                for error_class, count in sorted(state.failures(stage).items()):
+                    print(f"    {error_class}: {count}")
+        elif args.command == "retry":
+            print(f"Reset {state.retry(args.stage, args.error_classes)} items to pending")
+        elif args.command == "remaining":
+            for item_id in state.remaining(args.stage):
+                print(item_id)
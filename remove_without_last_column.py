@@ -1,7 +1,12 @@
 import csv
 
+import columnar_store
+
 
 def remove_rows_with_empty_last_column(input_file, output_file):
+    if columnar_store.is_dataset(input_file):
+        return remove_rows_with_empty_last_column_dataset(input_file, output_file)
+
     rows_processed = 0
     rows_removed = 0
 
@@ -25,14 +30,29 @@ def remove_rows_with_empty_last_column(input_file, output_file):
     return rows_processed, rows_removed
 
 
-# Usage
-input_file = "commits_with_parent_ids.csv"
-output_file = "final_output.csv"
-
-rows_processed, rows_removed = remove_rows_with_empty_last_column(
-    input_file, output_file
-)
-
-print(f"Total rows processed: {rows_processed}")
-print(f"Rows removed (empty last column): {rows_removed}")
-print(f"Rows in final output: {rows_processed - rows_removed}")
+def remove_rows_with_empty_last_column_dataset(input_path, output_file):
+    """Same as above for a columnar dataset; the filter reads one column."""
+    dataset = columnar_store.ColumnarDataset(input_path)
+    where = {dataset.columns[-1]: lambda value: bool(value and value.strip())}
+    rows_processed = len(dataset)
+    if output_file.endswith(".cols"):
+        rows_kept = columnar_store.write_dataset(
+            output_file, dataset.columns, dataset.read(where=where)
+        )
+    else:
+        rows_kept = dataset.to_csv(output_file, where=where)
+    return rows_processed, rows_processed - rows_kept
+
+
+if __name__ == "__main__":
+    # Usage
+    input_file = "commits_with_parent_ids.csv"
+    output_file = "final_output.csv"
+
+    rows_processed, rows_removed = remove_rows_with_empty_last_column(
+        input_file, output_file
+    )
+
+    print(f"Total rows processed: {rows_processed}")
+    print(f"Rows removed (empty last column): {rows_removed}")
+    print(f"Rows in final output: {rows_processed - rows_removed}")
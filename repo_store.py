@@ -0,0 +1,395 @@
+"""Shared store of mirror clones used by every pipeline stage.
+
+Repositories live under <root>/<owner>/<name>.git as `git clone --mirror`
+copies, so two projects with the same name never collide and a repository
+cloned by get_parent_commits is reused by get_blame_data and
+metadata_extractor. Clones and fetches take a per-repository file lock, so
+concurrent workers asking for the same repository wait for a single fetch
+instead of each running their own. An optional disk budget evicts the
+least recently used repositories, skipping any that a stage holds with
+in_use(). The size of each repository is recorded next to it whenever a
+clone or fetch changes it, so checking the budget never walks the store.
+
+A blobless store clones with `--filter=blob:none`: commits and trees
+only, with file contents fetched from the remote when a stage needs them
+(see git_backend.GitRepository.prefetch_blobs). Servers that do not
+support filtering get a complete clone instead. A blobless mirror has no
+use for a working copy, which would need every blob of the tree.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import tracing
+
+DEFAULT_ROOT = "repo_cache"
+LAST_USED_FILE = "pipeline-last-used"
+LAST_FETCH_FILE = "pipeline-last-fetch"
+SIZE_FILE = "pipeline-size"
+
+GIT_ENV = {
+    # Never block on a credential prompt for private or deleted repositories.
+    "GIT_TERMINAL_PROMPT": "0",
+    "GIT_ASKPASS": "echo",
+    "GIT_SSH_COMMAND": "ssh -o BatchMode=yes",
+}
+
+BLOBLESS_FILTER = "blob:none"
+
+
+def repo_key(repo_url):
+    """Return "owner/name" for a repository URL or local path."""
+    parsed = urlparse(repo_url)
+    path = parsed.path if parsed.scheme else repo_url
+    parts = [part for part in path.split("/") if part]
+    if not parts:
+        raise ValueError(f"Cannot derive a repository name from {repo_url!r}")
+    name = parts[-1]
+    if name.endswith(".git"):
+        name = name[: -len(".git")]
+    owner = parts[-2] if len(parts) > 1 else "_"
+    return f"{owner}/{name}"
+
+
+def run_git(args, cwd=None, check=True, input=None):
+    with tracing.span(f"git.{args[0]}") as span:
+        result = subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            check=check,
+            input=input,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env={**os.environ, **GIT_ENV},
+        )
+        span.bytes_read = len(result.stdout)
+        span.status = result.returncode
+    return result
+
+
+def directory_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def clean_stale_locks(repo_path):
+    """Remove git lock files left behind by a crashed run.
+
+    Only call this while holding the store lock of the repository, when no
+    other git process can be using it.
+    """
+    for lock_name in ("index.lock", "shallow.lock", "packed-refs.lock", "config.lock"):
+        lock_path = os.path.join(repo_path, lock_name)
+        if os.path.exists(lock_path):
+            try:
+                os.remove(lock_path)
+            except OSError as e:
+                logging.error(f"Failed to remove lock file {lock_path}: {str(e)}")
+
+
+def _touch(path):
+    with open(path, "a"):
+        pass
+    os.utime(path)
+
+
+class RepoStore:
+    def __init__(self, root=DEFAULT_ROOT, max_bytes=None, fetch_interval=3600, blobless=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        # Only affects new clones; existing mirrors keep what they have.
+        self.blobless = blobless
+        # A repository fetched less than fetch_interval seconds ago is not
+        # fetched again, whichever stage or worker did the fetch.
+        self.fetch_interval = fetch_interval
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, repo_url):
+        return os.path.join(self.root, repo_key(repo_url) + ".git")
+
+    def worktree_path(self, repo_url):
+        return os.path.join(self.root, "worktrees", repo_key(repo_url))
+
+    def _lock_path(self, repo_url):
+        return os.path.join(self.root, repo_key(repo_url) + ".lock")
+
+    def _use_lock_path(self, repo_url):
+        return os.path.join(self.root, repo_key(repo_url) + ".use")
+
+    @staticmethod
+    @contextmanager
+    def _flock(lock_path, flags):
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def lock(self, repo_url, blocking=True):
+        """Hold the per-repository lock; yields False if non-blocking and busy."""
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        with self._flock(self._lock_path(repo_url), flags) as acquired:
+            yield acquired
+
+    @contextmanager
+    def in_use(self, repo_url):
+        """Keep evict() from removing the mirror and working copy of repo_url meanwhile.
+
+        Any number of workers may hold a repository at once. This is a
+        separate lock from lock(), so a holder can still clone or fetch.
+        """
+        with self._flock(self._use_lock_path(repo_url), fcntl.LOCK_SH):
+            yield
+
+    def _record_size(self, repo_path):
+        """Measure a mirror and its working copy and record the total; returns the growth.
+
+        Call with the repository's lock held, after a clone or fetch. A
+        working copy is counted as it was at the time.
+        """
+        key = os.path.relpath(repo_path, self.root)[: -len(".git")]
+        size = directory_size(repo_path) + directory_size(self.worktree_path(key))
+        size_path = os.path.join(repo_path, SIZE_FILE)
+        try:
+            with open(size_path) as f:
+                previous = int(f.read())
+        except (FileNotFoundError, ValueError):
+            previous = 0
+        with open(size_path, "w") as f:
+            f.write(str(size))
+        return size - previous
+
+    def _recorded_size(self, repo_path):
+        try:
+            with open(os.path.join(repo_path, SIZE_FILE)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            pass
+        # A mirror from before sizes were recorded, or one just evicted.
+        with self.lock(os.path.relpath(repo_path, self.root)[: -len(".git")]):
+            if not os.path.isdir(repo_path):
+                return 0
+            return self._record_size(repo_path)
+
+    def stored_bytes(self):
+        """Return the recorded size of the store, reading no repository contents."""
+        return sum(self._recorded_size(repo_path) for repo_path, _ in self.repositories())
+
+    def _grew(self, repo_path, growth):
+        """Evict other repositories if growth took the store past max_bytes."""
+        if self.max_bytes is not None and growth > 0 and self.stored_bytes() > self.max_bytes:
+            self.evict(keep=repo_path)
+
+    def _fetched_since(self, repo_path, since):
+        try:
+            return os.path.getmtime(os.path.join(repo_path, LAST_FETCH_FILE)) >= since
+        except FileNotFoundError:
+            return False
+
+    def ensure(self, repo_url, fetch=False, depth=None):
+        """Return the path of an up-to-date mirror of repo_url, or None.
+
+        Missing repositories are cloned, shallowly if depth is given. A
+        shallow mirror requested without a depth is unshallowed, since the
+        caller needs full history. With fetch=True an existing mirror is
+        fetched, unless another caller fetched it while we waited for the
+        lock or within the last fetch_interval seconds.
+        """
+        repo_path = self.path_for(repo_url)
+        requested_at = time.time()
+        growth = 0
+        try:
+            with self.lock(repo_url):
+                if not os.path.exists(repo_path):
+                    self._clone(repo_url, repo_path, depth)
+                    growth = self._record_size(repo_path)
+                else:
+                    clean_stale_locks(repo_path)
+                    if depth is None and self.is_shallow(repo_path):
+                        logging.info(f"Unshallowing {repo_url}")
+                        run_git(
+                            ["fetch", "--unshallow", "--quiet", "origin"], cwd=repo_path
+                        )
+                        growth = self._record_size(repo_path)
+                    fetched_after = min(requested_at, time.time() - self.fetch_interval)
+                    if fetch and not self._fetched_since(repo_path, fetched_after):
+                        self._fetch(repo_url, repo_path)
+                        growth += self._record_size(repo_path)
+                _touch(os.path.join(repo_path, LAST_USED_FILE))
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Could not clone or fetch {repo_url}: {e.stderr}")
+            return None
+
+        self._grew(repo_path, growth)
+        return repo_path
+
+    def _clone(self, repo_url, repo_path, depth=None):
+        logging.info(f"Cloning mirror of {repo_url} into {repo_path}")
+        os.makedirs(os.path.dirname(repo_path), exist_ok=True)
+        tmp_path = repo_path + ".partial"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        command = ["clone", "--mirror", "--quiet"]
+        if depth is not None:
+            command += ["--depth", str(depth)]
+        if self.blobless:
+            command += [f"--filter={BLOBLESS_FILTER}"]
+        if (depth is not None or self.blobless) and "://" not in repo_url:
+            # --depth and --filter are ignored for plain local paths.
+            repo_url = "file://" + os.path.abspath(repo_url)
+        try:
+            result = run_git(command + [repo_url, tmp_path])
+            if self.blobless and "filtering not recognized by server" in result.stderr:
+                # git fell back to a complete clone but still marks the
+                # remote as a promisor; unmark it so the mirror is treated
+                # as complete.
+                logging.info(f"{repo_url} does not support filtering; cloned it in full")
+                for key in ("remote.origin.promisor", "remote.origin.partialclonefilter"):
+                    run_git(["config", "--unset", key], cwd=tmp_path, check=False)
+        except subprocess.CalledProcessError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        os.replace(tmp_path, repo_path)
+        _touch(os.path.join(repo_path, LAST_FETCH_FILE))
+
+    def _fetch(self, repo_url, repo_path):
+        logging.info(f"Fetching {repo_url}")
+        run_git(["fetch", "--prune", "--quiet", "origin"], cwd=repo_path)
+        _touch(os.path.join(repo_path, LAST_FETCH_FILE))
+
+    @staticmethod
+    def is_shallow(repo_path):
+        return os.path.exists(os.path.join(repo_path, "shallow"))
+
+    @staticmethod
+    def is_partial(repo_path):
+        """Whether repo_path is a partial clone whose objects may be fetched lazily."""
+        result = run_git(
+            ["config", "--bool", "--get", "remote.origin.promisor"], cwd=repo_path, check=False
+        )
+        return result.stdout.strip() == "true"
+
+    @staticmethod
+    def shallow_commits(repo_path):
+        """Return the boundary commits of a shallow mirror, whose parents are cut off."""
+        try:
+            with open(os.path.join(repo_path, "shallow")) as f:
+                return set(f.read().split())
+        except FileNotFoundError:
+            return set()
+
+    def deepen(self, repo_url, depth=None):
+        """Deepen a shallow mirror by depth commits, or unshallow it if depth is None."""
+        repo_path = self.path_for(repo_url)
+        if depth is None:
+            command = ["fetch", "--unshallow", "--quiet", "origin"]
+        else:
+            command = ["fetch", f"--deepen={depth}", "--quiet", "origin"]
+        try:
+            with self.lock(repo_url):
+                logging.info(f"Deepening {repo_url} by {depth or 'everything'}")
+                run_git(command, cwd=repo_path)
+                growth = self._record_size(repo_path)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Could not deepen {repo_url}: {e.stderr}")
+            return False
+        self._grew(repo_path, growth)
+        return True
+
+    def fetch_revisions(self, repo_url, revisions):
+        """Fetch specific commits by SHA, e.g. ones no branch or tag reaches."""
+        repo_path = self.path_for(repo_url)
+        try:
+            with self.lock(repo_url):
+                logging.info(f"Fetching {len(revisions)} commits by SHA from {repo_url}")
+                run_git(["fetch", "--quiet", "origin", *revisions], cwd=repo_path)
+                growth = self._record_size(repo_path)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Could not fetch commits from {repo_url}: {e.stderr}")
+            return False
+        self._grew(repo_path, growth)
+        return True
+
+    def working_copy(self, repo_url):
+        """Return a checkout of repo_url that borrows its objects from the mirror."""
+        repo_path = self.ensure(repo_url)
+        if repo_path is None:
+            return None
+        if self.is_partial(repo_path):
+            raise ValueError(f"{repo_path} is a blobless mirror; blame it without a checkout")
+        worktree_path = self.worktree_path(repo_url)
+        if not os.path.exists(worktree_path):
+            with self.lock(repo_url):
+                if not os.path.exists(worktree_path):
+                    os.makedirs(os.path.dirname(worktree_path), exist_ok=True)
+                    run_git(
+                        [
+                            "clone",
+                            "--shared",
+                            "--no-checkout",
+                            "--quiet",
+                            os.path.abspath(repo_path),
+                            worktree_path,
+                        ]
+                    )
+        return worktree_path
+
+    def repositories(self):
+        """Yield (repo_path, last_used) for every mirror in the store."""
+        for owner in os.listdir(self.root):
+            owner_path = os.path.join(self.root, owner)
+            if owner == "worktrees" or not os.path.isdir(owner_path):
+                continue
+            for name in os.listdir(owner_path):
+                repo_path = os.path.join(owner_path, name)
+                if not name.endswith(".git") or not os.path.isdir(repo_path):
+                    continue
+                try:
+                    last_used = os.path.getmtime(os.path.join(repo_path, LAST_USED_FILE))
+                except FileNotFoundError:
+                    last_used = 0
+                yield repo_path, last_used
+
+    def evict(self, keep=None):
+        """Remove least recently used mirrors until the store fits max_bytes.
+
+        Sizes are the ones recorded at each repository's last clone or fetch.
+        """
+        repos = sorted(self.repositories(), key=lambda repo: repo[1])
+        sizes = {repo_path: self._recorded_size(repo_path) for repo_path, _ in repos}
+        worktrees = os.path.join(self.root, "worktrees")
+        total = sum(sizes.values())
+
+        for repo_path, _ in repos:
+            if total <= self.max_bytes:
+                break
+            if repo_path == keep:
+                continue
+            key = os.path.relpath(repo_path, self.root)[: -len(".git")]
+            use_lock = self._flock(self._use_lock_path(key), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with self.lock(key, blocking=False) as acquired, use_lock as unused:
+                if not acquired or not unused:
+                    continue
+                worktree_path = os.path.join(worktrees, key)
+                total -= sizes[repo_path]
+                logging.info(f"Evicting {repo_path} from the repository store")
+                shutil.rmtree(worktree_path, ignore_errors=True)
+                shutil.rmtree(repo_path, ignore_errors=True)
@@ -0,0 +1,127 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+class ResultCache:
+    """Content-addressed on-disk cache for patches and blame results.
+
+    Entries are keyed by a hash of their key parts (for example repository,
+    commit, path and blame options), stored gzip-compressed under
+    <root>/<namespace>/<xx>/<hash>.gz and written atomically, so a crash
+    never leaves a truncated entry behind. Once the cache grows past
+    max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = self._disk_usage()
+
+    @staticmethod
+    def make_key(*parts):
+        encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def _path(self, namespace, key):
+        return os.path.join(self.root, namespace, key[:2], key + ".gz")
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".gz"):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat
+
+    def _disk_usage(self):
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def get_bytes(self, namespace, *key_parts):
+        path = self._path(namespace, self.make_key(*key_parts))
+        try:
+            with gzip.open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put_bytes(self, namespace, data, *key_parts):
+        path = self._path(namespace, self.make_key(*key_parts))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(
+                fileobj=raw, mode="wb", mtime=0
+            ) as f:
+                f.write(data)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._size += size
+            over_budget = self.max_bytes is not None and self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def get_text(self, namespace, *key_parts):
+        data = self.get_bytes(namespace, *key_parts)
+        return None if data is None else data.decode("utf-8")
+
+    def put_text(self, namespace, text, *key_parts):
+        self.put_bytes(namespace, text.encode("utf-8"), *key_parts)
+
+    def get_json(self, namespace, *key_parts):
+        data = self.get_bytes(namespace, *key_parts)
+        return None if data is None else json.loads(data)
+
+    def put_json(self, namespace, value, *key_parts):
+        self.put_bytes(namespace, json.dumps(value).encode("utf-8"), *key_parts)
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its budget."""
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+            size = sum(stat.st_size for _, stat in entries)
+            target = self.max_bytes * 0.9
+            for path, stat in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= stat.st_size
+                self.evictions += 1
+            self._size = size
+        logging.info(f"Cache evicted down to {size} bytes ({self.evictions} evictions)")
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self._size,
+        }
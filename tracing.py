@@ -0,0 +1,260 @@
+"""Lightweight spans and per-stage histograms for the pipeline scripts.
+
+Wrap a unit of work in a span to record how long it took, how many bytes
+it read and how it ended:
+
+    with tracing.span("git.blame") as s:
+        result = subprocess.run(...)
+        s.bytes_read = len(result.stdout)
+        s.status = result.returncode
+
+Spans are aggregated in memory per name (count, total and max duration,
+bytes read, exit statuses and a histogram of durations), never stored
+one by one. After configure() the aggregate is written as JSON every
+interval seconds and at exit; worker processes write their own file
+(metrics file name plus the pid) when they call flush(). Summarize one or
+more metrics files with:
+
+    python tracing.py blame_metrics*.json
+"""
+import argparse
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the duration buckets, in seconds: 1 ms doubling up to ~17 min.
+BUCKETS = [0.001 * 2**k for k in range(21)]
+
+_lock = threading.Lock()
+_stats = {}
+_settings = {"path": None, "interval": None}
+_exporter = None
+_exporter_pid = None
+_started_at = time.time()
+
+
+def _reset_after_fork():
+    # A forked worker starts with a copy of the parent's numbers; drop them
+    # so that merging the per-process files does not count them twice.
+    global _stats, _lock
+    _lock = threading.Lock()
+    _stats = {}
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Span:
+    __slots__ = ("name", "bytes_read", "status")
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes_read = 0
+        self.status = 0
+
+
+def _new_stats():
+    return {
+        "count": 0,
+        "total_s": 0.0,
+        "max_s": 0.0,
+        "bytes_read": 0,
+        "status": {},
+        "buckets": [0] * (len(BUCKETS) + 1),
+    }
+
+
+def record(name, duration, bytes_read=0, status=0):
+    """Add one finished operation to the aggregate of name."""
+    index = 0
+    while index < len(BUCKETS) and duration > BUCKETS[index]:
+        index += 1
+    status = str(status)
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = _new_stats()
+        stats["count"] += 1
+        stats["total_s"] += duration
+        if duration > stats["max_s"]:
+            stats["max_s"] = duration
+        stats["bytes_read"] += bytes_read or 0
+        stats["status"][status] = stats["status"].get(status, 0) + 1
+        stats["buckets"][index] += 1
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block under name; yields a Span for bytes_read/status.
+
+    An exception ends the span with its returncode if it has one (as
+    subprocess.CalledProcessError does), otherwise with its class name.
+    """
+    current = Span(name)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.status = getattr(e, "returncode", None) or type(e).__name__
+        raise
+    finally:
+        record(name, time.perf_counter() - start, current.bytes_read, current.status)
+
+
+def quantile(buckets, q):
+    """Approximate quantile q from a bucket list: the upper bound of its bucket."""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(buckets):
+        seen += count
+        if seen >= rank:
+            return BUCKETS[index] if index < len(BUCKETS) else float("inf")
+    return None
+
+
+def snapshot():
+    """Return the current aggregate as a JSON-serializable dict."""
+    with _lock:
+        spans = {
+            name: {**stats, "status": dict(stats["status"]), "buckets": list(stats["buckets"])}
+            for name, stats in _stats.items()
+        }
+    for stats in spans.values():
+        for label, q in (("p50_s", 0.5), ("p90_s", 0.9), ("p99_s", 0.99)):
+            stats[label] = quantile(stats["buckets"], q)
+    return {
+        "pid": os.getpid(),
+        "started_at": _started_at,
+        "exported_at": time.time(),
+        "bucket_bounds_s": BUCKETS,
+        "spans": spans,
+    }
+
+
+def _metrics_path():
+    path = _settings["path"]
+    if path is None or _exporter_pid == os.getpid():
+        return path
+    # A forked worker; keep its numbers apart from the parent's.
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{ext}"
+
+
+def flush():
+    """Write the aggregate to the metrics file, if one is configured."""
+    path = _metrics_path()
+    if path is None:
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot(), f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _export_periodically(stop, interval):
+    while not stop.wait(interval):
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def configure(path, interval=60):
+    """Export to path every interval seconds (None: only at exit) and at exit."""
+    global _exporter, _exporter_pid
+    _settings.update(path=path, interval=interval)
+    _exporter_pid = os.getpid()
+    if _exporter is None:
+        atexit.register(flush)
+        if interval:
+            _exporter = threading.Event()
+            threading.Thread(
+                target=_export_periodically,
+                args=(_exporter, interval),
+                name="metrics-exporter",
+                daemon=True,
+            ).start()
+
+
+def add_arguments(parser, metrics_file):
+    """Add the --metrics, --metrics-interval and --debug options of a stage script."""
+    parser.add_argument(
+        "--metrics",
+        default=metrics_file,
+        help="JSON file the span metrics are exported to",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="seconds between metrics exports (0: only at exit)",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="log every file, line range and commit, not only problems",
+    )
+
+
+def configure_from_args(args):
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    configure(args.metrics, args.metrics_interval or None)
+
+
+def merge(snapshots):
+    """Combine the span aggregates of several snapshots (e.g. one per process)."""
+    merged = {}
+    for data in snapshots:
+        for name, stats in data["spans"].items():
+            target = merged.setdefault(name, _new_stats())
+            target["count"] += stats["count"]
+            target["total_s"] += stats["total_s"]
+            target["max_s"] = max(target["max_s"], stats["max_s"])
+            target["bytes_read"] += stats["bytes_read"]
+            for status, count in stats["status"].items():
+                target["status"][status] = target["status"].get(status, 0) + count
+            for index, count in enumerate(stats["buckets"]):
+                target["buckets"][index] += count
+    return merged
+
+
+def format_table(spans):
+    lines = [
+        f"{'span':<22} {'count':>8} {'total (s)':>10} {'mean (ms)':>10} "
+        f"{'p90 (ms)':>9} {'max (ms)':>9} {'MiB read':>9}  status"
+    ]
+    for name, stats in sorted(spans.items(), key=lambda item: -item[1]["total_s"]):
+        p90 = quantile(stats["buckets"], 0.9)
+        statuses = ", ".join(f"{s}={c}" for s, c in sorted(stats["status"].items()))
+        lines.append(
+            f"{name:<22} {stats['count']:>8} {stats['total_s']:>10.2f} "
+            f"{1000 * stats['total_s'] / stats['count']:>10.2f} "
+            f"{1000 * p90:>9.1f} {1000 * stats['max_s']:>9.1f} "
+            f"{stats['bytes_read'] / 1024**2:>9.2f}  {statuses}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize exported span metrics.")
+    parser.add_argument("metrics_files", nargs="+")
+    parser.add_argument("--json", action="store_true", help="print the merged spans as JSON")
+    args = parser.parse_args()
+
+    snapshots = []
+    for metrics_file in args.metrics_files:
+        with open(metrics_file) as f:
+            snapshots.append(json.load(f))
+    spans = merge(snapshots)
+    if args.json:
+        print(json.dumps(spans, indent=2))
+    else:
+        print(format_table(spans))